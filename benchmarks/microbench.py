@@ -0,0 +1,312 @@
+import argparse
+import json
+import sys
+import timeit
+import tracemalloc
+from typing import Callable
+
+from sonofflan.crypto import DeviceCipher, generate_iv
+from sonofflan.decoder import DATA_FIELDS, decode_payload, join_payload
+
+DEFAULT_MIN_TIME = 0.5
+DEFAULT_TOLERANCE = 0.2
+TXT_FIELD_SIZE = 249
+BASELINE_VERSION = 1
+
+BENCHMARK_KEY = "abcdefgh-ijkl-mnop-qrst-uvwxyz012345"
+
+# Announcements of real devices, from the smallest to the largest
+PAYLOADS = {
+    "plug": {
+        "switch": "on",
+        "startup": "off",
+        "pulse": "off",
+        "sledOnline": "on",
+        "pulseWidth": 500,
+        "rssi": -55,
+    },
+    "power_plug": {
+        "switch": "on",
+        "startup": "off",
+        "pulse": "off",
+        "sledOnline": "on",
+        "pulseWidth": 500,
+        "rssi": -55,
+        "voltage": "230.12",
+        "current": "4.87",
+        "power": "1120.44",
+    },
+    "strip": {
+        "sledOnline": "on",
+        "configure": [{"startup": "off", "outlet": x} for x in range(4)],
+        "pulses": [{"pulse": "off", "width": 1000, "outlet": x} for x in range(4)],
+        "switches": [{"switch": "on" if x % 2 else "off", "outlet": x} for x in range(4)],
+        "rssi": -61,
+    },
+}
+
+
+class BenchmarkResult:
+    """Result of a benchmark
+
+    Attributes
+    ----------
+    `name` : str
+        Name of the benchmark
+    `ops` : float
+        Operations per second
+    `allocated` : int
+        Peak memory in bytes allocated by one operation
+    """
+
+    def __init__(self, name: str, ops: float, allocated: int) -> None:
+        self._name = name
+        self._ops = ops
+        self._allocated = allocated
+
+    def __repr__(self) -> str:
+        return f"BenchmarkResult({self._name} ops={self._ops:.0f}/s allocated={self._allocated}B)"
+
+    @property
+    def name(self) -> str:
+        """Name of the benchmark"""
+
+        return self._name
+
+    @property
+    def ops(self) -> float:
+        """Operations per second"""
+
+        return self._ops
+
+    @property
+    def allocated(self) -> int:
+        """Peak memory in bytes allocated by one operation"""
+
+        return self._allocated
+
+
+def txt_properties(payload: dict, cipher: DeviceCipher | None = None) -> dict[bytes, bytes]:
+    """Build the TXT record properties announced by a device
+
+    Parameters
+    ----------
+    `payload` : dict
+        Data announced by the device
+    `cipher` : DeviceCipher|None
+        Cipher for the device (None if the device is not encrypted)
+
+    Return
+    ------
+    The properties, with the data split in fields like the devices do
+    """
+
+    properties = {b"id": b"1000000000", b"type": b"plug"}
+    data = json.dumps(payload)
+    if cipher is not None:
+        iv = generate_iv()
+        properties[b"encrypt"] = b"true"
+        properties[b"iv"] = iv.encode("utf8")
+        data = cipher.encrypt(data, iv)
+    data = data.encode("utf8")
+    fields = [data[x:x + TXT_FIELD_SIZE] for x in range(0, len(data), TXT_FIELD_SIZE)]
+    if len(fields) > len(DATA_FIELDS):
+        raise ValueError(f"Payload of {len(data)} bytes doesn't fit in the TXT record")
+    properties.update(zip(DATA_FIELDS, fields))
+    return properties
+
+
+def benchmarks() -> dict[str, Callable[[], object]]:
+    """Get the benchmarks to run
+
+    For every payload the benchmarks cover the encryption and decryption
+    with the cipher of the device, and the full decoding of the TXT record
+    (as done by the browser) for both encrypted and plain devices.
+
+    Return
+    ------
+    The function to run for each benchmark
+    """
+
+    cipher = DeviceCipher(BENCHMARK_KEY)
+    iv = generate_iv()
+    result = {"generate_iv": generate_iv}
+    for name, payload in PAYLOADS.items():
+        plain = json.dumps(payload)
+        encrypted = cipher.encrypt(plain, iv)
+        properties = txt_properties(payload, cipher)
+        plain_properties = txt_properties(payload)
+        result[f"encrypt/{name}"] = (lambda p=plain: cipher.encrypt(p, iv))
+        result[f"decrypt/{name}"] = (lambda e=encrypted: cipher.decrypt(e, iv))
+        result[f"decode/{name}"] = (lambda p=properties: decode_payload(join_payload(p), p[b"iv"], cipher))
+        result[f"decode_plain/{name}"] = (lambda p=plain_properties: decode_payload(join_payload(p)))
+    return result
+
+
+def measure(name: str, func: Callable[[], object], min_time: float = DEFAULT_MIN_TIME) -> BenchmarkResult:
+    """Measure a benchmark
+
+    The speed is the best of 3 timed runs, each lasting about a third of
+    `min_time`. The allocations are measured separately with tracemalloc,
+    which would slow down the timed runs.
+
+    Parameters
+    ----------
+    `name` : str
+        Name of the benchmark
+    `func` : Callable
+        Function to measure
+    `min_time` : float
+        Minimum time in seconds spent measuring the speed
+
+    Return
+    ------
+    The result of the benchmark
+    """
+
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / 3 / elapsed))
+    best = min(timer.repeat(repeat=3, number=number))
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        func()  # Warm up the caches
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+    return BenchmarkResult(name, number / best, max(0, peak - current))
+
+
+def run_benchmarks(select: str | None = None, min_time: float = DEFAULT_MIN_TIME) -> list[BenchmarkResult]:
+    """Run the benchmarks
+
+    Parameters
+    ----------
+    `select` : str|None
+        Run only the benchmarks whose name contains this string (all if not set)
+    `min_time` : float
+        Minimum time in seconds spent measuring the speed of each benchmark
+
+    Return
+    ------
+    The results of the benchmarks
+    """
+
+    return [measure(name, func, min_time) for name, func in benchmarks().items() if select is None or select in name]
+
+
+def save_baseline(results: list[BenchmarkResult], path: str) -> None:
+    """Save the results as baseline
+
+    Parameters
+    ----------
+    `results` : list
+        The results of the benchmarks
+    `path` : str
+        Path of the baseline file (JSON)
+    """
+
+    baseline = {
+        "version": BASELINE_VERSION,
+        "python": sys.version.split()[0],
+        "results": {x.name: {"ops": x.ops, "allocated": x.allocated} for x in results},
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2)
+
+
+def load_baseline(path: str) -> list[BenchmarkResult]:
+    """Load the results saved as baseline
+
+    Parameters
+    ----------
+    `path` : str
+        Path of the baseline file (JSON)
+
+    Return
+    ------
+    The results of the benchmarks
+    """
+
+    with open(path) as f:
+        baseline = json.load(f)
+    if baseline.get("version") != BASELINE_VERSION:
+        raise ValueError(f"Unsupported baseline version {baseline.get('version')}")
+    return [BenchmarkResult(name, x["ops"], x["allocated"]) for name, x in baseline["results"].items()]
+
+
+def compare(results: list[BenchmarkResult], baseline: list[BenchmarkResult],
+            tolerance: float = DEFAULT_TOLERANCE) -> list[str]:
+    """Compare the results against a baseline
+
+    Parameters
+    ----------
+    `results` : list
+        The results of the benchmarks
+    `baseline` : list
+        The results saved as baseline
+    `tolerance` : float
+        Relative change allowed before reporting a regression (0.2 for 20%)
+
+    Return
+    ------
+    The regressions (empty if there are none)
+    """
+
+    reference = {x.name: x for x in baseline}
+    regressions = []
+    for result in results:
+        base = reference.get(result.name)
+        if base is None:
+            continue
+        if result.ops < base.ops * (1 - tolerance):
+            regressions.append(f"{result.name}: {result.ops:.0f} ops/s, was {base.ops:.0f} ops/s")
+        if result.allocated > base.allocated * (1 + tolerance):
+            regressions.append(f"{result.name}: {result.allocated} bytes allocated, was {base.allocated} bytes")
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="benchmarks.microbench",
+        description="Microbenchmarks for the encryption and the decoding of the announcements",
+    )
+    parser.add_argument("-k", "--select", help="Run only the benchmarks whose name contains this string")
+    parser.add_argument("-t", "--min-time", help="Seconds spent on each benchmark", type=float,
+                        default=DEFAULT_MIN_TIME)
+    parser.add_argument("-s", "--save", help="Save the results as baseline to this file")
+    parser.add_argument("-c", "--compare", help="Compare the results against the baseline in this file")
+    parser.add_argument("--tolerance", help="Relative change reported as regression", type=float,
+                        default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline(args.compare) if args.compare else None
+    results = run_benchmarks(args.select, args.min_time)
+    reference = {x.name: x for x in baseline or []}
+    for result in results:
+        line = f"{result.name:<26} {result.ops:>12.0f} ops/s {result.allocated:>8} B"
+        base = reference.get(result.name)
+        if base is not None:
+            line += f"  ({(result.ops / base.ops - 1) * 100:+.1f}% ops/s, {result.allocated - base.allocated:+d} B)"
+        print(line)
+    if args.save:
+        save_baseline(results, args.save)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,9 +3,10 @@ import asyncio
 import json
 import logging
 
-from sonofflan.browser import Browser
+from sonofflan.browser import Browser, DEFAULT_DISCOVERY_MIN_WAIT, DEFAULT_DISCOVERY_TIMEOUT, DEFAULT_QUIET_PERIOD
 from sonofflan.config import DevicesConfig
 from sonofflan.devices import Device, Plug, Strip, PowerPlug, ThermoPlug
+from sonofflan.registry import Registry
 
 log_formatter = logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 stream_handler = logging.StreamHandler()
@@ -22,6 +23,8 @@ def print_device(device: Device) -> None:
     print(f"{device.name} [{device.id}]")
     print(f"  Url:         {device.url}")
     print(f"  Type:        {type(device).__name__}")
+    if not device.verified:
+        print("  State:       unverified (loaded from the registry)")
     if isinstance(device, Plug):
         print(f"  Status:      {'on' if device.status else 'off'}")
     elif isinstance(device, Strip):
@@ -53,25 +56,25 @@ def info(devices: dict[str, Device], device_id: str) -> None:
     print_device(devices[device_id])
 
 
-async def command(devices: dict[str, Device], device_id: str, cmd: str) -> None:
-    if device_id not in devices:
+async def command(browser: Browser, device_id: str, cmd: str) -> None:
+    if device_id not in browser.devices:
         logger.error(f"Device with ID {device_id} not found")
         return
-    device = devices[device_id]
+    device = browser.devices[device_id]
     print_device(device)
-    # noinspection PyBroadException
-    try:
-        m = getattr(device, cmd)
-        if isinstance(device, Plug):
-            m()
-        elif isinstance(device, Strip):
-            m(args.outlet)
-        else:
-            raise Exception()
-        await asyncio.sleep(5)  # Wait for update to propagate
-        print_device(device)
-    except Exception:
+    if not isinstance(device, (Plug, Strip)):
         logger.error(f"Unsupported device of type \"{type(device).__name__}\"")
+        return
+    try:
+        result = await browser.send_and_confirm(device_id, cmd, args.outlet if isinstance(device, Strip) else None)
+    except asyncio.TimeoutError:
+        logger.error(f"Command {cmd} not confirmed by the device")
+        return
+    if not result.ok:
+        logger.error(f"Command {cmd} failed: {result}")
+        return
+    logger.info(f"Command {cmd} completed in {result.rtt * 1000:.0f}ms")
+    print_device(device)
 
 
 async def main() -> None:
@@ -79,17 +82,24 @@ async def main() -> None:
     # noinspection PyBroadException
     try:
         logger.info("Creating Sonoff Zeroconfig browser...")
-        browser = Browser(config)
+        browser = Browser(config, registry=Registry(args.registry) if args.registry is not None else None)
 
         logger.info("Waiting for discovery")
-        await asyncio.sleep(5)
+        if args.action == "discover":
+            # Until no new devices are found for a while (giving slow devices some time to answer)
+            await browser.wait_quiet(period=args.quiet_period, timeout=args.timeout,
+                                     min_wait=min(args.min_wait, args.timeout))
+        else:
+            # Only for the device needed: commands can use the device loaded from the registry, while the info
+            # needs its current state
+            await browser.wait_for_devices([args.device], timeout=args.timeout, verified=args.action == "info")
 
         if args.action == "discover":
             discover(browser.devices)
         elif args.action == "info":
             info(browser.devices, args.device)
         else:
-            await command(browser.devices, args.device, args.action)
+            await command(browser, args.device, args.action)
     except Exception:
         logger.error("Exception", exc_info=True)
     finally:
@@ -107,6 +117,13 @@ if __name__ == "__main__":
     logparser.add_argument("-q", "--quiet", help="Quiet", action="store_true", default=False)
     common_parser.add_argument("-k", "--key", help="Device encryption key")
     common_parser.add_argument("-c", "--config", help="Device configuration", type=argparse.FileType("r"))
+    common_parser.add_argument("-r", "--registry", help="Registry of the known devices (updated at exit)")
+    common_parser.add_argument("-t", "--timeout", help="Maximum seconds waiting for the discovery", type=float,
+                               default=DEFAULT_DISCOVERY_TIMEOUT)
+    common_parser.add_argument("--quiet-period", help="Seconds without new devices ending the discovery", type=float,
+                               default=DEFAULT_QUIET_PERIOD)
+    common_parser.add_argument("--min-wait", help="Minimum seconds waiting for the discovery", type=float,
+                               default=DEFAULT_DISCOVERY_MIN_WAIT)
 
     common_device_not_required_parser = argparse.ArgumentParser(add_help=False)
     common_device_not_required_parser.add_argument("-d", "--device", help="Device ID")
@@ -1,24 +1,32 @@
 import asyncio
-import json
 import logging
-from copy import deepcopy
+import time
+from concurrent.futures import Executor
+from typing import Callable
 
-from zeroconf import ServiceStateChange, Zeroconf
+from zeroconf import IPVersion, ServiceStateChange, Zeroconf
 from zeroconf.asyncio import AsyncServiceBrowser, AsyncZeroconf
 
 from sonofflan.config import DevicesConfig
-from sonofflan.crypto import decrypt
-from sonofflan.devices import create_device, Device
+from sonofflan.decoder import BatchDecoder, decode_payload, join_payload
+from sonofflan.devices import create_device, CommandResult, Device, DeviceSnapshot, Plug, Strip
 from sonofflan.errors import (
     InvalidDeviceError,
     MissingDeviceKeyError,
     NoInfoError,
     NotConfiguredDeviceError
 )
-from sonofflan.utils import parse_address
+from sonofflan.events import DEFAULT_MAX_EVENTS, EventBus, EventQueue, Subscription
+from sonofflan.registry import Registry
+from sonofflan.staleness import StalenessTracker
 
 SERVICE_TYPE = "_ewelink._tcp.local."
 DEVICE_PREFIX = "eWeLink_"
+DEFAULT_CONFIRM_TIMEOUT = 5.0
+DEFAULT_DISCOVERY_TIMEOUT = 5.0
+DEFAULT_QUIET_PERIOD = 1.0
+DEFAULT_DISCOVERY_MIN_WAIT = 3.0
+MAX_IGNORED_NAMES = 65536
 
 
 class Event:
@@ -28,22 +36,45 @@ class Event:
     ----------
     `action` : ServiceStateChange
         The action on the device
-    `device` : Device
-        The device for the event
+    `device` : DeviceSnapshot
+        Snapshot of the device state at the time of the event (use
+        `Browser.devices` to send commands to the device)
+    `expired` : bool
+        For a Removed event, if the device stopped announcing itself for
+        longer than the TTL of the browser (False if it sent an mDNS goodbye)
     """
 
-    def __init__(self, action: ServiceStateChange, device: Device):
+    __slots__ = ("_action", "_device", "_expired")
+
+    def __init__(self, action: ServiceStateChange, device: Device | DeviceSnapshot, expired: bool = False):
         self._action = action
-        self._device = deepcopy(device)
+        self._device = device if isinstance(device, DeviceSnapshot) else device.snapshot()
+        self._expired = expired
 
     @property
     def action(self) -> ServiceStateChange:
         return self._action
 
     @property
-    def device(self) -> Device:
+    def device(self) -> DeviceSnapshot:
         return self._device
 
+    @property
+    def expired(self) -> bool:
+        return self._expired
+
+
+def _merge_events(event: Event, other: Event) -> Event:
+    """Merge a queued event with a newer one for the same device
+
+    The newer state wins, but a device added and then updated before the
+    consumer got the event is still reported as added.
+    """
+
+    if event.action == ServiceStateChange.Added and other.action == ServiceStateChange.Updated:
+        return Event(ServiceStateChange.Added, other.device)
+    return other
+
 
 class Browser:
     """Zeroconf browser for Sonoff devices
@@ -52,20 +83,60 @@ class Browser:
     ----------
     `devices` : dict
         Dictionary with the devices that were found
+    `skipped` : int
+        Number of announcements skipped because nothing changed
+    `ignored` : int
+        Number of announcements of not configured devices ignored without querying them
+    `superseded` : int
+        Number of announcements whose processing was cancelled by a newer one
+    `event_queue` : EventQueue
+        The queue of the events for `wait_event` (with depth, drops and coalesced counters)
     """
 
-    def __init__(self, config: DevicesConfig):
+    def __init__(self, config: DevicesConfig, executor: Executor | None = None,
+                 max_events: int = DEFAULT_MAX_EVENTS, registry: Registry | None = None, ttl: float | None = None):
         """
         Parameters
         ----------
         `config` : DevicesConfig
             Configuration for the device
+        `executor` : Executor|None
+            Thread or process pool decoding the encrypted announcements
+            (the default executor of the loop if not set)
+        `max_events` : int
+            Maximum number of events waiting for `wait_event`: events for a
+            device already in the queue replace the queued one, and the
+            oldest event is dropped when the queue is full
+        `registry` : Registry|None
+            Registry of the last known devices: they are available
+            immediately (not verified until they announce themselves) and
+            the registry is saved at shutdown
+        `ttl` : float|None
+            Seconds without announcements before a device is set offline
+            (None to set devices offline only when they are removed): the
+            device is reported with a Removed event marked as `expired`
         """
 
         self._config = config
+        self._decoder = BatchDecoder(executor)
         self._devices = {}
-        self._queue = asyncio.Queue()
+        self._fingerprints: dict[str, int] = {}
+        self._skipped = 0
+        self._ignored_names: set[str] = set()
+        self._ignored = 0
+        self._tasks: dict[str, tuple[asyncio.Task, ServiceStateChange]] = {}
+        self._last_data: dict[str, dict] = {}
+        self._announced: dict[str, float] = {}
+        self._superseded = 0
+        self._waiters: dict[str, list[tuple[Callable[[Device], bool], asyncio.Future]]] = {}
+        self._discovered = asyncio.Event()
+        self._bus = EventBus(_merge_events)
+        self._queue = self._bus.subscribe(max_events=max_events)
         self._logger = logging.getLogger(f"sonofflan.browser")
+        self._tracker = StalenessTracker(ttl, self._expired) if ttl is not None else None
+        self._registry = registry
+        if registry is not None:
+            self._load_registry()
 
         self._logger.debug("Starting...")
         self._zeroconf = AsyncZeroconf()
@@ -76,20 +147,81 @@ class Browser:
 
         self._logger.debug("Stopping...")
         await self._browser.async_cancel()
-        await self._queue.put(None)
+        for task, _ in list(self._tasks.values()):
+            task.cancel()
+        if self._tracker is not None:
+            self._tracker.close()
+        if self._registry is not None:
+            # noinspection PyBroadException
+            try:
+                self._registry.save()
+            except Exception:
+                self._logger.error(f"Cannot save {self._registry}", exc_info=True)
+        self._bus.close()
         self._logger.debug("Stopped")
 
-    async def wait_event(self) -> Event:
-        """Get one event from the queue"""
+    def _load_registry(self) -> None:
+        """Create the configured devices found in the registry (not verified)"""
+
+        for data in self._registry.load():
+            config = self._config.device(data["id"])
+            if config is None:
+                continue
+            # noinspection PyBroadException
+            try:
+                device = create_device(data, config)
+            except Exception:
+                self._logger.warning(f"Invalid data for device {data['id']} in {self._registry}", exc_info=True)
+                continue
+            self._devices[device.id] = device
+            self._last_data[device.id] = data
+            if self._tracker is not None:
+                self._tracker.touch(device.id)
+            self._logger.debug(f"Loaded {device} from {self._registry}")
+
+    async def wait_event(self) -> Event | None:
+        """Get one event from the queue (None after the shutdown)"""
         return await self._queue.get()
 
     def event_processed(self) -> None:
         """Mark the event as processed"""
         self._queue.task_done()
 
-    async def _enqueue_event(self, action: ServiceStateChange, device: Device) -> None:
+    def subscribe(self, ids: list[str] | None = None, types: list[type[Device]] | None = None,
+                  actions: list[ServiceStateChange] | None = None,
+                  max_events: int = DEFAULT_MAX_EVENTS) -> Subscription:
+        """Subscribe to the events
+
+        Every subscription gets the events matching its filters in its own
+        bounded queue, independently of the other consumers.
+
+        Parameters
+        ----------
+        `ids` : list[str]|None
+            IDs of the devices of interest (None for all)
+        `types` : list[type]|None
+            Classes of the devices of interest, including their subclasses (None for all)
+        `actions` : list[ServiceStateChange]|None
+            Actions of interest (None for all)
+        `max_events` : int
+            Maximum number of events waiting in the queue of the subscription
+
+        Return
+        ------
+        The subscription (close it to stop receiving events)
+        """
+
+        return self._bus.subscribe(ids, types, actions, max_events)
+
+    def _enqueue_event(self, action: ServiceStateChange, device: Device, expired: bool = False) -> None:
         self._logger.debug(f"New event {action.name} for {device}")
-        await self._queue.put(Event(action, device))
+        self._bus.publish(device.id, Event(action, device, expired), type(device), action)
+
+    @property
+    def event_queue(self) -> EventQueue:
+        """The queue of the events for `wait_event` (with depth, drops and coalesced counters)"""
+
+        return self._queue.queue
 
     @property
     def devices(self) -> dict[str, Device]:
@@ -97,11 +229,312 @@ class Browser:
 
         return self._devices
 
+    @property
+    def skipped(self) -> int:
+        """Number of announcements skipped because nothing changed"""
+
+        return self._skipped
+
+    @property
+    def ignored(self) -> int:
+        """Number of announcements of not configured devices ignored without querying them"""
+
+        return self._ignored
+
+    @property
+    def superseded(self) -> int:
+        """Number of announcements whose processing was cancelled by a newer one"""
+
+        return self._superseded
+
+    async def wait_for_devices(self, ids: list[str] | None = None, timeout: float | None = DEFAULT_DISCOVERY_TIMEOUT,
+                               verified: bool = False) -> list[str]:
+        """Wait until some devices are found
+
+        Parameters
+        ----------
+        `ids` : list[str]|None
+            IDs of the devices to wait for (None for all the configured devices)
+        `timeout` : float|None
+            Maximum time to wait in seconds (None to wait forever)
+        `verified` : bool
+            If the devices loaded from the registry must announce themselves too
+
+        Return
+        ------
+        The IDs of the devices not found before the timeout (empty if all were found)
+        """
+
+        ids = self._config.ids() if ids is None else list(ids)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            missing = [
+                x for x in ids if x not in self._devices or (verified and not self._devices[x].verified)
+            ]
+            if not missing:
+                return []
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                self._logger.debug(f"Devices {missing} not found in {timeout}s")
+                return missing
+            try:
+                await asyncio.wait_for(self._discovered.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait_quiet(self, period: float = DEFAULT_QUIET_PERIOD,
+                         timeout: float | None = DEFAULT_DISCOVERY_TIMEOUT, min_wait: float = 0) -> bool:
+        """Wait until no new devices are found for a while
+
+        Parameters
+        ----------
+        `period` : float
+            Seconds without new devices
+        `timeout` : float|None
+            Maximum time to wait in seconds (None to wait forever)
+        `min_wait` : float
+            Minimum time to wait in seconds, so slow devices can announce
+            themselves before the quiet period ends
+
+        Return
+        ------
+        True if the quiet period was reached, False if the timeout expired before
+        """
+
+        start = time.monotonic()
+        deadline = start + timeout if timeout is not None else None
+        while True:
+            wait = max(period, start + min_wait - time.monotonic())
+            truncated = False
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                if remaining < wait:
+                    wait, truncated = remaining, True
+            try:
+                await asyncio.wait_for(self._discovered.wait(), wait)
+            except asyncio.TimeoutError:
+                if not truncated:
+                    return True
+
+    def _set_offline(self, device_id: str, reason: str, expired: bool = False) -> None:
+        """Mark a device as offline, emitting a Removed event
+
+        Parameters
+        ----------
+        `device_id` : str
+            ID of the device
+        `reason` : str
+            Why the device is offline
+        `expired` : bool
+            If the device stopped announcing itself (instead of being removed)
+        """
+
+        if self._tracker is not None:
+            self._tracker.remove(device_id)
+        self._fingerprints.pop(device_id, None)  # The next announcement is applied even if unchanged
+        device = self._devices.get(device_id)
+        if device is None or not device.online:
+            return
+        device.online = False
+        self._logger.info(f"{device} {reason}: set offline")
+        self._enqueue_event(ServiceStateChange.Removed, device, expired)
+
+    def last_announcement(self, device_id: str) -> float | None:
+        """Get when a device announced itself for the last time
+
+        Parameters
+        ----------
+        `device_id` : str
+            ID of the device
+
+        Return
+        ------
+        The time of the last announcement (time.monotonic), None if never announced
+        """
+
+        return self._announced.get(device_id)
+
+    def apply_poll(self, device_id: str, payload: dict) -> bool:
+        """Update a device with the state returned by polling it
+
+        The polled data is merged with the last data announced by the
+        device (it may not include all the fields, e.g. the power meter),
+        and an Updated event is emitted as if the device announced it.
+        Used by the Poller, or by any code querying the devices directly.
+
+        Parameters
+        ----------
+        `device_id` : str
+            ID of the device
+        `payload` : dict
+            The decoded state of the device
+
+        Return
+        ------
+        True if the device was updated
+        """
+
+        device = self._devices.get(device_id)
+        last = self._last_data.get(device_id)
+        if device is None or last is None:
+            return False
+        if self._tracker is not None:
+            self._tracker.touch(device_id)
+        data = {x: last[x] for x in ("id", "type", "address", "addresses", "port", "encrypt") if x in last}
+        data["data"] = dict(last["data"], **payload)
+        if data == last and device.online:
+            return True  # Nothing changed
+        discovered = not device.verified
+        device.update(data)
+        self._fingerprints.pop(device_id, None)  # The next announcement is applied even if unchanged
+        self._last_data[device_id] = data
+        if self._registry is not None:
+            self._registry.record(data)
+        if discovered:
+            self._device_discovered()
+        self._notify(device)
+        self._enqueue_event(ServiceStateChange.Updated, device)
+        return True
+
+    def _expired(self, device_id: str) -> None:
+        """Called by the tracker for the devices not announced before the TTL"""
+
+        self._set_offline(device_id, f"not announced for {self._tracker.ttl}s", expired=True)
+
+    def _device_discovered(self) -> None:
+        """Wake up the tasks waiting for new devices"""
+
+        self._discovered.set()
+        self._discovered = asyncio.Event()
+
+    async def wait_update(self, device_id: str, predicate: Callable[[Device], bool],
+                          timeout: float | None = DEFAULT_CONFIRM_TIMEOUT) -> Device:
+        """Wait for the next update of a device matching a condition
+
+        Parameters
+        ----------
+        `device_id` : str
+            ID of the device
+        `predicate` : Callable
+            Condition on the updated device
+        `timeout` : float|None
+            Maximum time to wait in seconds (None to wait forever)
+
+        Return
+        ------
+        The updated device (raises asyncio.TimeoutError if the timeout expires)
+        """
+
+        future = self._add_waiter(device_id, predicate)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._remove_waiter(device_id, future)
+
+    async def send_and_confirm(self, device_id: str, command: str, outlet: int | None = None,
+                               timeout: float | None = DEFAULT_CONFIRM_TIMEOUT) -> CommandResult:
+        """Send a switch command and wait until the device announces the new status
+
+        A command to the status the device already announced is confirmed
+        as soon as the device accepts it.
+
+        Parameters
+        ----------
+        `device_id` : str
+            ID of the device
+        `command` : str
+            The command ("on", "off" or "toggle")
+        `outlet` : int|None
+            Outlet ID (required for Strip devices)
+        `timeout` : float|None
+            Maximum time in seconds for the command and its confirmation (None to wait forever)
+
+        Return
+        ------
+        The result of the command (raises asyncio.TimeoutError if the new
+        status is not announced before the timeout)
+        """
+
+        if device_id not in self._devices:
+            raise KeyError(f"Device with ID {device_id} not found")
+        if command not in ("on", "off", "toggle"):
+            raise ValueError(f"Unsupported command \"{command}\"")
+        device = self._devices[device_id]
+        if isinstance(device, Plug):
+            target = (not device.status) if command == "toggle" else (command == "on")
+            predicate = (lambda x: x.announced_status == target)  # Not the optimistic status
+            args = ()
+        elif isinstance(device, Strip):
+            if outlet is None:
+                raise ValueError(f"Missing outlet for {device}")
+            target = (not device.status(outlet)) if command == "toggle" else (command == "on")
+            predicate = (lambda x: x.announced_status(outlet) == target)
+            args = (outlet,)
+        else:
+            raise ValueError(f"Unsupported device {device}")
+
+        start = time.monotonic()
+        future = self._add_waiter(device_id, predicate)  # Registered before sending not to miss the update
+        try:
+            result = await asyncio.wait_for(getattr(device, command)(*args), timeout)
+            if not result.ok:
+                return result
+            if predicate(device):
+                # Already announced (e.g. a command to the current state: the device announces nothing new)
+                self._logger.debug(f"Command {command} confirmed by {device} in {time.monotonic() - start:.3f}s")
+                return result
+            if timeout is not None:
+                timeout = max(0.0, timeout - (time.monotonic() - start))
+            await asyncio.wait_for(future, timeout)
+            self._logger.debug(f"Command {command} confirmed by {device} in {time.monotonic() - start:.3f}s")
+            return result
+        finally:
+            self._remove_waiter(device_id, future)
+
+    def _add_waiter(self, device_id: str, predicate: Callable[[Device], bool]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(device_id, []).append((predicate, future))
+        return future
+
+    def _remove_waiter(self, device_id: str, future: asyncio.Future) -> None:
+        waiters = [x for x in self._waiters.get(device_id, []) if x[1] is not future]
+        if waiters:
+            self._waiters[device_id] = waiters
+        else:
+            self._waiters.pop(device_id, None)
+
+    def _notify(self, device: Device) -> None:
+        """Wake up the waiters whose condition is matched by the updated device"""
+
+        for predicate, future in self._waiters.get(device.id, []):
+            # noinspection PyBroadException
+            try:
+                if not future.done() and predicate(device):
+                    future.set_result(device)
+            except Exception:
+                self._logger.debug(f"Exception checking condition on {device}", exc_info=True)
+
     # noinspection PyUnusedLocal
     def _update(self, zeroconf: Zeroconf, service_type: str, name: str, state_change: ServiceStateChange) -> None:
-        asyncio.get_running_loop().create_task(
+        # One announcement at a time for each device: a newer one supersedes the one in progress
+        previous, action = self._tasks.get(name, (None, None))
+        if previous is not None and not previous.done():
+            self._logger.debug(f'Service:"{name}" Action:{state_change.name} supersedes the one in progress')
+            previous.cancel()
+            self._superseded += 1
+            if action == ServiceStateChange.Added and state_change == ServiceStateChange.Updated:
+                state_change = action  # Never completed: the device is still reported as added
+        task = asyncio.get_running_loop().create_task(
             self._async_update(service_type, name, state_change)
         )
+        self._tasks[name] = (task, state_change)
+        task.add_done_callback(lambda x: self._task_done(name, x))
+
+    def _task_done(self, name: str, task: asyncio.Task) -> None:
+        if self._tasks.get(name, (None,))[0] is task:
+            del self._tasks[name]
 
     # noinspection PyBroadException
     async def _async_update(self, service_type: str, name: str, state_change: ServiceStateChange):
@@ -109,6 +542,24 @@ class Browser:
             self._logger.debug(f'Service:"{name}" Action:{state_change.name}')
             if not name.startswith(DEVICE_PREFIX) or not name.endswith("." + SERVICE_TYPE):
                 raise InvalidDeviceError(name)
+            if name in self._ignored_names:
+                self._ignored += 1
+                return
+            # The ID is in the name: don't query the devices that are not configured
+            name_id = name[len(DEVICE_PREFIX):-(len(SERVICE_TYPE) + 1)]
+            if self._config.device(name_id) is None:
+                if len(self._ignored_names) >= MAX_IGNORED_NAMES:
+                    self._ignored_names.clear()
+                self._ignored_names.add(name)
+                self._ignored += 1
+                raise NotConfiguredDeviceError(name_id, "unknown")
+            if state_change == ServiceStateChange.Removed:
+                # The service info may be gone already: the ID in the name is enough
+                self._set_offline(name_id, "removed")
+                return
+            if self._tracker is not None:
+                self._tracker.touch(name_id)
+            self._announced[name_id] = time.monotonic()
             info = await self._zeroconf.async_get_service_info(service_type, name)
             if info is None:
                 raise NoInfoError(name)
@@ -118,31 +569,57 @@ class Browser:
             if config is None:
                 raise NotConfiguredDeviceError(device_id, device_type)
             self._logger.debug(f"Got config {config}")
-            extra = b"".join(map(lambda x: info.properties.get(x) or b"", [b"data1", b"data2", b"data3", b"data4"]))
+            # IPv4 first, then IPv6 (with the scope of the link-local addresses, e.g. "fe80::1%eth0")
+            addresses = info.parsed_scoped_addresses(IPVersion.All)
+            if not addresses:
+                raise NoInfoError(name)
+            extra = join_payload(info.properties)
             encrypt = (info.properties.get(b"encrypt") == b"true")
+            fingerprint = hash(
+                (device_type, encrypt, info.properties.get(b"iv"), extra, tuple(addresses), info.port)
+            )
+            device = self._devices.get(device_id)
+            if self._fingerprints.get(device_id) == fingerprint and device is not None and device.online:
+                self._skipped += 1
+                self._logger.debug(f"Nothing changed for {self._devices[device_id]}, skipping it")
+                self._notify(device)  # The announcement may still confirm a command
+                return
             if encrypt:
-                if config.key is None:
+                if config.cipher is None:
                     raise MissingDeviceKeyError(device_id, device_type)
-                iv = info.properties.get(b"iv").decode("utf8")
-                extra = decrypt(extra.decode("utf8"), iv, config.key)
+                payload = await self._decoder.decode(extra, info.properties.get(b"iv"), config.cipher)
+            else:
+                payload = decode_payload(extra)  # Plain JSON: not worth a trip to the executor
             data = {
                 "id": device_id,
                 "type": device_type,
-                "address": parse_address(info.addresses[0]),
+                "address": addresses[0],
+                "addresses": addresses,
                 "port": info.port,
                 "encrypt": encrypt,
-                "data": json.loads(extra.decode("utf8"))
+                "data": payload
             }
             self._logger.info(f"{state_change.name} device id:{data['id']} type:{data['type']} name:{config.name}")
-            if data['id'] not in self._devices:
-                self._devices[data['id']] = create_device(data, config)
-            device = self._devices[data['id']]
-            if state_change != ServiceStateChange.Removed:
-                device.update(data)
-            else:
-                # TODO Maybe set as offline?
-                pass
-            await self._enqueue_event(state_change, device)
+            device = self._devices.get(data['id'])
+            discovered = (device is None or not device.verified)
+            if device is not None and not device.verified:
+                replacement = create_device(data, config)
+                if type(replacement) is not type(device):
+                    self._logger.info(f"Replacing {device} loaded from the registry with {replacement}")
+                    self._devices[data['id']] = device = replacement
+            if device is None:
+                self._devices[data['id']] = device = create_device(data, config)
+            if not device.online:
+                self._logger.info(f"{device} is back online")
+            device.update(data)
+            self._fingerprints[device_id] = fingerprint
+            self._last_data[device_id] = data
+            if self._registry is not None:
+                self._registry.record(data)
+            if discovered:
+                self._device_discovered()
+            self._notify(device)
+            self._enqueue_event(state_change, device)
             self._logger.info(f"{state_change.name} {device}")
         except InvalidDeviceError as ex:
             self._logger.warning(f'{ex}, ignoring it')
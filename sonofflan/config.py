@@ -1,3 +1,6 @@
+from sonofflan.crypto import DeviceCipher
+
+
 class DeviceConfig:
     """Hold device configuration.
 
@@ -5,6 +8,8 @@ class DeviceConfig:
     ID is the only required field. Name is used for display and ID will
     be used if not set.
     Key is required only for encrypted devices (not DIY mode).
+    Optimistic enables the optimistic status: commands update the status
+    of the device immediately, without waiting for the device announcement.
 
     Attributes
     ----------
@@ -14,6 +19,10 @@ class DeviceConfig:
         Name of the device (if not set, the ID will be used)
     `key` : str|None
         Encryption key for the device (used only if the device is encrypted).
+    `cipher` : DeviceCipher|None
+        Cipher for the device messages (available only if the key is set).
+    `optimistic` : bool
+        If the status is updated optimistically by commands (disabled if not set).
     """
 
     def __init__(self, c: dict) -> None:
@@ -31,10 +40,14 @@ class DeviceConfig:
         self._id = str(c["id"])
         self._name = None
         self._key = None
+        self._cipher = None
+        self._optimistic = False
         if "name" in c:
             self._name = c["name"]
         if "key" in c and c["key"] != "":
             self._key = c["key"]
+        if "optimistic" in c:
+            self._optimistic = bool(c["optimistic"])
 
     def __repr__(self) -> str:
         return f"DeviceConfig(\"{self._name}\" id:{self._id} key:{self._key})"
@@ -57,6 +70,23 @@ class DeviceConfig:
 
         return self._key
 
+    @property
+    def cipher(self) -> DeviceCipher | None:
+        """The cipher for the device messages (or None if the key is not set)
+
+        The cipher is created on first use and cached.
+        """
+
+        if self._cipher is None and self._key is not None:
+            self._cipher = DeviceCipher(self._key)
+        return self._cipher
+
+    @property
+    def optimistic(self) -> bool:
+        """If the status is updated optimistically by commands"""
+
+        return self._optimistic
+
 
 class DevicesConfig:
     """Hold the configuration for all the devices.
@@ -118,6 +148,11 @@ class DevicesConfig:
 
         return len(self._devices)
 
+    def ids(self) -> list[str]:
+        """Get the IDs of the configured devices"""
+
+        return list(self._devices)
+
     def device(self, device_id: str) -> DeviceConfig | None:
         """Get the configuration for the device with the specified ID
 
@@ -1,14 +1,127 @@
-from base64 import b64decode, b64encode
+from base64 import b64encode
+from binascii import a2b_base64, b2a_base64
 
 from Crypto.Cipher import AES
 from Crypto.Hash import MD5
 from Crypto.Random import get_random_bytes
-from Crypto.Util.Padding import pad, unpad
+
+
+class DeviceCipher:
+    """Cipher for the messages of an encrypted device
+
+    The AES key is derived from the device key (MD5) only once, when the
+    cipher is created: reuse the same cipher for all the messages of a
+    device.
+    """
+
+    def __init__(self, device_key: str) -> None:
+        """
+        Parameters
+        ----------
+        `device_key` : str
+            Encryption key for the device
+        """
+
+        dk = bytes(device_key, "utf-8")
+        md5hash = MD5.new()
+        md5hash.update(dk)
+        self._key = md5hash.digest()
+
+    def __repr__(self) -> str:
+        return "DeviceCipher()"  # Never show the key
+
+    def decrypt_bytes(self, data_element: bytes | bytearray | memoryview, iv: bytes | str) -> bytearray:
+        """Decrypt data from the device working on bytes
+
+        The data is decoded from base64 and decrypted into a single buffer,
+        which is unpadded in place: no intermediate strings are created.
+
+        Parameters
+        ----------
+        `data_element` : bytes|bytearray|memoryview
+            Data from the device to decrypt (base64)
+        `iv` : bytes|str
+            IV for the decryption (base64)
+
+        Return
+        ------
+        The decrypted data
+        """
+
+        ciphertext = a2b_base64(data_element)
+        cipher = AES.new(self._key, AES.MODE_CBC, iv=a2b_base64(iv))
+        plaintext = bytearray(len(ciphertext))
+        cipher.decrypt(ciphertext, output=plaintext)
+        padding = plaintext[-1] if plaintext else 0
+        if not 0 < padding <= AES.block_size or plaintext[-padding:] != bytes([padding]) * padding:
+            raise ValueError("Padding is incorrect.")
+        del plaintext[-padding:]
+
+        return plaintext
+
+    def encrypt_bytes(self, data_element: bytes | bytearray | memoryview, iv: bytes | str) -> bytes:
+        """Encrypt data for the device working on bytes
+
+        Parameters
+        ----------
+        `data_element` : bytes|bytearray|memoryview
+            Data for the device to encrypt
+        `iv` : bytes|str
+            IV for the encryption (base64)
+
+        Return
+        ------
+        The encrypted data (base64)
+        """
+
+        padded = bytearray(data_element)
+        padding = AES.block_size - len(padded) % AES.block_size
+        padded.extend(bytes([padding]) * padding)
+        cipher = AES.new(self._key, AES.MODE_CBC, iv=a2b_base64(iv))
+        ciphertext = cipher.encrypt(padded)
+
+        return b2a_base64(ciphertext, newline=False)
+
+    def decrypt(self, data_element: str, iv: str) -> bytes:
+        """Decrypt data from the device
+
+        Parameters
+        ----------
+        `data_element` : str
+            Data from the device to decrypt
+        `iv` : str
+            IV for the decryption
+
+        Return
+        ------
+        The decrypted data
+        """
+
+        return bytes(self.decrypt_bytes(data_element.encode("utf-8"), iv))
+
+    def encrypt(self, data_element: str, iv: str) -> str:
+        """Encrypt data for the device
+
+        Parameters
+        ----------
+        `data_element` : str
+            Data for the device to encrypt
+        `iv` : str
+            IV for the encryption
+
+        Return
+        ------
+        The encrypted data
+        """
+
+        return self.encrypt_bytes(data_element.encode("utf-8"), iv).decode("utf-8")
 
 
 def decrypt(data_element: str, iv: str, device_key: str) -> bytes:
     """Decrypt data from an encrypted device
 
+    Use a DeviceCipher to decrypt many messages from the same device.
+
     Parameters
     ----------
     `data_element` : str
@@ -23,22 +136,14 @@ def decrypt(data_element: str, iv: str, device_key: str) -> bytes:
     The decrypted data
     """
 
-    dk = bytes(device_key, "utf-8")
-    md5hash = MD5.new()
-    md5hash.update(dk)
-    key = md5hash.digest()
-
-    cipher = AES.new(key, AES.MODE_CBC, iv=b64decode(iv))
-    ciphertext = b64decode(data_element)
-    padded = cipher.decrypt(ciphertext)
-    plaintext = unpad(padded, AES.block_size)
-
-    return plaintext
+    return DeviceCipher(device_key).decrypt(data_element, iv)
 
 
 def encrypt(data_element: str, iv: str, device_key: str) -> str:
     """Encrypt data for an encrypted device
 
+    Use a DeviceCipher to encrypt many messages for the same device.
+
     Parameters
     ----------
     `data_element` : str
@@ -53,17 +158,7 @@ def encrypt(data_element: str, iv: str, device_key: str) -> str:
     The encrypted data
     """
 
-    dk = bytes(device_key, "utf-8")
-    md5hash = MD5.new()
-    md5hash.update(dk)
-    key = md5hash.digest()
-
-    cipher = AES.new(key, AES.MODE_CBC, iv=b64decode(iv))
-    padded = pad(bytes(data_element, "utf-8"), AES.block_size)
-    ciphertext = cipher.encrypt(padded)
-    encoded = b64encode(ciphertext)
-
-    return encoded.decode("utf-8")
+    return DeviceCipher(device_key).encrypt(data_element, iv)
 
 
 def generate_iv() -> str:
@@ -0,0 +1,202 @@
+import asyncio
+import json
+import logging
+from concurrent.futures import Executor
+
+from sonofflan.crypto import DeviceCipher
+from sonofflan.errors import InvalidResponseError
+
+DEFAULT_MAX_BATCH = 256
+DATA_FIELDS = (b"data1", b"data2", b"data3", b"data4")
+
+
+def join_payload(properties: dict[bytes, bytes | None]) -> bytes:
+    """Join the data fields of the TXT record announced by a device
+
+    Parameters
+    ----------
+    `properties` : dict
+        Properties of the TXT record
+
+    Return
+    ------
+    The data announced by the device
+    """
+
+    return b"".join([properties.get(x) or b"" for x in DATA_FIELDS])
+
+
+def decode_payload(data: bytes | memoryview, iv: bytes | str | None = None, cipher: DeviceCipher | None = None) -> dict:
+    """Decode the data announced by a device (data1..data4 TXT fields joined)
+
+    The payload stays in bytes from the TXT record to the JSON parser.
+
+    Parameters
+    ----------
+    `data` : bytes|memoryview
+        Data announced by the device
+    `iv` : bytes|str|None
+        IV for the decryption (None if the device is not encrypted)
+    `cipher` : DeviceCipher|None
+        Cipher for the device (None if the device is not encrypted)
+
+    Return
+    ------
+    The decoded data
+    """
+
+    if iv is not None and cipher is not None:
+        data = cipher.decrypt_bytes(data, iv)
+    elif isinstance(data, memoryview):
+        data = data.tobytes()  # The JSON parser doesn't accept memory views
+    return json.loads(data)
+
+
+def decode_info(response: dict, cipher: DeviceCipher | None = None) -> dict:
+    """Decode the response of the /zeroconf/info endpoint of a device
+
+    Parameters
+    ----------
+    `response` : dict
+        The response of the device
+    `cipher` : DeviceCipher|None
+        Cipher for the device (None if the device is not encrypted)
+
+    Return
+    ------
+    The decoded data
+    """
+
+    data = response.get("data")
+    if isinstance(data, dict):
+        return data
+    if not isinstance(data, str):
+        raise InvalidResponseError(f"unexpected info data {data!r}")
+    iv = response.get("iv")
+    if cipher is not None and iv is not None:
+        return decode_payload(data.encode("utf8"), iv, cipher)
+    return decode_payload(data.encode("utf8"))
+
+
+def decode_batch(items: list[tuple[bytes, bytes | str | None, DeviceCipher | None]]) -> list[dict | Exception]:
+    """Decode many payloads (runs in the executor)
+
+    Parameters
+    ----------
+    `items` : list[tuple]
+        Arguments for `decode_payload` for each payload
+
+    Return
+    ------
+    The decoded data, or the exception raised decoding it, for each payload
+    """
+
+    results = []
+    for item in items:
+        try:
+            results.append(decode_payload(*item))
+        except Exception as ex:
+            results.append(ex)
+    return results
+
+
+class BatchDecoder:
+    """Decode announced payloads in batches on an executor
+
+    Payloads are queued and decoded (base64, AES-CBC and JSON) on a thread
+    or process pool, so a discovery storm doesn't block the event loop.
+    The first payload is dispatched immediately: the ones arriving while a
+    batch is being decoded are collected and dispatched together as the
+    next batch.
+
+    Attributes
+    ----------
+    `pending` : int
+        Number of payloads waiting to be decoded
+    `batches` : int
+        Number of batches dispatched to the executor
+    """
+
+    def __init__(self, executor: Executor | None = None, max_batch: int = DEFAULT_MAX_BATCH) -> None:
+        """
+        Parameters
+        ----------
+        `executor` : Executor|None
+            Thread or process pool decoding the payloads (the default executor of the loop if not set)
+        `max_batch` : int
+            Maximum number of payloads in a batch
+        """
+
+        if max_batch < 1:
+            raise ValueError(f"Invalid max_batch {max_batch}: expected a positive number")
+        self._executor = executor
+        self._max_batch = max_batch
+        self._pending = []
+        self._worker = None
+        self._batches = 0
+        self._logger = logging.getLogger("sonofflan.decoder")
+
+    @property
+    def pending(self) -> int:
+        """Number of payloads waiting to be decoded"""
+
+        return len(self._pending)
+
+    @property
+    def batches(self) -> int:
+        """Number of batches dispatched to the executor"""
+
+        return self._batches
+
+    async def decode(self, data: bytes, iv: bytes | str | None = None, cipher: DeviceCipher | None = None) -> dict:
+        """Decode a payload
+
+        Parameters
+        ----------
+        `data` : bytes
+            Data announced by the device
+        `iv` : bytes|str|None
+            IV for the decryption (None if the device is not encrypted)
+        `cipher` : DeviceCipher|None
+            Cipher for the device (None if the device is not encrypted)
+
+        Return
+        ------
+        The decoded data
+        """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((data, iv, cipher), future))
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+        return await future
+
+    async def _run(self) -> None:
+        """Dispatch the pending payloads until there are none"""
+
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            batch = self._pending[:self._max_batch]
+            del self._pending[:self._max_batch]
+            batch = [x for x in batch if not x[1].done()]  # Skip the cancelled ones
+            if not batch:
+                continue
+            self._batches += 1
+            self._logger.debug(f"Decoding batch of {len(batch)} payloads")
+            try:
+                results = await loop.run_in_executor(self._executor, decode_batch, [x[0] for x in batch])
+            except Exception as ex:
+                results = [ex] * len(batch)
+            except asyncio.CancelledError:
+                for _, future in batch + self._pending:
+                    future.cancel()
+                self._pending.clear()
+                raise
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
@@ -1,9 +1,10 @@
 from sonofflan.config import DeviceConfig
-from sonofflan.devices.device import Device
-from sonofflan.devices.plug import Plug
-from sonofflan.devices.strip import Strip
-from sonofflan.devices.powerplug import PowerPlug
-from sonofflan.devices.thermoplug import ThermoPlug
+from sonofflan.devices.command import CommandResult
+from sonofflan.devices.device import Device, DeviceSnapshot
+from sonofflan.devices.plug import Plug, PlugSnapshot
+from sonofflan.devices.strip import Strip, StripSnapshot
+from sonofflan.devices.powerplug import PowerPlug, PowerPlugSnapshot
+from sonofflan.devices.thermoplug import ThermoPlug, ThermoPlugSnapshot
 
 
 def create_device(data: dict, config: DeviceConfig) -> Device:
@@ -0,0 +1,291 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+
+class CommandResult:
+    """Result of a command sent to a device
+
+    Attributes
+    ----------
+    `ok` : bool
+        If the command was accepted by the device
+    `status` : int|None
+        The HTTP status (None if no response was received)
+    `error` : int|None
+        The error code reported by the device (None if not reported)
+    `rtt` : float|None
+        The round-trip time in seconds (None if no response was received)
+    `data` : dict|None
+        The decoded response from the device
+    `exception` : Exception|None
+        The exception that made the command fail
+    """
+
+    def __init__(self, status: int | None = None, error: int | None = None, rtt: float | None = None,
+                 data: dict | None = None, exception: Exception | None = None) -> None:
+        """
+        Parameters
+        ----------
+        `status` : int|None
+            The HTTP status (None if no response was received)
+        `error` : int|None
+            The error code reported by the device (None if not reported)
+        `rtt` : float|None
+            The round-trip time in seconds (None if no response was received)
+        `data` : dict|None
+            The decoded response from the device
+        `exception` : Exception|None
+            The exception that made the command fail
+        """
+
+        self._status = status
+        self._error = error
+        self._rtt = rtt
+        self._data = data
+        self._exception = exception
+
+    def __repr__(self) -> str:
+        rtt = f"{self._rtt * 1000:.1f}ms" if self._rtt is not None else None
+        s = f"CommandResult(ok={self.ok} status={self._status} error={self._error} rtt={rtt}"
+        if self._exception is not None:
+            s += f" exception={self._exception!r}"
+        return s + ")"
+
+    @property
+    def ok(self) -> bool:
+        """If the command was accepted by the device"""
+
+        return self._exception is None and self._status == 200 and not self._error
+
+    @property
+    def status(self) -> int | None:
+        """The HTTP status (None if no response was received)"""
+
+        return self._status
+
+    @property
+    def error(self) -> int | None:
+        """The error code reported by the device (None if not reported)"""
+
+        return self._error
+
+    @property
+    def rtt(self) -> float | None:
+        """The round-trip time in seconds (None if no response was received)"""
+
+        return self._rtt
+
+    @property
+    def data(self) -> dict | None:
+        """The decoded response from the device"""
+
+        return self._data
+
+    @property
+    def exception(self) -> Exception | None:
+        """The exception that made the command fail"""
+
+        return self._exception
+
+
+class _Command:
+    """Command waiting in the queue"""
+
+    def __init__(self, url: str, data: str | dict) -> None:
+        self.url = url
+        self.data = data
+        self.futures = []
+        self.callbacks = []
+
+
+class CommandQueue:
+    """Ordered queue of the commands for a device
+
+    Commands are sent one at a time, in the order they were queued.
+    Commands queued with the same key supersede each other while they are
+    waiting (last write wins): only the latest one is sent, at the position
+    of the latest request, and all the callers get its result.
+    If a merger is set, consecutive waiting commands for the same URL are
+    merged into a single request when the merger can combine their data.
+    A waiting command is withdrawn when all its callers cancel their
+    awaitable (e.g. on a timeout): a command already being sent is
+    completed anyway.
+
+    Attributes
+    ----------
+    `pending` : int
+        Number of commands waiting to be sent
+    `coalesced` : int
+        Number of commands superseded before being sent
+    `merged` : int
+        Number of commands merged into a previous one
+    `withdrawn` : int
+        Number of commands withdrawn before being sent
+    """
+
+    def __init__(self, sender: Callable[[str, str | dict], Awaitable[CommandResult]], name: str = "",
+                 merger: Callable[[str, str | dict, str | dict], str | dict | None] | None = None) -> None:
+        """
+        Parameters
+        ----------
+        `sender` : Callable
+            Coroutine function sending a command (URL and data) to the device
+        `name` : str
+            Name of the queue (used for logging)
+        `merger` : Callable|None
+            Function combining the data of two commands for the same URL
+            (returns None if the commands cannot be merged)
+        """
+
+        self._sender = sender
+        self._merger = merger
+        self._commands = OrderedDict()
+        self._worker = None
+        self._coalesced = 0
+        self._merged = 0
+        self._withdrawn = 0
+        self._logger = logging.getLogger(f"sonofflan.devices.command{'.' if name else ''}{name}")
+
+    @property
+    def pending(self) -> int:
+        """Number of commands waiting to be sent"""
+
+        return len(self._commands)
+
+    @property
+    def coalesced(self) -> int:
+        """Number of commands superseded before being sent"""
+
+        return self._coalesced
+
+    @property
+    def merged(self) -> int:
+        """Number of commands merged into a previous one"""
+
+        return self._merged
+
+    @property
+    def withdrawn(self) -> int:
+        """Number of commands withdrawn before being sent"""
+
+        return self._withdrawn
+
+    def put(self, url: str, data: str | dict, key: str | None = None,
+            on_settled: Callable[[CommandResult | None], None] | None = None) -> asyncio.Future:
+        """Queue a command
+
+        Parameters
+        ----------
+        `url` : str
+            Command URL
+        `data` : str|dict
+            Data for the command
+        `key` : str|None
+            Key of the state changed by the command: a waiting command with
+            the same key is superseded (None to never coalesce)
+        `on_settled` : Callable|None
+            Function called with the result once the command was sent (or
+            with None if it was withdrawn): unlike the returned awaitable,
+            the callers cannot cancel it
+
+        Return
+        ------
+        Awaitable with the CommandResult
+        """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        command = _Command(url, data)
+        if key is None:
+            key = object()  # Unique key
+        elif key in self._commands:
+            superseded = self._commands.pop(key)
+            self._logger.debug(f"Command {superseded.url} {superseded.data} superseded by {url} {data}")
+            command.futures = superseded.futures
+            command.callbacks = superseded.callbacks
+            self._coalesced += 1
+        command.futures.append(future)
+        if on_settled is not None:
+            command.callbacks.append(on_settled)
+        future.add_done_callback(self._withdraw)
+        self._commands[key] = command
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+        return future
+
+    def _withdraw(self, future: asyncio.Future) -> None:
+        """Remove a cancelled caller, withdrawing its command if nobody else waits for it"""
+
+        if not future.cancelled():
+            return
+        for key, command in self._commands.items():
+            if future in command.futures:
+                command.futures.remove(future)
+                if not command.futures:
+                    del self._commands[key]
+                    self._withdrawn += 1
+                    self._logger.debug(f"Command {command.url} {command.data} withdrawn")
+                    self._settle(command, None)
+                return
+
+    def _settle(self, command: _Command, result: CommandResult | None) -> None:
+        """Complete the callers of a command and call its callbacks (None if the command was not sent)"""
+
+        for future in command.futures:
+            if not future.done():
+                if result is not None:
+                    future.set_result(result)
+                else:
+                    future.cancel()
+        for callback in command.callbacks:
+            # noinspection PyBroadException
+            try:
+                callback(result)
+            except Exception:
+                self._logger.error(f"Exception settling command {command.url} {command.data}", exc_info=True)
+
+    def _merge(self, command: _Command) -> None:
+        """Merge the following commands for the same URL into the given one"""
+
+        if self._merger is None:
+            return
+        while self._commands:
+            key, following = next(iter(self._commands.items()))
+            if following.url != command.url:
+                return
+            data = self._merger(command.url, command.data, following.data)
+            if data is None:
+                return
+            del self._commands[key]
+            self._logger.debug(f"Command {following.url} {following.data} merged into {command.data}")
+            command.data = data
+            command.futures += following.futures
+            command.callbacks += following.callbacks
+            self._merged += 1
+
+    async def _run(self) -> None:
+        """Send the queued commands until the queue is empty"""
+
+        while self._commands:
+            _, command = self._commands.popitem(last=False)
+            if all(x.cancelled() for x in command.futures):
+                # Cancelled while this worker was about to send it
+                self._withdrawn += 1
+                self._logger.debug(f"Command {command.url} {command.data} withdrawn")
+                self._settle(command, None)
+                continue
+            self._merge(command)
+            try:
+                result = await self._sender(command.url, command.data)
+            except asyncio.CancelledError:
+                commands = [command, *self._commands.values()]
+                self._commands.clear()
+                for command in commands:
+                    self._settle(command, None)
+                raise
+            except Exception as ex:
+                self._logger.error(f"Cannot send command {command.url} {command.data}", exc_info=True)
+                result = CommandResult(exception=ex)
+            self._settle(command, result)
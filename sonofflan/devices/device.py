@@ -4,11 +4,111 @@ import logging
 import time
 from collections import OrderedDict
 from datetime import datetime
-
-import requests
+from typing import Callable
 
 from sonofflan.config import DeviceConfig
-from sonofflan.crypto import encrypt, generate_iv
+from sonofflan.crypto import DeviceCipher, generate_iv
+from sonofflan.devices.command import CommandQueue, CommandResult
+from sonofflan.errors import CircuitOpenError, CommandError, DeviceOfflineError, PoolTimeoutError
+from sonofflan.retry import CircuitBreaker, RetryPolicy, RttEstimator, default_retry_policy
+from sonofflan.transport import Transport, default_transport
+from sonofflan.utils import base_url
+
+
+class DeviceSnapshot:
+    """Immutable snapshot of the state of a device
+
+    Snapshots hold only the state of the device (no command queue,
+    transport or logger), so they are cheap to create and can be shared by
+    all the consumers of an event.
+
+    Attributes
+    ----------
+    `id` : str
+        The device ID
+    `name` : str
+        The device name (from configuration)
+    `encrypt` : bool
+        If the device is encrypted (not DIY mode)
+    `url` : str
+        The device base URL (used to send commands)
+    `last_update` : datetime
+        The date and time which the device was updated for the last time
+    `verified` : bool
+        If the device state comes from an announcement (not from the registry)
+    `online` : bool
+        If the device is online
+    """
+
+    __slots__ = ("_id", "_name", "_encrypt", "_url", "_last_update", "_verified", "_online")
+
+    def __init__(self, device: "Device") -> None:
+        """
+        Parameters
+        ----------
+        `device` : Device
+            The device to take the snapshot of
+        """
+
+        self._id = device.id
+        self._name = device.name
+        self._encrypt = device.encrypt
+        self._url = device.url
+        self._last_update = device.last_update
+        self._verified = device.verified
+        self._online = device.online
+
+    def _repr(self) -> str:
+        """Internal representation method"""
+
+        return f'"{self._name}" {self._id} url={self._url} encrypt={self._encrypt}'
+
+    def __repr__(self) -> str:
+        """Representation method"""
+
+        return f'{self.__class__.__name__}({self._repr()} updated={self._last_update})'
+
+    @property
+    def id(self) -> str:
+        """The device ID"""
+
+        return self._id
+
+    @property
+    def name(self) -> str:
+        """The device name"""
+
+        return self._name
+
+    @property
+    def encrypt(self) -> bool:
+        """If the device is encrypted (not DIY mode)"""
+
+        return self._encrypt
+
+    @property
+    def url(self) -> str | None:
+        """The device base URL (used to send commands)"""
+
+        return self._url
+
+    @property
+    def last_update(self) -> datetime | None:
+        """The date and time which the device was updated for the last time"""
+
+        return self._last_update
+
+    @property
+    def verified(self) -> bool:
+        """If the device state comes from an announcement (not from the registry)"""
+
+        return self._verified
+
+    @property
+    def online(self) -> bool:
+        """If the device is online"""
+
+        return self._online
 
 
 class Device:
@@ -24,10 +124,35 @@ class Device:
         If the device is encrypted (not DIY mode)
     `key` : str
         The device encryption key (from configuration)
+    `cipher` : DeviceCipher|None
+        The cipher for the device messages (from configuration)
+    `optimistic` : bool
+        If commands update the status immediately (from configuration)
     `url` : str
         The device base URL (used to send commands)
+    `urls` : list[str]
+        The base URLs for all the addresses of the device
     `last_update` : datetime
         The date and time which the device was updated for the last time
+    `verified` : bool
+        If the device state comes from an announcement (False if loaded
+        from the registry and not announced yet)
+    `online` : bool
+        If the device is online (commands to offline devices fail immediately)
+    `pending_commands` : int
+        Number of commands waiting to be sent
+    `transport` : Transport
+        The HTTP transport used to send commands
+    `retry` : RetryPolicy
+        The policy for retrying commands that got no response
+    `circuit_breaker` : CircuitBreaker
+        The circuit breaker failing commands fast when the device is not responding
+    `srtt` : float|None
+        The smoothed round-trip time in seconds
+    `rttvar` : float|None
+        The round-trip time variation in seconds
+    `timeout` : float
+        The timeout in seconds for the next request
     """
 
     def __init__(self, data: dict, config: DeviceConfig) -> None:
@@ -44,9 +169,20 @@ class Device:
         self._name = config.name
         self._encrypt = data['encrypt']
         self._key = config.key
+        self._cipher = config.cipher
+        self._optimistic = config.optimistic
         self._url = None
+        self._urls = []
+        self._raced = False
         self._last_update = None
+        self._verified = True
+        self._online = True
+        self._transport = None
+        self._retry = None
+        self._circuit_breaker = CircuitBreaker()
+        self._rtt = RttEstimator()
         self._logger = logging.getLogger(f"sonofflan.devices.{self.__class__.__name__}")
+        self._queue = CommandQueue(self._async_send, self._id, self._merge)
 
         self._update(data)
 
@@ -60,8 +196,20 @@ class Device:
         """
 
         self._encrypt = data['encrypt']
-        self._url = f"http://{data['address']}:{data['port']}"
+        urls = [base_url(x, data['port']) for x in data.get('addresses') or [data['address']]]
+        if urls != self._urls:
+            if self._urls:
+                self._logger.debug(f"Addresses of {self} changed to {urls}")
+            for url in self._urls:
+                if url not in urls:
+                    self.transport.evict(url)
+            self._urls = urls
+            self._raced = False
+        if self._url not in urls:
+            self._url = urls[0]  # Keep the address that answered first if still announced
         self._last_update = datetime.utcnow()
+        self._verified = data.get("verified", True)
+        self._online = True
 
     def update(self, data: dict) -> None:
         """Update the device with data from Zeroconf
@@ -78,6 +226,11 @@ class Device:
             return
         self._update(data)
 
+    def snapshot(self) -> DeviceSnapshot:
+        """Take an immutable snapshot of the device state"""
+
+        return DeviceSnapshot(self)
+
     def _repr(self) -> str:
         """Internal representation method"""
 
@@ -88,55 +241,186 @@ class Device:
 
         return f'{self.__class__.__name__}({self._repr()} updated={self._last_update})'
 
-    def _send(self, url: str, data: str | dict) -> None:
+    def _send(self, url: str, data: str | dict, key: str | None = None,
+              on_settled: Callable[[CommandResult | None], None] | None = None) -> asyncio.Future:
         """Internal send command method
 
+        The command is queued and sent in background, after the commands
+        already queued for the device: the returned awaitable can be awaited
+        to get the CommandResult, or ignored.
+
         Parameters
         ----------
         `url` : str
             Command URL
         `data` : str|dict
             Data for the command
+        `key` : str|None
+            Key of the state changed by the command: a queued command with
+            the same key is superseded by this one (None to never coalesce)
+        `on_settled` : Callable|None
+            Function called with the result once the command was sent (or
+            with None if it was never sent), even if the caller cancelled
+            the awaitable
         """
 
-        asyncio.get_running_loop().create_task(
-            self._async_send(url, data)
-        )
+        return self._queue.put(url, data, key, on_settled)
+
+    def _merge(self, url: str, data: str | dict, other: str | dict) -> str | dict | None:
+        """Internal method merging two queued commands for the same URL
+
+        Devices don't merge commands: subclasses can override it.
 
-    async def _async_send(self, url: str, data: str | dict) -> None:
+        Parameters
+        ----------
+        `url` : str
+            Command URL
+        `data` : str|dict
+            Data for the first command
+        `other` : str|dict
+            Data for the following command
+
+        Return
+        ------
+        The data for a single command with the effects of both (None if not possible)
+        """
+
+        return None
+
+    def _failed(self, reason: str) -> asyncio.Future:
+        """Internal method returning a command already failed
+
+        Parameters
+        ----------
+        `reason` : str
+            Reason of the failure
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(CommandResult(exception=CommandError(self._id, reason)))
+        return future
+
+    async def _async_send(self, url: str, data: str | dict) -> CommandResult:
         """Internal asynchronous send command method
 
+        Commands that get no response (or an HTTP server error) are retried
+        following the retry policy. While the circuit breaker is open the
+        command fails immediately.
+
         Parameters
         ----------
         `url` : str
             Command URL
         `data` : str|dict
             Data for the command
+
+        Return
+        ------
+        The result of the command
         """
 
         if self._url is None:
             self._logger.error(f"Cannot send commands to {self}: url not valid")
-            return
+            return CommandResult(exception=CommandError(self._id, "url not valid"))
+        if not self._online:
+            self._logger.warning(f"Cannot send commands to {self}: device is offline")
+            return CommandResult(exception=DeviceOfflineError(self._id))
+        if not self._circuit_breaker.allow():
+            self._logger.warning(f"Cannot send commands to {self}: circuit breaker is open")
+            return CommandResult(exception=CircuitOpenError(self._id))
 
         if type(data) == dict:
             data = json.dumps(data, separators=(",", ":"), indent=None)
+        retry = self.retry
+        attempt = 0
+        try:
+            while True:
+                attempt += 1
+                result = await self._post(url, data)  # type: ignore
+                if isinstance(result.exception, PoolTimeoutError):
+                    self._circuit_breaker.abort()  # The transport is saturated: says nothing about the device
+                    break
+                if result.status is not None and result.status < 500:
+                    self._circuit_breaker.record_success()  # The device is alive, even if it reported an error
+                    break
+                if attempt >= retry.attempts:
+                    self._circuit_breaker.record_failure()
+                    break
+                delay = retry.delay(attempt)
+                self._logger.debug(f"Retrying {url} for {self} in {delay:.3f}s (attempt {attempt}: {result})")
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self._circuit_breaker.abort()
+            raise
+        if result.exception is not None:
+            self._logger.error(f"Command {url} for {self} failed after {attempt} attempts: {result.exception!r}")
+        return result
+
+    async def info(self) -> CommandResult:
+        """Query the state of the device (/zeroconf/info)
+
+        The request is sent immediately, bypassing the command queue, the
+        circuit breaker and the offline check: it's used to check devices
+        that are not announcing themselves.
+
+        Return
+        ------
+        The result of the request (with the response of the device in `data`)
+        """
+
+        if self._url is None:
+            return CommandResult(exception=CommandError(self._id, "url not valid"))
+        return await self._post("/zeroconf/info", "{}")
+
+    async def _race(self, timeout: float) -> None:
+        """Internal method choosing the address of the device that connects first
+
+        The winner is used for the following requests, until a request
+        fails or the addresses change. Raises the connection error if no
+        address could be reached.
+
+        Parameters
+        ----------
+        `timeout` : float
+            Timeout in seconds
+        """
+
+        self._url = await self.transport.connect_any(self._urls, timeout=timeout)
+        self._raced = True
+        self._logger.debug(f"Using {self._url} for {self}")
+
+    async def _post(self, url: str, data: str) -> CommandResult:
+        """Internal method sending a single request for a command
+
+        Parameters
+        ----------
+        `url` : str
+            Command URL
+        `data` : str
+            Data for the command (JSON)
+
+        Return
+        ------
+        The result of the request
+        """
+
         self._logger.debug(f'Sending to "{self._url}{url}" data "{data}"')
         payload = {
             "sequence": str(int(time.time() * 1000)),
             "deviceid": self._id,
             "encrypt": self._encrypt,
         }
-        if self._encrypt and self._key is not None:
+        if self._encrypt and self._cipher is not None:
             payload["selfApikey"] = "123"
             iv = generate_iv()
             payload["iv"] = iv
-            data = encrypt(data, iv, self._key)  # type: ignore
+            data = self._cipher.encrypt_bytes(data.encode("utf-8"), iv).decode("ascii")
         payload["data"] = data
 
         headers = OrderedDict(
             {
                 "Content-Type": "application/json;charset=UTF-8",
-                # "Connection": "keep-alive",
+                "Connection": "keep-alive",
                 "Accept": "application/json",
                 "Accept-Language": "en-gb",
                 # "Content-Length": "0",
@@ -145,23 +429,47 @@ class Device:
             }
         )
         payload = json.dumps(payload, separators=(",", ":"), indent=None)
+        timeout = self._rtt.timeout
+        start = time.monotonic()
         # noinspection PyBroadException
         try:
-            response = requests.post(f"{self._url}{url}", headers=headers, data=payload)
-        except Exception:
-            self._logger.error(f"Cannot send request to {self._url}{url}", exc_info=True)
-            return
+            if len(self._urls) > 1 and not self._raced:
+                await self._race(timeout)
+                timeout = max(0.0, timeout - (time.monotonic() - start))  # The race and the request share the timeout
+            response = await self.transport.post(
+                f"{self._url}{url}", headers=headers, data=payload, timeout=timeout
+            )
+        except PoolTimeoutError as ex:
+            self._logger.warning(f"No free connection for {self}: {ex}")
+            return CommandResult(exception=ex)
+        except asyncio.TimeoutError as ex:
+            self._logger.debug(f"Request to {self._url}{url} timed out after {self._rtt.timeout:.3f}s")
+            self._rtt.backoff()
+            self._raced = False  # Race the addresses again on the next attempt
+            return CommandResult(exception=ex)
+        except Exception as ex:
+            self._logger.debug(f"Cannot send request to {self._url}{url}", exc_info=True)
+            self._raced = False
+            return CommandResult(exception=ex)
+        # Measured by the transport once the connection was available, excluding the wait for a free slot
+        rtt = response.elapsed if response.elapsed is not None else time.monotonic() - start
+        self._rtt.sample(rtt)
+        error = None
+        response_json = None
         # noinspection PyBroadException
         try:
-            if response.status_code != 200:
-                raise RuntimeError(f"Got HTTP status {response.code}")  # type: ignore
-            response_json = json.loads(response.content.decode("utf-8"))
-            self._logger.debug(f'Got response {response.status_code} {json.dumps(response_json, indent=2)}')
-            if "error" in response_json and response_json["error"] != 0:
-                raise RuntimeError(f'Get error {response_json["error"]}')
+            if response.status != 200:
+                raise CommandError(self._id, f"got HTTP status {response.status}")
+            response_json = response.json()
+            self._logger.debug(f'Got response {response.status} {json.dumps(response_json, indent=2)}')
+            error = response_json.get("error")
+            if error is not None and error != 0:
+                raise CommandError(self._id, f"got error {error}")
             self._logger.debug(f'Message sent to {self} successfully!')
-        except Exception:
-            self._logger.error(f"Error processing response {response}: {response.content}", exc_info=True)
+        except Exception as ex:
+            self._logger.debug(f"Error processing response {response}: {response.content}", exc_info=True)
+            return CommandResult(response.status, error, rtt, response_json, ex)
+        return CommandResult(response.status, error, rtt, response_json)
 
     @property
     def id(self) -> str:
@@ -187,14 +495,116 @@ class Device:
 
         return self._key
 
+    @property
+    def cipher(self) -> DeviceCipher | None:
+        """The cipher for the device messages (from configuration)"""
+
+        return self._cipher
+
+    @property
+    def optimistic(self) -> bool:
+        """If commands update the status immediately (rolled back if they fail)"""
+
+        return self._optimistic
+
+    @optimistic.setter
+    def optimistic(self, optimistic: bool) -> None:
+        self._optimistic = optimistic
+
     @property
     def url(self) -> str | None:
         """The device base URL (used to send commands)"""
 
         return self._url
 
+    @property
+    def urls(self) -> list[str]:
+        """The base URLs for all the addresses of the device"""
+
+        return list(self._urls)
+
     @property
     def last_update(self) -> datetime | None:
         """The date and time which the device was updated for the last time"""
 
         return self._last_update
+
+    @property
+    def verified(self) -> bool:
+        """If the device state comes from an announcement (False if loaded from the registry)"""
+
+        return self._verified
+
+    @property
+    def online(self) -> bool:
+        """If the device is online (set offline when removed or not announced for a while)"""
+
+        return self._online
+
+    @online.setter
+    def online(self, online: bool) -> None:
+        self._online = online
+
+    @property
+    def pending_commands(self) -> int:
+        """Number of commands waiting to be sent"""
+
+        return self._queue.pending
+
+    @property
+    def transport(self) -> Transport:
+        """The HTTP transport used to send commands (the shared one if not set)"""
+
+        return self._transport if self._transport is not None else default_transport()
+
+    @transport.setter
+    def transport(self, transport: Transport | None) -> None:
+        self._transport = transport
+
+    @property
+    def retry(self) -> RetryPolicy:
+        """The policy for retrying commands (the shared one if not set)"""
+
+        return self._retry if self._retry is not None else default_retry_policy()
+
+    @retry.setter
+    def retry(self, retry: RetryPolicy | None) -> None:
+        self._retry = retry
+
+    @property
+    def srtt(self) -> float | None:
+        """The smoothed round-trip time in seconds (None until the first response)"""
+
+        return self._rtt.srtt
+
+    @property
+    def rttvar(self) -> float | None:
+        """The round-trip time variation in seconds (None until the first response)"""
+
+        return self._rtt.rttvar
+
+    @property
+    def timeout(self) -> float:
+        """The timeout in seconds for the next request (derived from the round-trip times)"""
+
+        return self._rtt.timeout
+
+    @property
+    def rtt_estimator(self) -> RttEstimator:
+        """The round-trip time estimator of the device"""
+
+        return self._rtt
+
+    @rtt_estimator.setter
+    def rtt_estimator(self, rtt_estimator: RttEstimator) -> None:
+        self._rtt = rtt_estimator
+
+    @property
+    def circuit_breaker(self) -> CircuitBreaker:
+        """The circuit breaker of the device"""
+
+        return self._circuit_breaker
+
+    @circuit_breaker.setter
+    def circuit_breaker(self, circuit_breaker: CircuitBreaker) -> None:
+        self._circuit_breaker = circuit_breaker
@@ -1,8 +1,55 @@
+import asyncio
+from functools import partial
+
 from sonofflan.config import DeviceConfig
-from sonofflan.devices.device import Device
+from sonofflan.devices.command import CommandResult
+from sonofflan.devices.device import Device, DeviceSnapshot
 from sonofflan.errors import MissingSwitchesError
 
 
+class PlugSnapshot(DeviceSnapshot):
+    """Immutable snapshot of the state of a plug
+
+    Attributes
+    ----------
+    `status` : bool
+        The status of the plug
+    `pending` : bool
+        If the status was set optimistically and is not confirmed yet
+    """
+
+    __slots__ = ("_status", "_pending")
+
+    def __init__(self, device: "Plug") -> None:
+        """
+        Parameters
+        ----------
+        `device` : Plug
+            The plug to take the snapshot of
+        """
+
+        super().__init__(device)
+        self._status = device.status
+        self._pending = device.pending
+
+    def _repr(self) -> str:
+        """Internal representation method"""
+
+        return super()._repr() + f" status:{self._status}"
+
+    @property
+    def status(self) -> bool | None:
+        """The status of the plug (on or off)"""
+
+        return self._status
+
+    @property
+    def pending(self) -> bool:
+        """If the status was set optimistically and is not confirmed yet"""
+
+        return self._pending
+
+
 class Plug(Device):
     """Sonoff device with a status (a plug)
 
@@ -10,6 +57,10 @@ class Plug(Device):
     ----------
     `status` : bool
         The status of the plug
+    `announced_status` : bool
+        The status last announced by the device (differs from `status` while an optimistic command is pending)
+    `pending` : bool
+        If the status was set optimistically and is not confirmed yet
     """
 
     def __init__(self, data: dict, config: DeviceConfig) -> None:
@@ -23,6 +74,9 @@ class Plug(Device):
         """
 
         self._status = None
+        self._confirmed_status = None
+        self._announced_status = None
+        self._pending = None
         self._outlet = None
         super().__init__(data, config)
 
@@ -37,7 +91,7 @@ class Plug(Device):
 
         super()._update(data)
         if "switch" in data['data']:
-            self._status = (data['data']['switch'] == 'on')
+            status = (data['data']['switch'] == 'on')
         elif "switches" in data['data']:
             if len(data['data']['switches']) == 0:
                 raise MissingSwitchesError(self.id, data["type"])
@@ -46,9 +100,20 @@ class Plug(Device):
                     f'Too much switches in device "{self.id}" ({data["type"]}): using only the first one'
                 )
             self._outlet = data['data']['switches'][0]['outlet']
-            self._status = (data['data']['switches'][0]['switch'] == 'on')
+            status = (data['data']['switches'][0]['switch'] == 'on')
         else:
             raise MissingSwitchesError(self.id, data["type"])
+        self._confirmed_status = status
+        self._announced_status = status
+        if self._pending is None:
+            self._status = status
+        elif status == self._status:
+            self._pending = None  # Optimistic status confirmed by the device
+
+    def snapshot(self) -> PlugSnapshot:
+        """Take an immutable snapshot of the plug state"""
+
+        return PlugSnapshot(self)
 
     def _repr(self) -> str:
         """Internal representation method"""
@@ -61,38 +126,113 @@ class Plug(Device):
 
         return self._status
 
-    def on(self) -> None:
-        """Turn on the plug"""
+    @property
+    def announced_status(self) -> bool | None:
+        """The status last announced by the device"""
 
-        self._logger.debug(f"Turn ON {self}")
+        return self._announced_status
+
+    @property
+    def pending(self) -> bool:
+        """If the status was set optimistically and is not confirmed yet"""
+
+        return self._pending is not None
+
+    def _switch(self, status: bool) -> asyncio.Future:
+        """Internal method sending the switch command
+
+        In optimistic mode the status is set immediately and rolled back if
+        the command fails or is never sent. Cancelling the returned
+        awaitable doesn't roll it back if the command is sent anyway.
+
+        Parameters
+        ----------
+        `status` : bool
+            Status to set (on or off)
+        """
+
+        switch = "on" if status else "off"
+        on_settled = None
+        if self._optimistic:
+            pending = object()
+            self._pending = pending
+            self._status = status
+            on_settled = partial(self._settle, pending)
         if self._outlet is None:
-            self._send("/zeroconf/switch", {"switch": "on"})
+            return self._send("/zeroconf/switch", {"switch": switch}, key="switch", on_settled=on_settled)
+        return self._send(
+            "/zeroconf/switches",
+            {"switches": [{"switch": switch, "outlet": self._outlet}], "operSide": 1},
+            key="switch",
+            on_settled=on_settled
+        )
+
+    def _settle(self, pending: object, result: CommandResult | None) -> None:
+        """Internal method completing an optimistic command
+
+        Parameters
+        ----------
+        `pending` : object
+            Marker of the optimistic command
+        `result` : CommandResult|None
+            The result of the command (None if it was never sent)
+        """
+
+        if self._pending is not pending:
+            return  # Already confirmed or superseded by a newer command
+        self._pending = None
+        if result is None or not result.ok:
+            self._logger.debug(f"Command failed: rolling back {self} to {self._confirmed_status}")
+            self._status = self._confirmed_status
         else:
-            self._send("/zeroconf/switches", {"switches": [{"switch": "on", "outlet": self._outlet}], "operSide": 1 })
+            self._confirmed_status = self._status  # Accepted by the device
+
+    def on(self) -> asyncio.Future:
+        """Turn on the plug
+
+        Return
+        ------
+        Awaitable with the CommandResult
+        """
+
+        self._logger.debug(f"Turn ON {self}")
+        return self._switch(True)
 
-    def off(self) -> None:
-        """Turn off the plug"""
+    def off(self) -> asyncio.Future:
+        """Turn off the plug
+
+        Return
+        ------
+        Awaitable with the CommandResult
+        """
 
         self._logger.debug(f"Turn OFF {self}")
-        if self._outlet is None:
-            self._send("/zeroconf/switch", {"switch": "off"})
-        else:
-            self._send("/zeroconf/switches", {"switches": [{"switch": "off", "outlet": self._outlet}], "operSide": 1})
+        return self._switch(False)
 
-    def toggle(self) -> None:
-        """Toggle the device status"""
+    def toggle(self) -> asyncio.Future:
+        """Toggle the device status
+
+        Return
+        ------
+        Awaitable with the CommandResult
+        """
 
         self._logger.debug(f"Toggle {self}")
         if self._status:
-            self.off()
+            return self.off()
         else:
-            self.on()
+            return self.on()
+
+    def refresh(self) -> asyncio.Future:
+        """Refresh the device status (send the same status currently set)
 
-    def refresh(self) -> None:
-        """Refresh the device status (send the same status currently set)"""
+        Return
+        ------
+        Awaitable with the CommandResult
+        """
 
         self._logger.debug(f"Refresh {self}")
         if self._status:
-            self.on()
+            return self.on()
         else:
-            self.off()
+            return self.off()
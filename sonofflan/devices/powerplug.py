@@ -1,5 +1,5 @@
 from sonofflan.config import DeviceConfig
-from sonofflan.devices.plug import Plug
+from sonofflan.devices.plug import Plug, PlugSnapshot
 
 
 def _parse_data(value: str | int | float) -> float:
@@ -15,6 +15,55 @@ def _parse_data(value: str | int | float) -> float:
     return 0
 
 
+class PowerPlugSnapshot(PlugSnapshot):
+    """Immutable snapshot of the state of a plug with power meter
+
+    Attributes
+    ----------
+    `voltage` : float
+        The measured voltage
+    `current` : float
+        The measured current
+    `power` : float
+        The measured power
+    """
+
+    __slots__ = ("_voltage", "_current", "_power")
+
+    def __init__(self, device: "PowerPlug") -> None:
+        """
+        Parameters
+        ----------
+        `device` : PowerPlug
+            The plug to take the snapshot of
+        """
+
+        super().__init__(device)
+        self._voltage = device.voltage
+        self._current = device.current
+        self._power = device.power
+
+    def _repr(self) -> str:
+        """Internal representation method"""
+
+        return super()._repr() + f" V:{self._voltage}V C:{self._current}A P:{self._power}W"
+
+    @property
+    def voltage(self) -> float | None:
+        """The measured voltage"""
+        return self._voltage
+
+    @property
+    def current(self) -> float | None:
+        """The measured current"""
+        return self._current
+
+    @property
+    def power(self) -> float | None:
+        """The measured power"""
+        return self._power
+
+
 class PowerPlug(Plug):
     """Sonoff plug with power meter
 
@@ -61,6 +110,11 @@ class PowerPlug(Plug):
             self._current /= 100.0
             self._power /= 100.0
 
+    def snapshot(self) -> PowerPlugSnapshot:
+        """Take an immutable snapshot of the plug state"""
+
+        return PowerPlugSnapshot(self)
+
     def _repr(self) -> str:
         """Internal representation method"""
 
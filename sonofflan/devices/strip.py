@@ -1,5 +1,66 @@
+import asyncio
+from functools import partial
+
 from sonofflan.config import DeviceConfig
-from sonofflan.devices.device import Device
+from sonofflan.devices.command import CommandResult
+from sonofflan.devices.device import Device, DeviceSnapshot
+
+
+class StripSnapshot(DeviceSnapshot):
+    """Immutable snapshot of the state of a plug stripe
+
+    Attributes
+    ----------
+    `outlets` : list[int]
+        Available outlets
+    `pending_outlets` : list[int]
+        Outlets with a status set optimistically and not confirmed yet
+    """
+
+    __slots__ = ("_statuses", "_pending")
+
+    def __init__(self, device: "Strip") -> None:
+        """
+        Parameters
+        ----------
+        `device` : Strip
+            The plug stripe to take the snapshot of
+        """
+
+        super().__init__(device)
+        self._statuses = tuple((x, device.status(x)) for x in device.outlets)
+        self._pending = tuple(device.pending_outlets)
+
+    def _repr(self) -> str:
+        """Internal representation method"""
+
+        return super()._repr() + f" status:{dict(self._statuses)}"
+
+    @property
+    def outlets(self) -> list[int]:
+        """Available outlets"""
+
+        return [x for x, _ in self._statuses]
+
+    @property
+    def pending_outlets(self) -> list[int]:
+        """Outlets with a status set optimistically and not confirmed yet"""
+
+        return list(self._pending)
+
+    def status(self, outlet: int) -> bool:
+        """The status of the given outlet (on or off)
+
+        Parameters
+        ----------
+        `outlet` : int
+            Outlet ID
+        """
+
+        for x, status in self._statuses:
+            if x == outlet:
+                return status
+        raise ValueError(f"{self} doesn't have outlet {outlet}")
 
 
 class Strip(Device):
@@ -9,6 +70,8 @@ class Strip(Device):
     ----------
     `outlets` : list[int]
         Available outlets
+    `pending_outlets` : list[int]
+        Outlets with a status set optimistically and not confirmed yet
     """
 
     def __init__(self, data: dict, config: DeviceConfig) -> None:
@@ -22,6 +85,9 @@ class Strip(Device):
         """
 
         self._statuses = {}
+        self._confirmed_statuses = {}
+        self._announced_statuses = {}
+        self._pending = {}
         super().__init__(data, config)
 
     def _update(self, data: dict) -> None:
@@ -35,13 +101,101 @@ class Strip(Device):
 
         super()._update(data)
         for switch in data['data']["switches"]:
-            self._statuses[switch['outlet']] = (switch['switch'] == 'on')
+            outlet = switch['outlet']
+            status = (switch['switch'] == 'on')
+            self._confirmed_statuses[outlet] = status
+            self._announced_statuses[outlet] = status
+            if outlet not in self._pending:
+                self._statuses[outlet] = status
+            elif status == self._statuses[outlet]:
+                del self._pending[outlet]  # Optimistic status confirmed by the device
+
+    def snapshot(self) -> StripSnapshot:
+        """Take an immutable snapshot of the plug stripe state"""
+
+        return StripSnapshot(self)
 
     def _repr(self) -> str:
         """Internal representation method"""
 
         return super()._repr() + f" status:{self._statuses}"
 
+    def _merge(self, url: str, data: str | dict, other: str | dict) -> str | dict | None:
+        """Internal method merging two queued commands for the same URL
+
+        Consecutive switches commands are merged into a single one: when
+        both change the same outlet, the following command wins.
+
+        Parameters
+        ----------
+        `url` : str
+            Command URL
+        `data` : str|dict
+            Data for the first command
+        `other` : str|dict
+            Data for the following command
+
+        Return
+        ------
+        The data for a single command with the effects of both (None if not possible)
+        """
+
+        if url != "/zeroconf/switches" or not isinstance(data, dict) or not isinstance(other, dict):
+            return None
+        if data.keys() != {"switches"} or other.keys() != {"switches"}:
+            return None
+        switches = {x["outlet"]: x["switch"] for x in data["switches"]}
+        switches.update({x["outlet"]: x["switch"] for x in other["switches"]})
+        return {"switches": [{"switch": switches[x], "outlet": x} for x in switches]}
+
+    def _switch(self, statuses: dict[int, bool]) -> asyncio.Future:
+        """Internal method sending the switches command
+
+        In optimistic mode the statuses are set immediately and rolled back
+        if the command fails or is never sent. Cancelling the returned
+        awaitable doesn't roll them back if the command is sent anyway.
+
+        Parameters
+        ----------
+        `statuses` : dict[int, bool]
+            Status to set (on or off) for each outlet ID
+        """
+
+        on_settled = None
+        if self._optimistic:
+            pending = object()
+            for outlet in statuses:
+                self._pending[outlet] = pending
+                self._statuses[outlet] = statuses[outlet]
+            on_settled = partial(self._settle, pending)
+        return self._send(
+            "/zeroconf/switches",
+            {"switches": [{"switch": "on" if statuses[x] else "off", "outlet": x} for x in statuses]},
+            key=f"switch:{next(iter(statuses))}" if len(statuses) == 1 else None,
+            on_settled=on_settled
+        )
+
+    def _settle(self, pending: object, result: CommandResult | None) -> None:
+        """Internal method completing an optimistic command
+
+        Parameters
+        ----------
+        `pending` : object
+            Marker of the optimistic command
+        `result` : CommandResult|None
+            The result of the command (None if it was never sent)
+        """
+
+        failed = result is None or not result.ok
+        for outlet in [x for x in self._pending if self._pending[x] is pending]:
+            # Outlets already confirmed or superseded by a newer command are not affected
+            del self._pending[outlet]
+            if failed:
+                self._statuses[outlet] = self._confirmed_statuses[outlet]
+                self._logger.debug(f"Command failed: rolled back {self} {outlet}")
+            else:
+                self._confirmed_statuses[outlet] = self._statuses[outlet]  # Accepted by the device
+
     def _check_outlet(self, outlet: int) -> None:
         """Check if the outlet is available"""
 
@@ -54,6 +208,12 @@ class Strip(Device):
 
         return [x for x in self._statuses]
 
+    @property
+    def pending_outlets(self) -> list[int]:
+        """Outlets with a status set optimistically and not confirmed yet"""
+
+        return [x for x in self._pending]
+
     def status(self, outlet: int) -> bool:
         """The status of the given outlet (on or off)
 
@@ -66,60 +226,132 @@ class Strip(Device):
         self._check_outlet(outlet)
         return self._statuses[outlet]
 
-    def on(self, outlet: int) -> None:
+    def announced_status(self, outlet: int) -> bool:
+        """The status of the given outlet last announced by the device
+
+        It differs from `status` while an optimistic command is pending.
+
+        Parameters
+        ----------
+        `outlet` : int
+            Outlet ID
+        """
+
+        self._check_outlet(outlet)
+        return self._announced_statuses[outlet]
+
+    def on(self, outlet: int) -> asyncio.Future:
         """Turn on the given outlet
 
         Parameters
         ----------
         `outlet` : int
             Outlet ID
+
+        Return
+        ------
+        Awaitable with the CommandResult
         """
 
         self._check_outlet(outlet)
         self._logger.debug(f"Turn ON {self} {outlet}")
-        self._send("/zeroconf/switches", {"switches": [{"switch": "on", "outlet": outlet}]})
+        return self._switch({outlet: True})
 
-    def off(self, outlet: int) -> None:
+    def off(self, outlet: int) -> asyncio.Future:
         """Turn off the given outlet
 
         Parameters
         ----------
         `outlet` : int
             Outlet ID
+
+        Return
+        ------
+        Awaitable with the CommandResult
         """
 
         self._check_outlet(outlet)
         self._logger.debug(f"Turn OFF {self} {outlet}")
-        self._send("/zeroconf/switches", {"switches": [{"switch": "off", "outlet": outlet}]})
+        return self._switch({outlet: False})
+
+    def set_outlets(self, statuses: dict[int, bool]) -> asyncio.Future:
+        """Set the status of multiple outlets with a single command
+
+        Parameters
+        ----------
+        `statuses` : dict[int, bool]
+            Status to set (on or off) for each outlet ID
+
+        Return
+        ------
+        Awaitable with the CommandResult
+        """
 
-    def toggle(self, outlet: int) -> None:
+        if len(statuses) == 0:
+            raise ValueError(f"No outlets to set for {self}")
+        for outlet in statuses:
+            self._check_outlet(outlet)
+        self._logger.debug(f"Set {self} {statuses}")
+        return self._switch(statuses)
+
+    def all_on(self) -> asyncio.Future:
+        """Turn on all the outlets
+
+        Return
+        ------
+        Awaitable with the CommandResult
+        """
+
+        self._logger.debug(f"Turn ON {self} all")
+        return self._switch({x: True for x in self._statuses})
+
+    def all_off(self) -> asyncio.Future:
+        """Turn off all the outlets
+
+        Return
+        ------
+        Awaitable with the CommandResult
+        """
+
+        self._logger.debug(f"Turn OFF {self} all")
+        return self._switch({x: False for x in self._statuses})
+
+    def toggle(self, outlet: int) -> asyncio.Future:
         """Toggle the given outlet status
 
         Parameters
         ----------
         `outlet` : int
             Outlet ID
+
+        Return
+        ------
+        Awaitable with the CommandResult
         """
 
         self._check_outlet(outlet)
         self._logger.debug(f"Toggle {self} {outlet}")
         if self._statuses[outlet]:
-            self.off(outlet)
+            return self.off(outlet)
         else:
-            self.on(outlet)
+            return self.on(outlet)
 
-    def refresh(self, outlet: int) -> None:
+    def refresh(self, outlet: int) -> asyncio.Future:
         """Refresh the given outlet status (send the same status currently set)
 
         Parameters
         ----------
         `outlet` : int
             Outlet ID
+
+        Return
+        ------
+        Awaitable with the CommandResult
         """
 
         self._check_outlet(outlet)
         self._logger.debug(f"Refresh {self} {outlet}")
         if self._statuses[outlet]:
-            self.on(outlet)
+            return self.on(outlet)
         else:
-            self.off(outlet)
+            return self.off(outlet)
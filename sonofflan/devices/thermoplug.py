@@ -1,5 +1,64 @@
+import asyncio
+
 from sonofflan.config import DeviceConfig
-from sonofflan.devices.plug import Plug
+from sonofflan.devices.plug import Plug, PlugSnapshot
+
+
+class ThermoPlugSnapshot(PlugSnapshot):
+    """Immutable snapshot of the state of a plug with thermometer
+
+    Attributes
+    ----------
+    `sensor` : str
+        The reported sensor type
+    `mode` : str
+        The working mode ("normal" or automatic based on "temperature" or "humidity")
+    `temperature` : float
+        The measured temperature
+    `humidity` : int
+        The measured humidity
+    """
+
+    __slots__ = ("_sensor", "_mode", "_temperature", "_humidity")
+
+    def __init__(self, device: "ThermoPlug") -> None:
+        """
+        Parameters
+        ----------
+        `device` : ThermoPlug
+            The plug to take the snapshot of
+        """
+
+        super().__init__(device)
+        self._sensor = device.sensor
+        self._mode = device.mode
+        self._temperature = device.temperature
+        self._humidity = device.humidity
+
+    def _repr(self) -> str:
+        """Internal representation method"""
+
+        return super()._repr() + f" sensor:{self._sensor} T:{self._temperature}° H:{self._humidity}%"
+
+    @property
+    def sensor(self) -> str | None:
+        """The reported sensor type"""
+        return self._sensor
+
+    @property
+    def mode(self) -> str | None:
+        """The working mode"""
+        return self._mode
+
+    @property
+    def temperature(self) -> float | None:
+        """The measured temperature"""
+        return self._temperature
+
+    @property
+    def humidity(self) -> int | None:
+        """The measured humidity"""
+        return self._humidity
 
 
 class ThermoPlug(Plug):
@@ -48,6 +107,11 @@ class ThermoPlug(Plug):
         self._temperature = float(data['data']['currentTemperature'])
         self._humidity = int(data['data']['currentHumidity'])
 
+    def snapshot(self) -> ThermoPlugSnapshot:
+        """Take an immutable snapshot of the plug state"""
+
+        return ThermoPlugSnapshot(self)
+
     def _repr(self) -> str:
         """Internal representation method"""
 
@@ -73,38 +137,38 @@ class ThermoPlug(Plug):
         """The measured humidity"""
         return self._humidity
 
-    def on(self) -> None:
+    def on(self) -> asyncio.Future:
         """Turn on the plug"""
 
         if self._mode != "normal":
             self._logger.warning(f"Cannot turn ON {self}: mode is {self._mode}")
-            return
+            return self._failed(f"mode is {self._mode}")
 
-        super().on()
+        return super().on()
 
-    def off(self) -> None:
+    def off(self) -> asyncio.Future:
         """Turn off the plug"""
 
         if self._mode != "normal":
             self._logger.warning(f"Cannot turn OFF {self}: mode is {self._mode}")
-            return
+            return self._failed(f"mode is {self._mode}")
 
-        super().off()
+        return super().off()
 
-    def toggle(self) -> None:
+    def toggle(self) -> asyncio.Future:
         """Toggle the device status"""
 
         if self._mode != "normal":
             self._logger.warning(f"Cannot toggle {self}: mode is {self._mode}")
-            return
+            return self._failed(f"mode is {self._mode}")
 
-        super().toggle()
+        return super().toggle()
 
-    def refresh(self) -> None:
+    def refresh(self) -> asyncio.Future:
         """Refresh the device status (send the same status currently set)"""
 
         if self._mode != "normal":
             self._logger.warning(f"Cannot refresh {self}: mode is {self._mode}")
-            return
+            return self._failed(f"mode is {self._mode}")
 
-        super().refresh()
+        return super().refresh()
@@ -39,3 +39,44 @@ class MissingSwitchesError(RuntimeError):
         super().__init__(f'Missing switches for device "{device_id}" ({type_})')
         self.id = device_id
         self.type_ = type_
+
+
+class InvalidResponseError(RuntimeError):
+    """The device sent an invalid HTTP response"""
+
+    def __init__(self, reason: str) -> None:
+        super().__init__(f'Invalid response from device: {reason}')
+        self.reason = reason
+
+
+class CommandError(RuntimeError):
+    """The command could not be executed by the device"""
+
+    def __init__(self, device_id: str, reason: str) -> None:
+        super().__init__(f'Command for device "{device_id}" failed: {reason}')
+        self.id = device_id
+        self.reason = reason
+
+
+class CircuitOpenError(RuntimeError):
+    """The device is not responding: commands are rejected until the cool-down expires"""
+
+    def __init__(self, device_id: str) -> None:
+        super().__init__(f'Circuit breaker open for device "{device_id}"')
+        self.id = device_id
+
+
+class DeviceOfflineError(RuntimeError):
+    """The device is offline: commands are rejected until it announces itself again"""
+
+    def __init__(self, device_id: str) -> None:
+        super().__init__(f'Device "{device_id}" is offline')
+        self.id = device_id
+
+
+class PoolTimeoutError(RuntimeError):
+    """No connection slot became free in time: the transport is saturated, not the device"""
+
+    def __init__(self, url: str) -> None:
+        super().__init__(f'Timed out waiting for a free connection to "{url}"')
+        self.url = url
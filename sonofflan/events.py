@@ -0,0 +1,424 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Hashable, Iterable
+
+DEFAULT_MAX_EVENTS = 1024
+DROP_LOG_INTERVAL = 60.0
+
+
+class EventQueue:
+    """Bounded queue of events with the latest state winning for each key
+
+    An event for a key already in the queue replaces the queued one (or is
+    merged with it by the merger) keeping its place in the queue, so a slow
+    consumer gets only the freshest state of each device. When the queue is
+    full the oldest event is dropped to make room for the new one: the
+    producers never wait and the memory used is bounded. Drops are logged
+    as a warning at most once every DROP_LOG_INTERVAL seconds (with the
+    number of drops since the last warning), so a queue nobody consumes
+    doesn't flood the logs.
+
+    Attributes
+    ----------
+    `maxsize` : int
+        Maximum number of events in the queue
+    `depth` : int
+        Number of events in the queue
+    `drops` : int
+        Number of events dropped because the queue was full
+    `coalesced` : int
+        Number of events merged into an event already in the queue
+    `closed` : bool
+        If the queue was closed
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_MAX_EVENTS, merger: Callable[[Any, Any], Any] | None = None) -> None:
+        """
+        Parameters
+        ----------
+        `maxsize` : int
+            Maximum number of events in the queue
+        `merger` : Callable|None
+            Function combining a queued event with a newer one for the same
+            key (the newer one replaces the queued one if not set)
+        """
+
+        if maxsize < 1:
+            raise ValueError(f"Invalid maxsize {maxsize}: expected a positive number")
+        self._maxsize = maxsize
+        self._merger = merger
+        self._events: OrderedDict[Hashable, Any] = OrderedDict()
+        self._getters: deque[asyncio.Future] = deque()
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+        self._closed = False
+        self._drops = 0
+        self._unreported = 0
+        self._reported_at = None
+        self._coalesced = 0
+        self._logger = logging.getLogger("sonofflan.events")
+
+    def __repr__(self) -> str:
+        return f"EventQueue(depth={self.depth}/{self._maxsize} drops={self._drops} coalesced={self._coalesced})"
+
+    @property
+    def maxsize(self) -> int:
+        """Maximum number of events in the queue"""
+
+        return self._maxsize
+
+    @property
+    def depth(self) -> int:
+        """Number of events in the queue"""
+
+        return len(self._events)
+
+    @property
+    def drops(self) -> int:
+        """Number of events dropped because the queue was full"""
+
+        return self._drops
+
+    @property
+    def coalesced(self) -> int:
+        """Number of events merged into an event already in the queue"""
+
+        return self._coalesced
+
+    @property
+    def closed(self) -> bool:
+        """If the queue was closed"""
+
+        return self._closed
+
+    def put(self, key: Hashable, event: Any) -> None:
+        """Put an event in the queue (never waits)
+
+        Parameters
+        ----------
+        `key` : Hashable
+            Key of the event (e.g. the device ID)
+        `event` : Any
+            The event
+        """
+
+        if self._closed:
+            self._logger.debug(f"Queue closed, ignoring event for {key}")
+            return
+        if key in self._events:
+            queued = self._events[key]
+            merged = self._merger(queued, event) if self._merger is not None else None
+            self._events[key] = merged if merged is not None else event
+            self._coalesced += 1
+            return
+        if len(self._events) >= self._maxsize:
+            dropped, _ = self._events.popitem(last=False)
+            self._drops += 1
+            self._report_drop(dropped)
+            self.task_done()  # Never delivered
+        self._events[key] = event
+        self._unfinished += 1
+        self._finished.clear()
+        self._wakeup()
+
+    async def get(self) -> Any:
+        """Get the oldest event from the queue, waiting for one if empty
+
+        Return
+        ------
+        The event (None if the queue was closed and all the events were taken)
+        """
+
+        while not self._events:
+            if self._closed:
+                return None
+            future = asyncio.get_running_loop().create_future()
+            self._getters.append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future in self._getters:
+                    self._getters.remove(future)
+                elif self._events:
+                    self._wakeup()  # Woken up but cancelled: pass the event to another getter
+                raise
+        _, event = self._events.popitem(last=False)
+        return event
+
+    def task_done(self) -> None:
+        """Mark an event taken from the queue as processed"""
+
+        if self._unfinished <= 0:
+            raise ValueError("task_done() called too many times")
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._finished.set()
+
+    async def join(self) -> None:
+        """Wait until all the events put in the queue are processed (or dropped)"""
+
+        await self._finished.wait()
+
+    def close(self) -> None:
+        """Close the queue: the consumers get None once the queued events are taken"""
+
+        self._closed = True
+        while self._getters:
+            future = self._getters.popleft()
+            if not future.done():
+                future.set_result(None)
+
+    def _report_drop(self, key: Hashable) -> None:
+        """Log a dropped event (rate limited)"""
+
+        self._unreported += 1
+        now = time.monotonic()
+        if self._reported_at is not None and now - self._reported_at < DROP_LOG_INTERVAL:
+            self._logger.debug(f"Event queue full, dropped the event for {key}")
+            return
+        self._logger.warning(
+            f"Event queue full, dropped {self._unreported} events (last one for {key}, {self._drops} in total)"
+        )
+        self._reported_at = now
+        self._unreported = 0
+
+    def _wakeup(self) -> None:
+        while self._getters:
+            future = self._getters.popleft()
+            if not future.done():
+                future.set_result(None)
+                break
+
+
+class Subscription:
+    """Subscription to the events of an EventBus
+
+    Each subscription has its own bounded queue, so a slow subscriber
+    doesn't delay the other ones. Iterate on it (`async for`) or call
+    `get()` to receive the events: the iteration ends when the
+    subscription or the bus is closed.
+
+    Attributes
+    ----------
+    `ids` : frozenset|None
+        IDs of the devices of interest (None for all)
+    `types` : frozenset|None
+        Classes of the devices of interest, including their subclasses (None for all)
+    `actions` : frozenset|None
+        Actions of interest (None for all)
+    `queue` : EventQueue
+        The queue of the events of the subscription
+    """
+
+    def __init__(self, bus: "EventBus", ids: frozenset | None, types: frozenset | None, actions: frozenset | None,
+                 queue: EventQueue) -> None:
+        self._bus = bus
+        self._ids = ids
+        self._types = types
+        self._actions = actions
+        self._queue = queue
+
+    def __repr__(self) -> str:
+        return f"Subscription(ids={self._ids} types={self._types} actions={self._actions} {self._queue})"
+
+    @property
+    def ids(self) -> frozenset | None:
+        """IDs of the devices of interest (None for all)"""
+
+        return self._ids
+
+    @property
+    def types(self) -> frozenset | None:
+        """Classes of the devices of interest (None for all)"""
+
+        return self._types
+
+    @property
+    def actions(self) -> frozenset | None:
+        """Actions of interest (None for all)"""
+
+        return self._actions
+
+    @property
+    def queue(self) -> EventQueue:
+        """The queue of the events of the subscription"""
+
+        return self._queue
+
+    async def get(self) -> Any:
+        """Get the next event (None once the subscription is closed)"""
+
+        return await self._queue.get()
+
+    def task_done(self) -> None:
+        """Mark an event as processed"""
+
+        self._queue.task_done()
+
+    def close(self) -> None:
+        """Stop receiving events"""
+
+        self._bus.unsubscribe(self)
+
+    def __aiter__(self) -> "Subscription":
+        return self
+
+    async def __anext__(self) -> Any:
+        event = await self._queue.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+
+class EventBus:
+    """Deliver events to many subscribers, each with its own filter
+
+    The filters are indexed by device ID, device class and action: the
+    subscribers of an event are found with a few set operations, without
+    checking the filter of every subscriber. Events are shared by all the
+    subscribers (they must be immutable).
+
+    Attributes
+    ----------
+    `subscriptions` : int
+        Number of active subscriptions
+    """
+
+    def __init__(self, merger: Callable[[Any, Any], Any] | None = None) -> None:
+        """
+        Parameters
+        ----------
+        `merger` : Callable|None
+            Function combining a queued event with a newer one for the same
+            key (see EventQueue)
+        """
+
+        self._merger = merger
+        self._subscriptions: set[Subscription] = set()
+        self._by_id: dict[Hashable, set[Subscription]] = {}
+        self._by_type: dict[type, set[Subscription]] = {}
+        self._by_action: dict[Hashable, set[Subscription]] = {}
+        self._any_id: set[Subscription] = set()
+        self._any_type: set[Subscription] = set()
+        self._any_action: set[Subscription] = set()
+        self._closed = False
+
+    @property
+    def subscriptions(self) -> int:
+        """Number of active subscriptions"""
+
+        return len(self._subscriptions)
+
+    def subscribe(self, ids: Iterable[Hashable] | None = None, types: Iterable[type] | None = None,
+                  actions: Iterable[Hashable] | None = None, max_events: int = DEFAULT_MAX_EVENTS) -> Subscription:
+        """Subscribe to the events
+
+        Parameters
+        ----------
+        `ids` : Iterable|None
+            IDs of the devices of interest (None for all)
+        `types` : Iterable|None
+            Classes of the devices of interest, including their subclasses (None for all)
+        `actions` : Iterable|None
+            Actions of interest (None for all)
+        `max_events` : int
+            Maximum number of events waiting in the queue of the subscription
+
+        Return
+        ------
+        The subscription
+        """
+
+        subscription = Subscription(
+            self,
+            frozenset(ids) if ids is not None else None,
+            frozenset(types) if types is not None else None,
+            frozenset(actions) if actions is not None else None,
+            EventQueue(max_events, self._merger)
+        )
+        if self._closed:
+            subscription.queue.close()
+            return subscription
+        self._subscriptions.add(subscription)
+        self._index(subscription.ids, self._by_id, self._any_id, subscription)
+        self._index(subscription.types, self._by_type, self._any_type, subscription)
+        self._index(subscription.actions, self._by_action, self._any_action, subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """Remove a subscription and close its queue
+
+        Parameters
+        ----------
+        `subscription` : Subscription
+            The subscription to remove
+        """
+
+        subscription.queue.close()
+        if subscription not in self._subscriptions:
+            return
+        self._subscriptions.discard(subscription)
+        self._unindex(subscription.ids, self._by_id, self._any_id, subscription)
+        self._unindex(subscription.types, self._by_type, self._any_type, subscription)
+        self._unindex(subscription.actions, self._by_action, self._any_action, subscription)
+
+    def publish(self, key: Hashable, event: Any, device_type: type, action: Hashable) -> int:
+        """Deliver an event to the matching subscriptions
+
+        Parameters
+        ----------
+        `key` : Hashable
+            ID of the device of the event
+        `event` : Any
+            The event
+        `device_type` : type
+            Class of the device of the event
+        `action` : Hashable
+            Action of the event
+
+        Return
+        ------
+        Number of subscriptions receiving the event
+        """
+
+        if not self._subscriptions:
+            return 0
+        matching = self._any_id.union(self._by_id.get(key, ()))
+        if matching:
+            types = self._any_type.union(*[self._by_type[x] for x in device_type.__mro__ if x in self._by_type])
+            matching &= types
+        if matching:
+            matching &= self._any_action.union(self._by_action.get(action, ()))
+        for subscription in matching:
+            subscription.queue.put(key, event)
+        return len(matching)
+
+    def close(self) -> None:
+        """Close all the subscriptions"""
+
+        self._closed = True
+        for subscription in list(self._subscriptions):
+            self.unsubscribe(subscription)
+
+    @staticmethod
+    def _index(values: frozenset | None, index: dict, wildcard: set, subscription: Subscription) -> None:
+        if values is None:
+            wildcard.add(subscription)
+            return
+        for value in values:
+            index.setdefault(value, set()).add(subscription)
+
+    @staticmethod
+    def _unindex(values: frozenset | None, index: dict, wildcard: set, subscription: Subscription) -> None:
+        if values is None:
+            wildcard.discard(subscription)
+            return
+        for value in values:
+            subscriptions = index.get(value)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del index[value]
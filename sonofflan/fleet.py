@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Iterable
+
+from sonofflan.devices import CommandResult, Device
+from sonofflan.errors import CommandError
+
+DEFAULT_LIMIT = 32
+
+logger = logging.getLogger("sonofflan.fleet")
+
+
+async def fan_out(
+        devices: dict[str, Device] | Iterable[Device],
+        command: str | Callable[[Device], Awaitable[CommandResult]],
+        *args,
+        select: Callable[[Device], bool] | None = None,
+        limit: int = DEFAULT_LIMIT,
+        deadline: float | None = None,
+) -> dict[str, CommandResult]:
+    """Send a command to many devices concurrently
+
+    At most `limit` commands are in flight at the same time. When the
+    deadline expires the fan-out stops waiting: the commands not started
+    yet or still waiting in the queue of their device are withdrawn and
+    never sent, and the results of the ones not completed fail with a
+    TimeoutError. A command already being sent to its device when the
+    deadline expires is completed anyway, so it may still be applied.
+
+    Example: turn off every plug in the fleet within 2 seconds
+
+        results = await fan_out(browser.devices, "off", select=lambda x: isinstance(x, Plug), deadline=2)
+
+    Parameters
+    ----------
+    `devices` : dict[str, Device]|Iterable[Device]
+        The devices (e.g. `Browser.devices`)
+    `command` : str|Callable
+        Name of the device method to call (e.g. "on") or function returning
+        the awaitable command for a device
+    `args`
+        Arguments for the device method (e.g. the outlet for a Strip)
+    `select` : Callable|None
+        Filter for the devices to send the command to (all if not set)
+    `limit` : int
+        Maximum number of commands in flight
+    `deadline` : float|None
+        Maximum time in seconds for the whole fan-out (None to wait for all)
+
+    Return
+    ------
+    Dictionary with the CommandResult for each selected device ID
+    """
+
+    if limit < 1:
+        raise ValueError(f"Invalid limit {limit}: expected a positive number")
+    if isinstance(devices, dict):
+        devices = devices.values()
+    selected = [x for x in devices if select is None or select(x)]
+    semaphore = asyncio.Semaphore(limit)
+
+    async def send(device: Device) -> CommandResult:
+        async with semaphore:
+            if callable(command):
+                return await command(device)
+            method = getattr(device, command, None)
+            if method is None:
+                return CommandResult(exception=CommandError(device.id, f'unsupported command "{command}"'))
+            return await method(*args)
+
+    tasks = {x.id: asyncio.create_task(send(x)) for x in selected}
+    if not tasks:
+        return {}
+    logger.debug(f"Sending {command} to {len(tasks)} devices")
+    try:
+        _, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+    except asyncio.CancelledError:
+        for task in tasks.values():
+            task.cancel()
+        raise
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.warning(f"Deadline expired with {len(pending)} commands not completed")
+        await asyncio.wait(pending)
+
+    results = {}
+    for device_id, task in tasks.items():
+        if task.cancelled():
+            results[device_id] = CommandResult(exception=asyncio.TimeoutError(f"Deadline expired for {device_id}"))
+        elif task.exception() is not None:
+            results[device_id] = CommandResult(exception=task.exception())  # type: ignore
+        else:
+            results[device_id] = task.result()
+    return results
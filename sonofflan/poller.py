@@ -0,0 +1,181 @@
+import asyncio
+import heapq
+import logging
+import random
+import time
+
+from sonofflan.browser import Browser
+from sonofflan.decoder import decode_info
+
+DEFAULT_POLL_INTERVAL = 60.0
+DEFAULT_POLL_JITTER = 0.2
+DEFAULT_POLL_LIMIT = 8
+
+
+class Poller:
+    """Poll the devices that stopped announcing themselves
+
+    Some devices stop announcing over mDNS (e.g. after a router restart):
+    the poller queries their /zeroconf/info endpoint with the transport of
+    the device and updates them through the browser, as if they announced
+    the new state. A device that announced itself in the last interval is
+    not polled.
+
+    All the devices are scheduled on a single heap: each one is polled
+    about every `interval` seconds, randomized by the jitter so the polls
+    are spread over time, and at most `limit` polls run at the same time.
+
+    Attributes
+    ----------
+    `interval` : float
+        Seconds between two polls of the same device
+    `polls` : int
+        Number of polls sent
+    `failures` : int
+        Number of polls that failed
+    `skipped` : int
+        Number of polls skipped because the device announced itself
+    """
+
+    def __init__(self, browser: Browser, interval: float = DEFAULT_POLL_INTERVAL,
+                 jitter: float = DEFAULT_POLL_JITTER, limit: int = DEFAULT_POLL_LIMIT) -> None:
+        """
+        Parameters
+        ----------
+        `browser` : Browser
+            The browser with the devices to poll
+        `interval` : float
+            Seconds between two polls of the same device
+        `jitter` : float
+            Relative randomization of the interval (0.2 for ±20%)
+        `limit` : int
+            Maximum number of polls running at the same time
+        """
+
+        if interval <= 0:
+            raise ValueError(f"Invalid interval {interval}: expected a positive number")
+        if not 0 <= jitter < 1:
+            raise ValueError(f"Invalid jitter {jitter}: expected a number between 0 and 1")
+        if limit < 1:
+            raise ValueError(f"Invalid limit {limit}: expected a positive number")
+        self._browser = browser
+        self._interval = interval
+        self._jitter = jitter
+        self._semaphore = asyncio.Semaphore(limit)
+        self._heap: list[tuple[float, str]] = []
+        self._scheduled: set[str] = set()
+        self._in_flight: dict[str, asyncio.Task] = {}
+        self._task = None
+        self._polls = 0
+        self._failures = 0
+        self._skipped = 0
+        self._logger = logging.getLogger("sonofflan.poller")
+
+    def __repr__(self) -> str:
+        return f"Poller(interval={self._interval} polls={self._polls} failures={self._failures})"
+
+    @property
+    def interval(self) -> float:
+        """Seconds between two polls of the same device"""
+
+        return self._interval
+
+    @property
+    def polls(self) -> int:
+        """Number of polls sent"""
+
+        return self._polls
+
+    @property
+    def failures(self) -> int:
+        """Number of polls that failed"""
+
+        return self._failures
+
+    @property
+    def skipped(self) -> int:
+        """Number of polls skipped because the device announced itself"""
+
+        return self._skipped
+
+    def start(self) -> None:
+        """Start polling in background"""
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop polling (the polls in progress are cancelled)"""
+
+        tasks = list(self._in_flight.values())
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def poll(self, device_id: str) -> bool:
+        """Poll a device now
+
+        Parameters
+        ----------
+        `device_id` : str
+            ID of the device
+
+        Return
+        ------
+        True if the device answered and was updated
+        """
+
+        device = self._browser.devices.get(device_id)
+        if device is None:
+            return False
+        async with self._semaphore:
+            self._polls += 1
+            result = await device.info()
+        if not result.ok:
+            self._failures += 1
+            self._logger.debug(f"Cannot poll {device}: {result}")
+            return False
+        # noinspection PyBroadException
+        try:
+            payload = decode_info(result.data, device.cipher if device.encrypt else None)
+        except Exception:
+            self._failures += 1
+            self._logger.warning(f"Invalid info from {device}", exc_info=True)
+            return False
+        self._logger.debug(f"Polled {device}: {payload}")
+        return self._browser.apply_poll(device_id, payload)
+
+    def _next_delay(self) -> float:
+        return self._interval * random.uniform(1 - self._jitter, 1 + self._jitter)
+
+    async def _run(self) -> None:
+        """Poll the devices when they are due"""
+
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            for device_id in self._browser.devices:
+                if device_id not in self._scheduled:
+                    # The first polls are spread over the interval
+                    self._scheduled.add(device_id)
+                    heapq.heappush(self._heap, (now + random.uniform(0, self._interval), device_id))
+            while self._heap and self._heap[0][0] <= now:
+                _, device_id = heapq.heappop(self._heap)
+                if device_id not in self._browser.devices:
+                    self._scheduled.discard(device_id)
+                    continue
+                heapq.heappush(self._heap, (now + self._next_delay(), device_id))
+                announced = self._browser.last_announcement(device_id)
+                if announced is not None and time.monotonic() - announced < self._interval:
+                    self._skipped += 1
+                    continue
+                if device_id in self._in_flight:
+                    continue  # Still polling it
+                task = loop.create_task(self.poll(device_id))
+                self._in_flight[device_id] = task
+                task.add_done_callback(lambda x, y=device_id: self._in_flight.pop(y, None))
+            delay = self._heap[0][0] - now if self._heap else self._interval
+            await asyncio.sleep(min(delay, self._interval))
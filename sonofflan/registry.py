@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+from copy import deepcopy
+
+REGISTRY_VERSION = 1
+
+
+class Registry:
+    """Persistent registry of the last known state of the devices
+
+    The registry keeps the last announcement received from each device (ID,
+    type, addresses, port, encryption flag and decoded data) and saves it to a
+    JSON file, so a new browser can create the devices at startup without
+    waiting for the discovery. The devices loaded from the registry are not
+    verified until they announce themselves again.
+
+    Attributes
+    ----------
+    `path` : str
+        Path of the registry file (JSON)
+    `num_devices` : int
+        Number of devices in the registry
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Parameters
+        ----------
+        `path` : str
+            Path of the registry file (JSON)
+        """
+
+        self._path = path
+        self._devices: dict[str, dict] = {}
+        self._dirty = False
+        self._logger = logging.getLogger("sonofflan.registry")
+
+    def __repr__(self) -> str:
+        return f"Registry({self._path} devices={len(self._devices)})"
+
+    @property
+    def path(self) -> str:
+        """Path of the registry file (JSON)"""
+
+        return self._path
+
+    @property
+    def num_devices(self) -> int:
+        """Number of devices in the registry"""
+
+        return len(self._devices)
+
+    def load(self) -> list[dict]:
+        """Load the registry from its file
+
+        A missing or invalid file is treated as an empty registry.
+
+        Return
+        ------
+        The data of the devices, as received from Zeroconf (marked as not verified)
+        """
+
+        # noinspection PyBroadException
+        try:
+            with open(self._path) as f:
+                registry = json.load(f)
+            if registry.get("version") != REGISTRY_VERSION:
+                raise ValueError(f"Unsupported registry version {registry.get('version')}")
+            devices = registry["devices"]
+            for device_id, data in devices.items():
+                if data.get("id") != device_id:
+                    raise ValueError(f'Invalid data for device "{device_id}"')
+        except FileNotFoundError:
+            self._logger.debug(f"Registry {self._path} not found")
+            return []
+        except Exception:
+            self._logger.warning(f"Cannot load registry {self._path}, ignoring it", exc_info=True)
+            return []
+        self._devices = devices
+        self._dirty = False
+        self._logger.debug(f"Loaded {len(devices)} devices from {self._path}")
+        return [dict(deepcopy(x), verified=False) for x in devices.values()]
+
+    def record(self, data: dict) -> None:
+        """Record the last data received from a device
+
+        Parameters
+        ----------
+        `data` : dict
+            Dictionary with data coming from Zeroconf
+        """
+
+        data = {x: data[x] for x in ("id", "type", "address", "addresses", "port", "encrypt", "data") if x in data}
+        if self._devices.get(data["id"]) != data:
+            self._devices[data["id"]] = deepcopy(data)
+            self._dirty = True
+
+    def forget(self, device_id: str) -> None:
+        """Remove a device from the registry
+
+        Parameters
+        ----------
+        `device_id` : str
+            ID of the device
+        """
+
+        if self._devices.pop(device_id, None) is not None:
+            self._dirty = True
+
+    def save(self) -> None:
+        """Save the registry to its file (only if changed)
+
+        The file is replaced atomically, so a crash never leaves it truncated.
+        """
+
+        if not self._dirty:
+            return
+        tmp = f"{self._path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": REGISTRY_VERSION, "devices": self._devices}, f, indent=2)
+        os.replace(tmp, self._path)
+        self._dirty = False
+        self._logger.debug(f"Saved {len(self._devices)} devices to {self._path}")
@@ -0,0 +1,274 @@
+import random
+import time
+
+DEFAULT_ATTEMPTS = 3
+DEFAULT_BASE_DELAY = 0.2
+DEFAULT_MAX_DELAY = 5.0
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_COOLDOWN = 30.0
+DEFAULT_INITIAL_TIMEOUT = 5.0
+DEFAULT_MIN_TIMEOUT = 0.5
+DEFAULT_MAX_TIMEOUT = 30.0
+
+_default_retry_policy = None
+
+
+class RetryPolicy:
+    """Policy for retrying commands that got no response from the device
+
+    The delay before each retry grows exponentially and is randomized with
+    "full jitter" (uniformly between 0 and the exponential value), so many
+    commands failing together don't retry in lockstep.
+
+    Attributes
+    ----------
+    `attempts` : int
+        Maximum number of attempts (1 to never retry)
+    `base_delay` : float
+        Delay in seconds before the first retry (before jitter)
+    `max_delay` : float
+        Maximum delay in seconds between two attempts (before jitter)
+    """
+
+    def __init__(self, attempts: int = DEFAULT_ATTEMPTS, base_delay: float = DEFAULT_BASE_DELAY,
+                 max_delay: float = DEFAULT_MAX_DELAY) -> None:
+        """
+        Parameters
+        ----------
+        `attempts` : int
+            Maximum number of attempts (1 to never retry)
+        `base_delay` : float
+            Delay in seconds before the first retry (before jitter)
+        `max_delay` : float
+            Maximum delay in seconds between two attempts (before jitter)
+        """
+
+        if attempts < 1:
+            raise ValueError(f"Invalid attempts {attempts}: expected a positive number")
+        self._attempts = attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+    def __repr__(self) -> str:
+        return f"RetryPolicy(attempts={self._attempts} base_delay={self._base_delay} max_delay={self._max_delay})"
+
+    @property
+    def attempts(self) -> int:
+        """Maximum number of attempts"""
+
+        return self._attempts
+
+    @property
+    def base_delay(self) -> float:
+        """Delay in seconds before the first retry (before jitter)"""
+
+        return self._base_delay
+
+    @property
+    def max_delay(self) -> float:
+        """Maximum delay in seconds between two attempts (before jitter)"""
+
+        return self._max_delay
+
+    def delay(self, attempt: int) -> float:
+        """Get the delay before the next attempt
+
+        Parameters
+        ----------
+        `attempt` : int
+            Number of attempts already done (starting from 1)
+        """
+
+        return random.uniform(0, min(self._max_delay, self._base_delay * (2 ** (attempt - 1))))
+
+
+class CircuitBreaker:
+    """Circuit breaker for a device
+
+    After `failure_threshold` consecutive failed commands the circuit opens
+    and the following commands fail fast without contacting the device.
+    After the cool-down a single probe command is allowed (half-open): if
+    it succeeds the circuit closes, otherwise it opens again.
+
+    Attributes
+    ----------
+    `state` : str
+        The circuit state ("closed", "open" or "half-open")
+    `failures` : int
+        Number of consecutive failures
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD, cooldown: float = DEFAULT_COOLDOWN) -> None:
+        """
+        Parameters
+        ----------
+        `failure_threshold` : int
+            Number of consecutive failures opening the circuit
+        `cooldown` : float
+            Seconds before probing the device again
+        """
+
+        if failure_threshold < 1:
+            raise ValueError(f"Invalid failure_threshold {failure_threshold}: expected a positive number")
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def __repr__(self) -> str:
+        return f"CircuitBreaker({self.state} failures={self._failures})"
+
+    @property
+    def state(self) -> str:
+        """The circuit state ("closed", "open" or "half-open")"""
+
+        if self._opened_at is None:
+            return self.CLOSED
+        if self._probing or time.monotonic() - self._opened_at >= self._cooldown:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    @property
+    def failures(self) -> int:
+        """Number of consecutive failures"""
+
+        return self._failures
+
+    def allow(self) -> bool:
+        """Check if a command can be sent (a probe is allowed when half-open)"""
+
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        """Record a command that reached the device"""
+
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def abort(self) -> None:
+        """Record a command that was not completed (e.g. cancelled)"""
+
+        self._probing = False
+
+    def record_failure(self) -> None:
+        """Record a command that got no response from the device"""
+
+        self._failures += 1
+        if self._probing or self._failures >= self._failure_threshold:
+            self._opened_at = time.monotonic()
+        self._probing = False
+
+
+class RttEstimator:
+    """Round-trip time estimator for a device
+
+    Keeps a smoothed RTT and its variance like TCP does (RFC 6298), and
+    derives the timeout for the next request from them:
+
+        timeout = srtt + 4 * rttvar
+
+    clamped between the minimum and the maximum timeout. Every request
+    that times out doubles the timeout (up to the maximum) until a new
+    sample is received.
+
+    Attributes
+    ----------
+    `srtt` : float|None
+        The smoothed round-trip time in seconds (None until the first sample)
+    `rttvar` : float|None
+        The round-trip time variation in seconds (None until the first sample)
+    `timeout` : float
+        The timeout in seconds for the next request
+    """
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial_timeout: float = DEFAULT_INITIAL_TIMEOUT, min_timeout: float = DEFAULT_MIN_TIMEOUT,
+                 max_timeout: float = DEFAULT_MAX_TIMEOUT) -> None:
+        """
+        Parameters
+        ----------
+        `initial_timeout` : float
+            Timeout in seconds used before the first sample
+        `min_timeout` : float
+            Minimum timeout in seconds
+        `max_timeout` : float
+            Maximum timeout in seconds
+        """
+
+        if not 0 < min_timeout <= max_timeout:
+            raise ValueError(f"Invalid timeout range {min_timeout}-{max_timeout}")
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+        self._srtt = None
+        self._rttvar = None
+        self._timeout = self._clamp(initial_timeout)
+
+    def __repr__(self) -> str:
+        return f"RttEstimator(srtt={self._srtt} rttvar={self._rttvar} timeout={self._timeout})"
+
+    @property
+    def srtt(self) -> float | None:
+        """The smoothed round-trip time in seconds (None until the first sample)"""
+
+        return self._srtt
+
+    @property
+    def rttvar(self) -> float | None:
+        """The round-trip time variation in seconds (None until the first sample)"""
+
+        return self._rttvar
+
+    @property
+    def timeout(self) -> float:
+        """The timeout in seconds for the next request"""
+
+        return self._timeout
+
+    def sample(self, rtt: float) -> None:
+        """Update the estimate with a measured round-trip time
+
+        Parameters
+        ----------
+        `rtt` : float
+            The round-trip time in seconds of a request that got a response
+        """
+
+        if self._srtt is None or self._rttvar is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = (1 - self.BETA) * self._rttvar + self.BETA * abs(self._srtt - rtt)
+            self._srtt = (1 - self.ALPHA) * self._srtt + self.ALPHA * rtt
+        self._timeout = self._clamp(self._srtt + self.K * self._rttvar)
+
+    def backoff(self) -> None:
+        """Double the timeout after a request timed out"""
+
+        self._timeout = self._clamp(self._timeout * 2)
+
+    def _clamp(self, timeout: float) -> float:
+        return min(self._max_timeout, max(self._min_timeout, timeout))
+
+
+def default_retry_policy() -> RetryPolicy:
+    """Get the retry policy shared by all the devices"""
+
+    global _default_retry_policy
+    if _default_retry_policy is None:
+        _default_retry_policy = RetryPolicy()
+    return _default_retry_policy
@@ -0,0 +1,136 @@
+import asyncio
+import heapq
+import logging
+from typing import Callable, Hashable
+
+
+class StalenessTracker:
+    """Track when many keys (devices) were last seen, with a single timer
+
+    The deadlines are kept in a heap and a single loop timer is scheduled
+    for the earliest one, so tracking thousands of devices doesn't need a
+    task or a timer per device. Touching a key pushes a new deadline: the
+    outdated entries are discarded lazily when they reach the top of the
+    heap (or when they are too many, compacting the heap).
+
+    Attributes
+    ----------
+    `ttl` : float
+        Seconds without being touched before a key expires
+    `tracked` : int
+        Number of keys tracked
+    """
+
+    def __init__(self, ttl: float, on_expired: Callable[[Hashable], None]) -> None:
+        """
+        Parameters
+        ----------
+        `ttl` : float
+            Seconds without being touched before a key expires
+        `on_expired` : Callable
+            Function called with each expired key (it is not tracked anymore)
+        """
+
+        if ttl <= 0:
+            raise ValueError(f"Invalid ttl {ttl}: expected a positive number")
+        self._ttl = ttl
+        self._on_expired = on_expired
+        self._deadlines: dict[Hashable, float] = {}
+        self._heap: list[tuple[float, int, Hashable]] = []
+        self._counter = 0  # Tie-breaker: keys don't need to be comparable
+        self._timer: asyncio.TimerHandle | None = None
+        self._logger = logging.getLogger("sonofflan.staleness")
+
+    def __repr__(self) -> str:
+        return f"StalenessTracker(ttl={self._ttl} tracked={len(self._deadlines)})"
+
+    @property
+    def ttl(self) -> float:
+        """Seconds without being touched before a key expires"""
+
+        return self._ttl
+
+    @property
+    def tracked(self) -> int:
+        """Number of keys tracked"""
+
+        return len(self._deadlines)
+
+    def touch(self, key: Hashable) -> None:
+        """Mark a key as seen now (starting to track it if needed)
+
+        Parameters
+        ----------
+        `key` : Hashable
+            The key (e.g. the device ID)
+        """
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._ttl
+        self._deadlines[key] = deadline
+        self._counter += 1
+        heapq.heappush(self._heap, (deadline, self._counter, key))
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._compact()
+        self._schedule(loop)
+
+    def remove(self, key: Hashable) -> None:
+        """Stop tracking a key
+
+        Parameters
+        ----------
+        `key` : Hashable
+            The key (e.g. the device ID)
+        """
+
+        self._deadlines.pop(key, None)  # The heap entries are discarded lazily
+
+    def close(self) -> None:
+        """Stop tracking all the keys"""
+
+        self._deadlines.clear()
+        self._heap.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _compact(self) -> None:
+        """Rebuild the heap without the outdated entries"""
+
+        self._heap = [x for x in self._heap if self._deadlines.get(x[2]) == x[0]]
+        heapq.heapify(self._heap)
+
+    def _schedule(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Schedule the timer for the earliest deadline"""
+
+        while self._heap and self._deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)  # Outdated entry
+        if not self._heap:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            return
+        earliest = self._heap[0][0]
+        if self._timer is not None and self._timer.when() <= earliest:
+            return  # The timer fires before the earliest deadline
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = loop.call_at(earliest, self._expire)
+
+    def _expire(self) -> None:
+        """Expire the keys whose deadline passed"""
+
+        self._timer = None
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            if self._deadlines.get(key) != deadline:
+                continue  # Touched again or removed
+            del self._deadlines[key]
+            # noinspection PyBroadException
+            try:
+                self._on_expired(key)
+            except Exception:
+                self._logger.error(f"Exception expiring {key}", exc_info=True)
+        self._schedule(loop)
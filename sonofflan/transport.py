@@ -0,0 +1,562 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+from sonofflan.errors import InvalidResponseError, PoolTimeoutError
+
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_ACQUIRE_TIMEOUT = 30.0
+DEFAULT_MAX_CONNECTIONS = 64
+DEFAULT_MAX_IDLE_PER_HOST = 2
+DEFAULT_IDLE_TIMEOUT = 30.0
+DEFAULT_RACE_DELAY = 0.25
+
+_default_transport = None
+
+
+class Response:
+    """HTTP response received from a device
+
+    Attributes
+    ----------
+    `status` : int
+        The HTTP status code
+    `reason` : str
+        The HTTP reason phrase
+    `headers` : dict[str, str]
+        The response headers (names are lower case)
+    `content` : bytes
+        The response body
+    `elapsed` : float|None
+        Seconds from getting a connection to receiving the response (None if not measured)
+    """
+
+    def __init__(self, status: int, reason: str, headers: dict[str, str], content: bytes,
+                 elapsed: float | None = None) -> None:
+        """
+        Parameters
+        ----------
+        `status` : int
+            The HTTP status code
+        `reason` : str
+            The HTTP reason phrase
+        `headers` : dict[str, str]
+            The response headers (names are lower case)
+        `content` : bytes
+            The response body
+        `elapsed` : float|None
+            Seconds from getting a connection to receiving the response (None if not measured)
+        """
+
+        self._status = status
+        self._reason = reason
+        self._headers = headers
+        self._content = content
+        self._elapsed = elapsed
+
+    def __repr__(self) -> str:
+        return f"Response({self._status} {self._reason})"
+
+    @property
+    def status(self) -> int:
+        """The HTTP status code"""
+
+        return self._status
+
+    @property
+    def reason(self) -> str:
+        """The HTTP reason phrase"""
+
+        return self._reason
+
+    @property
+    def headers(self) -> dict[str, str]:
+        """The response headers (names are lower case)"""
+
+        return self._headers
+
+    @property
+    def content(self) -> bytes:
+        """The response body"""
+
+        return self._content
+
+    @property
+    def elapsed(self) -> float | None:
+        """Seconds from getting a connection to receiving the response (None if not measured)"""
+
+        return self._elapsed
+
+    def json(self):
+        """Decode the response body as JSON"""
+
+        return json.loads(self._content)
+
+
+class _Connection:
+    """Connection to a device kept by the transport pool"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.reused = False
+        self.idle_since = time.monotonic()
+
+    def usable(self, idle_timeout: float | None) -> bool:
+        """Check if the idle connection can be used for a new request"""
+
+        if self.loop is not asyncio.get_running_loop():
+            return False
+        if self.writer.is_closing() or self.reader.at_eof():
+            return False
+        return idle_timeout is None or time.monotonic() - self.idle_since < idle_timeout
+
+    def close(self) -> None:
+        # noinspection PyBroadException
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class Transport:
+    """Asynchronous HTTP transport for the eWeLink LAN protocol
+
+    Devices in LAN mode expose a tiny HTTP/1.1 server accepting JSON
+    `POST` requests on `/zeroconf/*`: the transport speaks only that subset
+    of the protocol directly on asyncio streams, so sending a command never
+    blocks the event loop.
+
+    Connections are kept alive and reused for the following requests to
+    the same device, while the total number of open sockets is capped for
+    the whole fleet: when the cap is reached, idle connections to other
+    devices are closed first, then requests wait for a free slot. The wait
+    for a slot is bounded by its own timeout: the timeout of a request
+    starts once the connection is available, so a saturated pool is never
+    mistaken for a slow device.
+
+    Attributes
+    ----------
+    `timeout` : float|None
+        Default timeout in seconds for a request (None to wait forever)
+    `max_connections` : int
+        Maximum number of open sockets
+    `open_connections` : int
+        Number of open sockets (in use or idle)
+    `idle_connections` : int
+        Number of idle sockets kept in the pool
+    """
+
+    def __init__(self, timeout: float | None = DEFAULT_TIMEOUT, max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 max_idle_per_host: int = DEFAULT_MAX_IDLE_PER_HOST,
+                 idle_timeout: float | None = DEFAULT_IDLE_TIMEOUT,
+                 acquire_timeout: float | None = DEFAULT_ACQUIRE_TIMEOUT) -> None:
+        """
+        Parameters
+        ----------
+        `timeout` : float|None
+            Default timeout in seconds for a request (None to wait forever)
+        `max_connections` : int
+            Maximum number of open sockets for all the devices
+        `max_idle_per_host` : int
+            Maximum number of idle connections kept for each device (0 to disable keep-alive)
+        `idle_timeout` : float|None
+            Seconds after which an idle connection is not reused (None to keep it forever)
+        `acquire_timeout` : float|None
+            Maximum seconds waiting for a free slot when the sockets are capped (None to wait forever)
+        """
+
+        if max_connections < 1:
+            raise ValueError(f"Invalid max_connections {max_connections}: expected a positive number")
+        self._timeout = timeout
+        self._max_connections = max_connections
+        self._max_idle_per_host = max_idle_per_host
+        self._idle_timeout = idle_timeout
+        self._acquire_timeout = acquire_timeout
+        self._idle: dict[tuple[str, int], deque[_Connection]] = {}
+        self._open = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self._logger = logging.getLogger("sonofflan.transport")
+
+    @property
+    def timeout(self) -> float | None:
+        """Default timeout in seconds for a request"""
+
+        return self._timeout
+
+    @property
+    def max_connections(self) -> int:
+        """Maximum number of open sockets"""
+
+        return self._max_connections
+
+    @property
+    def open_connections(self) -> int:
+        """Number of open sockets (in use or idle)"""
+
+        return self._open
+
+    @property
+    def idle_connections(self) -> int:
+        """Number of idle sockets kept in the pool"""
+
+        return sum(len(x) for x in self._idle.values())
+
+    async def post(self, url: str, headers: dict[str, str], data: str | bytes,
+                   timeout: float | None = None) -> Response:
+        """Send a POST request
+
+        Parameters
+        ----------
+        `url` : str
+            Full URL of the request (`http://address:port/path`)
+        `headers` : dict[str, str]
+            Headers for the request
+        `data` : str|bytes
+            Body of the request
+        `timeout` : float|None
+            Timeout in seconds, starting once a connection slot is available
+            (the default timeout is used if not set)
+
+        Return
+        ------
+        The response from the device, with the elapsed time since the slot
+        was available (raises PoolTimeoutError if no slot became free)
+        """
+
+        parts = urlsplit(url)
+        if parts.scheme != "http" or parts.hostname is None:
+            raise ValueError(f"Unsupported URL \"{url}\"")
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if timeout is None:
+            timeout = self._timeout
+        host, port = parts.hostname, parts.port or 80
+        try:
+            connection = await asyncio.wait_for(self._reserve(host, port), self._acquire_timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeoutError(url) from None
+        start = time.monotonic()
+        reserved = [connection]  # Taken by _request when it starts
+        try:
+            response = await asyncio.wait_for(self._request(host, port, path, headers, data, reserved), timeout)
+        finally:
+            if reserved:
+                # Cancelled before the request started: give back the connection or the slot
+                connection = reserved.pop()
+                if connection is not None:
+                    self._release(host, port, connection, True)
+                else:
+                    self._open -= 1
+                    self._wake_up()
+        response._elapsed = time.monotonic() - start
+        return response
+
+    async def connect_any(self, urls: list[str], timeout: float | None = None,
+                          delay: float = DEFAULT_RACE_DELAY) -> str:
+        """Race connections to the addresses of a device ("happy eyeballs")
+
+        The connection attempts start in order, each one `delay` seconds
+        after the previous one (or as soon as it fails): the first
+        connection established wins and the other attempts are cancelled.
+        The winning connection is kept in the pool, so the next request to
+        that URL reuses it: no request is sent twice.
+
+        Parameters
+        ----------
+        `urls` : list[str]
+            Base URLs of the device (`http://address:port`), in order of preference
+        `timeout` : float|None
+            Timeout in seconds (the default timeout is used if not set)
+        `delay` : float
+            Seconds before starting the next attempt
+
+        Return
+        ------
+        The URL whose connection won (raises the error of the last attempt if all failed)
+        """
+
+        targets = []
+        for url in urls:
+            parts = urlsplit(url)
+            if parts.scheme != "http" or parts.hostname is None:
+                raise ValueError(f"Unsupported URL \"{url}\"")
+            targets.append((url, parts.hostname, parts.port or 80))
+        if not targets:
+            raise ValueError("No URL to connect to")
+        if timeout is None:
+            timeout = self._timeout
+        return await asyncio.wait_for(self._race(targets, delay), timeout)
+
+    def evict(self, url: str) -> None:
+        """Close the idle connections to a device (e.g. when its address changed)
+
+        Parameters
+        ----------
+        `url` : str
+            Base URL of the device (`http://address:port`)
+        """
+
+        parts = urlsplit(url)
+        connections = self._idle.pop((parts.hostname, parts.port or 80), None)
+        if connections:
+            self._logger.debug(f"Evicting {len(connections)} idle connections to {url}")
+            for connection in connections:
+                self._close(connection)
+
+    async def close(self) -> None:
+        """Close all the idle connections"""
+
+        for key in list(self._idle):
+            for connection in self._idle.pop(key):
+                self._close(connection)
+
+    async def _request(self, host: str, port: int, path: str, headers: dict[str, str], body: bytes,
+                       reserved: list[_Connection | None]) -> Response:
+        """Internal method sending a request on a pooled connection
+
+        The reserved connection is an idle one, or None if a slot for a new one was reserved.
+        """
+
+        connection = reserved.pop()
+        request = _build_request(host, port, path, headers, body, keep_alive=self._max_idle_per_host > 0)
+        if connection is None:
+            connection = await self._connect(host, port)
+        while True:
+            reusable = False
+            try:
+                connection.writer.write(request)
+                await connection.writer.drain()
+                response, reusable = await _read_response(connection.reader)
+                return response
+            except (ConnectionError, InvalidResponseError, asyncio.IncompleteReadError):
+                if not connection.reused:
+                    raise
+                # The device closed the idle connection: retry once on a new one
+                self._logger.debug(f"Stale connection to {host}:{port}, reconnecting")
+            finally:
+                self._release(host, port, connection, reusable)
+            connection = await self._acquire(host, port)
+
+    async def _race(self, targets: list[tuple[str, str, int]], delay: float) -> str:
+        """Internal method racing the connections to many addresses"""
+
+        for url, host, port in targets:
+            if any(x.usable(self._idle_timeout) for x in self._idle.get((host, port), ())):
+                return url  # Already connected
+        loop = asyncio.get_running_loop()
+        waiting = list(targets)
+        attempts: dict[asyncio.Task, tuple[str, str, int]] = {}
+        error = None
+        try:
+            while waiting or attempts:
+                if waiting:
+                    target = waiting.pop(0)
+                    attempts[loop.create_task(self._acquire(target[1], target[2]))] = target
+                done, _ = await asyncio.wait(
+                    attempts, timeout=delay if waiting else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    url, host, port = attempts.pop(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                        self._logger.debug(f"Cannot connect to {url}: {error!r}")
+                        continue
+                    self._logger.debug(f"Connected to {url}")
+                    self._release(host, port, task.result(), True)
+                    return url
+            raise error if error is not None else ConnectionError("No connection")
+        finally:
+            for task, (_, host, port) in attempts.items():
+                task.cancel()
+                task.add_done_callback(lambda x, h=host, p=port: self._discard(h, p, x))
+
+    def _discard(self, host: str, port: int, task: asyncio.Task) -> None:
+        """Give back the connection of an attempt that lost the race"""
+
+        if not task.cancelled() and task.exception() is None:
+            self._release(host, port, task.result(), True)
+
+    async def _acquire(self, host: str, port: int) -> _Connection:
+        """Get an idle connection to the device or open a new one"""
+
+        connection = await self._reserve(host, port)
+        if connection is not None:
+            return connection
+        return await self._connect(host, port)
+
+    async def _reserve(self, host: str, port: int) -> _Connection | None:
+        """Get an idle connection to the device, or reserve a slot for a new one (returning None)"""
+
+        idle = self._idle.get((host, port))
+        while idle:
+            connection = idle.pop()
+            if connection.usable(self._idle_timeout):
+                connection.reused = True
+                return connection
+            self._close(connection)
+        while self._open >= self._max_connections:
+            if not self._close_oldest_idle():
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+                try:
+                    await waiter
+                except asyncio.CancelledError:
+                    if waiter.done() and not waiter.cancelled():
+                        self._wake_up()  # Pass the slot to the next waiter
+                    raise
+        self._open += 1
+        return None
+
+    async def _connect(self, host: str, port: int) -> _Connection:
+        """Open a new connection to the device in a reserved slot"""
+
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except BaseException:
+            self._open -= 1
+            self._wake_up()
+            raise
+        return _Connection(reader, writer)
+
+    def _release(self, host: str, port: int, connection: _Connection, reusable: bool) -> None:
+        """Give the connection back to the pool (or close it)"""
+
+        idle = self._idle.setdefault((host, port), deque())
+        if reusable and not connection.writer.is_closing() and len(idle) < self._max_idle_per_host:
+            connection.reused = False
+            connection.idle_since = time.monotonic()
+            idle.append(connection)
+            if self._waiters:
+                self._close_oldest_idle()
+        else:
+            if not idle:
+                del self._idle[(host, port)]
+            self._close(connection)
+
+    def _close(self, connection: _Connection) -> None:
+        """Close a connection and free its slot"""
+
+        connection.close()
+        self._open -= 1
+        self._wake_up()
+
+    def _close_oldest_idle(self) -> bool:
+        """Close the idle connection unused for the longest time"""
+
+        oldest = None
+        for key, idle in self._idle.items():
+            if idle and (oldest is None or idle[0].idle_since < self._idle[oldest][0].idle_since):
+                oldest = key
+        if oldest is None:
+            return False
+        idle = self._idle[oldest]
+        connection = idle.popleft()
+        if not idle:
+            del self._idle[oldest]
+        self._close(connection)
+        return True
+
+    def _wake_up(self) -> None:
+        """Wake up the first request waiting for a free slot"""
+
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+
+def default_transport() -> Transport:
+    """Get the transport shared by all the devices"""
+
+    global _default_transport
+    if _default_transport is None:
+        _default_transport = Transport()
+    return _default_transport
+
+
+def _build_request(host: str, port: int, path: str, headers: dict[str, str], body: bytes, keep_alive: bool) -> bytes:
+    """Serialize a POST request"""
+
+    if ":" in host:
+        host = f"[{host.split('%')[0]}]"  # IPv6 literal (the scope is local to this host)
+    lines = [f"POST {path} HTTP/1.1", f"Host: {host}:{port}"]
+    for name, value in headers.items():
+        if name.lower() not in ("host", "content-length", "connection"):
+            lines.append(f"{name}: {value}")
+    lines.append(f"Content-Length: {len(body)}")
+    lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+
+async def _read_response(reader: asyncio.StreamReader) -> tuple[Response, bool]:
+    """Parse a response from the stream
+
+    Return
+    ------
+    The response and if the connection can be reused
+    """
+
+    status_line = await reader.readline()
+    if not status_line:
+        raise InvalidResponseError("connection closed without response")
+    parts = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+        raise InvalidResponseError(f"invalid status line {status_line!r}")
+    version = parts[0]
+    status = int(parts[1])
+    reason = parts[2] if len(parts) > 2 else ""
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n"):
+            break
+        if not line:
+            raise InvalidResponseError("connection closed while reading headers")
+        name, sep, value = line.decode("latin-1").partition(":")
+        if not sep:
+            raise InvalidResponseError(f"invalid header line {line!r}")
+        headers[name.strip().lower()] = value.strip()
+
+    reusable = (version == "HTTP/1.1" and headers.get("connection", "").lower() != "close")
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        content = await _read_chunked(reader)
+    elif "content-length" in headers:
+        try:
+            content = await reader.readexactly(int(headers["content-length"]))
+        except (ValueError, asyncio.IncompleteReadError) as ex:
+            raise InvalidResponseError(f"invalid body: {ex}")
+    else:
+        content = await reader.read()  # Body delimited by the end of the connection
+        reusable = False
+
+    return Response(status, reason, headers, content), reusable
+
+
+async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+    """Read a body with chunked transfer encoding"""
+
+    chunks = []
+    try:
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                # Skip trailers
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)  # CRLF after the chunk
+    except (ValueError, asyncio.IncompleteReadError) as ex:
+        raise InvalidResponseError(f"invalid chunked body: {ex}")
+    return b"".join(chunks)
@@ -1,7 +1,15 @@
-def parse_address(address: bytes):
-    """Resolve the IP address of the device"""
+import ipaddress
 
-    address_list = []
-    for i in range(4):
-        address_list.append(int(address.hex()[(i * 2): (i + 1) * 2], 16))
-    return f"{address_list[0]}.{address_list[1]}.{address_list[2]}.{address_list[3]}"
+
+def parse_address(address: bytes) -> str:
+    """Resolve the IP address of the device (IPv4 or IPv6, packed as announced by Zeroconf)"""
+
+    return str(ipaddress.ip_address(address))
+
+
+def base_url(address: str, port: int) -> str:
+    """Build the base URL of a device (`http://address:port`, IPv6 addresses bracketed with their scope)"""
+
+    if ":" in address:
+        return f"http://[{address}]:{port}"  # IPv6 literal
+    return f"http://{address}:{port}"
@@ -1,5 +1,11 @@
+import asyncio
+import json
 import time
 from datetime import datetime
+from unittest.mock import patch
+from urllib.parse import urlsplit
+
+from sonofflan.transport import Response, Transport
 
 
 def get_and_wait() -> datetime:
@@ -7,3 +13,68 @@ def get_and_wait() -> datetime:
     v = datetime.utcnow()
     time.sleep(0.000001)
     return v
+
+
+class MockRequest:
+    """Request captured by TransportMock"""
+
+    def __init__(self, url: str, headers: dict[str, str], data: str | bytes) -> None:
+        parts = urlsplit(url)
+        self.method = "POST"
+        self.url = url
+        self.scheme = parts.scheme
+        self.hostname = parts.hostname
+        self.port = parts.port
+        self.path = parts.path
+        self.headers = headers
+        self.text = data.decode("utf-8") if isinstance(data, bytes) else data
+
+
+class TransportMock:
+    """Replace the HTTP transport of the devices"""
+
+    def __init__(self) -> None:
+        self.request_history = []
+        self._status = 200
+        self._content = b"{}"
+        self._delay = 0
+        self._patcher = None
+
+    def __enter__(self) -> "TransportMock":
+        mock = self
+
+        # noinspection PyUnusedLocal
+        async def post(transport, url, headers, data, *args, **kwargs) -> Response:
+            mock.request_history.append(MockRequest(url, headers, data))
+            if mock._delay:
+                await asyncio.sleep(mock._delay)
+            return Response(mock._status, "OK", {}, mock._content)
+
+        self._patcher = patch.object(Transport, "post", new=post)
+        self._patcher.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._patcher.stop()
+
+    def post(self, status: int = 200, json_data: dict | None = None, delay: float = 0) -> None:
+        """Set the response (and its delay in seconds) for the next requests"""
+
+        self._status = status
+        self._delay = delay
+        self._content = json.dumps(json_data if json_data is not None else {}).encode("utf-8")
+
+    def reset(self) -> None:
+        self.request_history = []
+
+    @property
+    def called(self) -> bool:
+        return len(self.request_history) > 0
+
+    @property
+    def call_count(self) -> int:
+        return len(self.request_history)
+
+    @property
+    def last_request(self) -> MockRequest | None:
+        return self.request_history[-1] if self.request_history else None
@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from sonofflan.devices.command import CommandQueue, CommandResult
+
+
+class Sender:
+    def __init__(self, delay: float = 0.01) -> None:
+        self.delay = delay
+        self.sent = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, url: str, data: str | dict) -> CommandResult:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        self.sent.append((url, data))
+        await asyncio.sleep(self.delay)
+        self.running -= 1
+        if data == "fail":
+            raise RuntimeError("failure")
+        return CommandResult(status=200, error=0, rtt=self.delay, data={"data": data})
+
+
+@pytest.mark.asyncio
+async def test_order():
+    sender = Sender()
+    queue = CommandQueue(sender)
+    futures = [queue.put("/path", str(x)) for x in range(5)]
+    assert queue.pending == 5
+
+    results = await asyncio.gather(*futures)
+
+    assert sender.sent == [("/path", str(x)) for x in range(5)]
+    assert sender.max_running == 1
+    assert [x.data["data"] for x in results] == [str(x) for x in range(5)]
+    assert queue.pending == 0
+    assert queue.coalesced == 0
+
+
+@pytest.mark.asyncio
+async def test_coalesce():
+    sender = Sender()
+    queue = CommandQueue(sender)
+    first = queue.put("/switch", "on", key="switch")  # Sent immediately
+    await asyncio.sleep(0)
+    futures = [
+        queue.put("/switch", "off", key="switch"),
+        queue.put("/other", "other"),
+        queue.put("/switch", "on", key="switch"),
+        queue.put("/switch", "off", key="switch"),
+    ]
+
+    results = await asyncio.gather(first, *futures)
+
+    assert sender.sent == [("/switch", "on"), ("/other", "other"), ("/switch", "off")]
+    assert queue.coalesced == 2
+    assert results[0].data["data"] == "on"
+    assert results[1] is results[3] is results[4]
+    assert results[1].data["data"] == "off"
+    assert results[2].data["data"] == "other"
+
+
+@pytest.mark.asyncio
+async def test_exception():
+    sender = Sender()
+    queue = CommandQueue(sender)
+    failed = queue.put("/path", "fail")
+    succeeded = queue.put("/path", "ok")
+
+    result = await failed
+    assert result.ok is False
+    assert isinstance(result.exception, RuntimeError)
+    result = await succeeded
+    assert result.ok is True
+
+
+@pytest.mark.asyncio
+async def test_withdraw():
+    sender = Sender()
+    queue = CommandQueue(sender)
+    first = queue.put("/path", "first")  # Sent immediately
+    await asyncio.sleep(0)
+    withdrawn = queue.put("/path", "withdrawn")
+    shared = [queue.put("/switch", "on", key="switch"), queue.put("/switch", "off", key="switch")]
+    last = queue.put("/path", "last")
+
+    withdrawn.cancel()
+    shared[0].cancel()  # The other caller still waits for the command
+    first.cancel()  # Already being sent
+    result = await last
+    assert result.ok is True
+    assert (await shared[1]).data["data"] == "off"
+
+    assert sender.sent == [("/path", "first"), ("/switch", "off"), ("/path", "last")]
+    assert queue.withdrawn == 1
+
+
+@pytest.mark.asyncio
+async def test_merge():
+    def merger(url: str, data: str | dict, other: str | dict) -> str | dict | None:
+        if url != "/merge":
+            return None
+        return data + other
+
+    sender = Sender()
+    queue = CommandQueue(sender, merger=merger)
+    futures = [
+        queue.put("/merge", "a"),
+        queue.put("/merge", "b"),
+        queue.put("/other", "c"),
+        queue.put("/other", "d"),
+        queue.put("/merge", "e"),
+    ]
+
+    results = await asyncio.gather(*futures)
+
+    assert sender.sent == [("/merge", "ab"), ("/other", "c"), ("/other", "d"), ("/merge", "e")]
+    assert queue.merged == 1
+    assert results[0] is results[1]
@@ -1,13 +1,16 @@
 import asyncio
 import json
+from unittest.mock import Mock
 
 import pytest
-import requests_mock
 
 from sonofflan.config import DeviceConfig
 from sonofflan.crypto import decrypt, encrypt, generate_iv
 from sonofflan.devices.device import Device
-from tests import get_and_wait
+from sonofflan.errors import CircuitOpenError, CommandError, DeviceOfflineError, PoolTimeoutError
+from sonofflan.retry import CircuitBreaker, RetryPolicy, RttEstimator
+from sonofflan.transport import Response, Transport
+from tests import TransportMock, get_and_wait
 
 
 def test_create():
@@ -79,6 +82,84 @@ def test_update():
     assert dev.last_update < after_update  # type: ignore
 
 
+def test_update_address():
+    dev = Device(
+        {
+            "id": "1234",
+            "type": "device_type",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {},
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+    dev.transport = Mock(spec=Transport)
+
+    dev.update({
+        "id": "1234",
+        "type": "device_type",
+        "address": "address",
+        "port": 123,
+        "encrypt": False,
+        "data": {},
+    })
+    dev.transport.evict.assert_not_called()
+
+    dev.update({
+        "id": "1234",
+        "type": "device_type",
+        "address": "new_address",
+        "port": 123,
+        "encrypt": False,
+        "data": {},
+    })
+    dev.transport.evict.assert_called_once_with("http://address:123")
+    assert dev.url == "http://new_address:123"
+
+
+def test_update_addresses():
+    dev = Device(
+        {
+            "id": "1234",
+            "type": "device_type",
+            "address": "192.168.1.10",
+            "addresses": ["192.168.1.10", "fe80::1"],
+            "port": 8081,
+            "encrypt": False,
+            "data": {},
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+    dev.transport = Mock(spec=Transport)
+    assert dev.url == "http://192.168.1.10:8081"
+    assert dev.urls == ["http://192.168.1.10:8081", "http://[fe80::1]:8081"]
+
+    # The IPv4 address is gone: its connections are evicted
+    dev.update({
+        "id": "1234",
+        "type": "device_type",
+        "address": "fe80::1",
+        "addresses": ["fe80::1"],
+        "port": 8081,
+        "encrypt": False,
+        "data": {},
+    })
+    dev.transport.evict.assert_called_once_with("http://192.168.1.10:8081")
+    assert dev.url == "http://[fe80::1]:8081"
+    assert dev.urls == ["http://[fe80::1]:8081"]
+
+
 @pytest.mark.asyncio
 async def test_send():
     dev = Device(
@@ -98,8 +179,8 @@ async def test_send():
         )
     )
 
-    with requests_mock.Mocker() as m:
-        m.post(requests_mock.ANY, json={"error": 0})
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
         dev._send("/command/path", {"parameter": "value"})
 
         await asyncio.sleep(1)
@@ -141,8 +222,8 @@ async def test_send_crypto():
         )
     )
 
-    with requests_mock.Mocker() as m:
-        m.post(requests_mock.ANY, json={"error": 0})
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
         dev._send("/command/path", {"parameter": "value"})
 
         await asyncio.sleep(1)
@@ -162,3 +243,337 @@ async def test_send_crypto():
     assert "iv" in data
     iv = data["iv"]
     assert json.loads(decrypt(data["data"], iv, dev_key)) == {"parameter": "value"}
+
+
+@pytest.mark.asyncio
+async def test_send_result():
+    dev = Device(
+        {
+            "id": "1234",
+            "type": "device_type",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {},
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+
+    with TransportMock() as m:
+        m.post(json_data={"seq": 1, "error": 0})
+        result = await dev._send("/command/path", {"parameter": "value"})
+
+    assert result.ok is True
+    assert result.status == 200
+    assert result.error == 0
+    assert result.rtt >= 0
+    assert result.data == {"seq": 1, "error": 0}
+    assert result.exception is None
+
+    with TransportMock() as m:
+        m.post(json_data={"seq": 2, "error": 400})
+        result = await dev._send("/command/path", {"parameter": "value"})
+
+    assert result.ok is False
+    assert result.status == 200
+    assert result.error == 400
+    assert isinstance(result.exception, CommandError)
+
+    with TransportMock() as m:
+        m.post(status=500)
+        result = await dev._send("/command/path", {"parameter": "value"})
+
+    assert result.ok is False
+    assert result.status == 500
+    assert result.error is None
+    assert isinstance(result.exception, CommandError)
+
+
+class FailingTransport:
+    def __init__(self, failures: int, exception: type[Exception] = ConnectionRefusedError) -> None:
+        self.failures = failures
+        self.exception = exception
+        self.calls = 0
+        self.timeouts = []
+
+    # noinspection PyUnusedLocal
+    async def post(self, url, headers, data, timeout=None) -> Response:
+        self.calls += 1
+        self.timeouts.append(timeout)
+        if self.calls <= self.failures:
+            raise self.exception()
+        return Response(200, "OK", {}, b'{"error":0}')
+
+
+@pytest.mark.asyncio
+async def test_send_retry():
+    dev = Device(
+        {
+            "id": "1234",
+            "type": "device_type",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {},
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+    dev.transport = FailingTransport(2)
+    dev.retry = RetryPolicy(attempts=3, base_delay=0.01)
+
+    result = await dev._send("/command/path", {"parameter": "value"})
+
+    assert result.ok is True
+    assert dev.transport.calls == 3
+    assert dev.circuit_breaker.state == CircuitBreaker.CLOSED
+
+    dev.transport = FailingTransport(3)
+    result = await dev._send("/command/path", {"parameter": "value"})
+
+    assert result.ok is False
+    assert isinstance(result.exception, ConnectionRefusedError)
+    assert dev.transport.calls == 3
+    assert dev.circuit_breaker.failures == 1
+
+
+@pytest.mark.asyncio
+async def test_send_circuit_breaker():
+    dev = Device(
+        {
+            "id": "1234",
+            "type": "device_type",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {},
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+    dev.transport = FailingTransport(2)
+    dev.retry = RetryPolicy(attempts=1)
+    dev.circuit_breaker = CircuitBreaker(failure_threshold=2, cooldown=0.1)
+
+    for _ in range(2):
+        result = await dev._send("/command/path", {"parameter": "value"})
+        assert isinstance(result.exception, ConnectionRefusedError)
+    assert dev.circuit_breaker.state == CircuitBreaker.OPEN
+
+    result = await dev._send("/command/path", {"parameter": "value"})
+    assert isinstance(result.exception, CircuitOpenError)
+    assert dev.transport.calls == 2
+
+    await asyncio.sleep(0.15)
+    result = await dev._send("/command/path", {"parameter": "value"})
+    assert result.ok is True
+    assert dev.circuit_breaker.state == CircuitBreaker.CLOSED
+
+
+@pytest.mark.asyncio
+async def test_send_timeout():
+    dev = Device(
+        {
+            "id": "1234",
+            "type": "device_type",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {},
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+    dev.transport = FailingTransport(1, asyncio.TimeoutError)
+    dev.retry = RetryPolicy(attempts=2, base_delay=0.01)
+    dev.rtt_estimator = RttEstimator(initial_timeout=1.0, min_timeout=0.1, max_timeout=10.0)
+    assert dev.srtt is None
+    assert dev.rttvar is None
+    assert dev.timeout == 1.0
+
+    result = await dev._send("/command/path", {"parameter": "value"})
+
+    assert result.ok is True
+    assert dev.transport.timeouts == [1.0, 2.0]  # Timeout doubled after the first attempt timed out
+    assert dev.srtt is not None
+    assert dev.rttvar is not None
+    assert dev.timeout == 0.1  # Mocked transport is very fast
+
+
+@pytest.mark.asyncio
+async def test_send_pool_timeout():
+    dev = Device(
+        {
+            "id": "1234",
+            "type": "device_type",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {},
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+    dev.transport = FailingTransport(2, lambda: PoolTimeoutError("http://address:123"))
+    dev.retry = RetryPolicy(attempts=3, base_delay=0.01)
+    dev.circuit_breaker = CircuitBreaker(failure_threshold=1, cooldown=10)
+    dev.rtt_estimator = RttEstimator(initial_timeout=1.0, min_timeout=0.1, max_timeout=10.0)
+
+    # A saturated transport is not a failure of the device: no retry, no backoff, no circuit breaker failure
+    for _ in range(2):
+        result = await dev._send("/command/path", {"parameter": "value"})
+        assert isinstance(result.exception, PoolTimeoutError)
+    assert dev.transport.calls == 2
+    assert dev.circuit_breaker.state == CircuitBreaker.CLOSED
+    assert dev.timeout == 1.0
+
+    result = await dev._send("/command/path", {"parameter": "value"})
+    assert result.ok is True
+
+
+@pytest.mark.asyncio
+async def test_send_offline():
+    dev = Device(
+        {
+            "id": "1234",
+            "type": "device_type",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {},
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+    dev.transport = FailingTransport(0)
+    assert dev.online is True
+    dev.online = False
+    assert dev.snapshot().online is False
+
+    result = await dev._send("/command/path", {"parameter": "value"})
+    assert isinstance(result.exception, DeviceOfflineError)
+    assert dev.transport.calls == 0
+
+    # Back online with the next announcement
+    dev.update(
+        {
+            "id": "1234",
+            "type": "device_type",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {},
+        }
+    )
+    assert dev.online is True
+    result = await dev._send("/command/path", {"parameter": "value"})
+    assert result.ok is True
+    assert dev.transport.calls == 1
+
+
+class RacingTransport(FailingTransport):
+    def __init__(self, failures: int, reachable: bool = True) -> None:
+        super().__init__(failures)
+        self.reachable = reachable
+        self.races = 0
+        self.urls = []
+
+    # noinspection PyUnusedLocal
+    async def connect_any(self, urls, timeout=None) -> str:
+        self.races += 1
+        if not self.reachable:
+            raise ConnectionRefusedError()
+        return urls[-1]  # The last address connects first
+
+    async def post(self, url, headers, data, timeout=None) -> Response:
+        self.urls.append(url)
+        return await super().post(url, headers, data, timeout)
+
+
+@pytest.mark.asyncio
+async def test_send_addresses():
+    dev = Device(
+        {
+            "id": "1234",
+            "type": "device_type",
+            "address": "192.168.1.10",
+            "addresses": ["192.168.1.10", "fe80::1"],
+            "port": 8081,
+            "encrypt": False,
+            "data": {},
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+    dev.transport = RacingTransport(1)
+    dev.retry = RetryPolicy(attempts=1)
+
+    # The first request fails: the addresses are raced again on the next one
+    result = await dev._send("/command/path", {"parameter": "value"})
+    assert result.ok is False
+    result = await dev._send("/command/path", {"parameter": "value"})
+    assert result.ok is True
+    result = await dev._send("/command/path", {"parameter": "value"})
+    assert result.ok is True
+
+    assert dev.transport.races == 2
+    assert dev.transport.urls == ["http://[fe80::1]:8081/command/path"] * 3
+    assert dev.url == "http://[fe80::1]:8081"
+
+
+@pytest.mark.asyncio
+async def test_send_addresses_unreachable():
+    dev = Device(
+        {
+            "id": "1234",
+            "type": "device_type",
+            "address": "192.168.1.10",
+            "addresses": ["192.168.1.10", "fe80::1"],
+            "port": 8081,
+            "encrypt": False,
+            "data": {},
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+    dev.transport = RacingTransport(0, reachable=False)
+    dev.retry = RetryPolicy(attempts=1)
+
+    # No address reachable: the request is not sent to the old address
+    result = await dev._send("/command/path", {"parameter": "value"})
+    assert isinstance(result.exception, ConnectionRefusedError)
+    assert dev.transport.races == 1
+    assert dev.transport.calls == 0
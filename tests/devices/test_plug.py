@@ -2,11 +2,10 @@ import asyncio
 import json
 
 import pytest
-import requests_mock
 
 from sonofflan.config import DeviceConfig
-from sonofflan.devices.plug import Plug
-from tests import get_and_wait
+from sonofflan.devices.plug import Plug, PlugSnapshot
+from tests import TransportMock, get_and_wait
 
 
 def test_create():
@@ -108,8 +107,8 @@ async def test_on():
         )
     )
 
-    with requests_mock.Mocker() as m:
-        m.post(requests_mock.ANY, json={"error": 0})
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
         dev.on()
 
         await asyncio.sleep(1)
@@ -149,8 +148,8 @@ async def test_off():
         )
     )
 
-    with requests_mock.Mocker() as m:
-        m.post(requests_mock.ANY, json={"error": 0})
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
         dev.off()
 
         await asyncio.sleep(1)
@@ -190,8 +189,8 @@ async def test_toggle():
         )
     )
 
-    with requests_mock.Mocker() as m:
-        m.post(requests_mock.ANY, json={"error": 0})
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
         dev.toggle()
 
         await asyncio.sleep(1)
@@ -222,8 +221,8 @@ async def test_toggle():
         },
     })
 
-    with requests_mock.Mocker() as m:
-        m.post(requests_mock.ANY, json={"error": 0})
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
         dev.toggle()
 
         await asyncio.sleep(1)
@@ -263,8 +262,8 @@ async def test_refresh():
         )
     )
 
-    with requests_mock.Mocker() as m:
-        m.post(requests_mock.ANY, json={"error": 0})
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
         dev.refresh()
 
         await asyncio.sleep(1)
@@ -295,8 +294,8 @@ async def test_refresh():
         },
     })
 
-    with requests_mock.Mocker() as m:
-        m.post(requests_mock.ANY, json={"error": 0})
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
         dev.refresh()
 
         await asyncio.sleep(1)
@@ -313,3 +312,268 @@ async def test_refresh():
     assert data["deviceid"] == "1234"
     assert data["encrypt"] is False
     assert json.loads(data["data"]) == {"switch": "off"}
+
+
+@pytest.mark.asyncio
+async def test_coalesce():
+    dev = Plug(
+        {
+            "id": "1234",
+            "type": "plug",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switch": "off",
+            },
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
+        results = await asyncio.gather(dev.on(), dev.off(), dev.on())
+
+    assert m.call_count == 1
+    data = json.loads(m.last_request.text)
+    assert json.loads(data["data"]) == {"switch": "on"}
+    assert all(x.ok for x in results)
+
+
+@pytest.mark.asyncio
+async def test_optimistic():
+    dev = Plug(
+        {
+            "id": "1234",
+            "type": "plug",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switch": "off",
+            },
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+                "optimistic": True,
+            }
+        )
+    )
+    assert dev.optimistic is True
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
+        future = dev.on()
+        assert dev.status is True
+        assert dev.pending is True
+
+        # Stale announcement received while the command is in flight
+        dev.update({
+            "id": "1234",
+            "type": "plug",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switch": "off",
+            },
+        })
+        assert dev.status is True
+        assert dev.pending is True
+
+        # Toggle uses the optimistic status
+        dev.toggle()
+        assert dev.status is False
+
+        await future
+        assert dev.pending is False  # Settled by the coalesced command
+        await asyncio.sleep(0.1)
+
+    assert dev.status is False
+    assert dev.pending is False
+    assert m.call_count == 1  # "on" and "off" coalesced
+    data = json.loads(m.last_request.text)
+    assert json.loads(data["data"]) == {"switch": "off"}
+
+
+@pytest.mark.asyncio
+async def test_optimistic_rollback():
+    dev = Plug(
+        {
+            "id": "1234",
+            "type": "plug",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switch": "off",
+            },
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+                "optimistic": True,
+            }
+        )
+    )
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 400})
+        future = dev.on()
+        assert dev.status is True
+        result = await future
+
+    assert result.ok is False
+    assert dev.status is False
+    assert dev.pending is False
+
+
+@pytest.mark.asyncio
+async def test_optimistic_cancelled():
+    dev = Plug(
+        {
+            "id": "1234",
+            "type": "plug",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switch": "off",
+            },
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+                "optimistic": True,
+            }
+        )
+    )
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 0}, delay=0.05)
+
+        # Cancelled while being sent: the command is applied anyway
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(dev.on(), 0.01)
+        assert dev.status is True
+        await asyncio.sleep(0.1)
+        assert dev.status is True
+        assert dev.pending is False
+        assert m.call_count == 1
+
+        # Cancelled before being sent: the command is withdrawn
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(dev.off(), 0)
+        await asyncio.sleep(0.1)
+        assert dev.status is True
+        assert dev.pending is False
+        assert m.call_count == 1
+
+        # No double toggle
+        await dev.toggle()
+        assert dev.status is False
+
+    assert m.call_count == 2
+    data = json.loads(m.last_request.text)
+    assert json.loads(data["data"]) == {"switch": "off"}
+
+
+@pytest.mark.asyncio
+async def test_optimistic_confirmed():
+    dev = Plug(
+        {
+            "id": "1234",
+            "type": "plug",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switch": "off",
+            },
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+                "optimistic": True,
+            }
+        )
+    )
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
+        future = dev.on()
+        dev.update({
+            "id": "1234",
+            "type": "plug",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switch": "on",
+            },
+        })
+        assert dev.status is True
+        assert dev.pending is False
+        await future
+
+    assert dev.status is True
+
+
+def test_snapshot():
+    dev = Plug(
+        {
+            "id": "1234",
+            "type": "plug",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switch": "on",
+            },
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+    snapshot = dev.snapshot()
+
+    assert isinstance(snapshot, PlugSnapshot)
+    assert snapshot.id == "1234"
+    assert snapshot.name == "Device 1"
+    assert snapshot.encrypt is False
+    assert snapshot.url == "http://address:123"
+    assert snapshot.last_update == dev.last_update
+    assert snapshot.status is True
+    assert snapshot.pending is False
+    assert not hasattr(snapshot, "__dict__")
+    with pytest.raises(AttributeError):
+        snapshot.status = False  # type: ignore
+
+    # The snapshot is not changed by the following updates
+    dev.update(
+        {
+            "id": "1234",
+            "type": "plug",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switch": "off",
+            },
+        }
+    )
+    assert dev.status is False
+    assert snapshot.status is True
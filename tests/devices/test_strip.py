@@ -2,11 +2,10 @@ import asyncio
 import json
 
 import pytest
-import requests_mock
 
 from sonofflan.config import DeviceConfig
-from sonofflan.devices.strip import Strip
-from tests import get_and_wait
+from sonofflan.devices.strip import Strip, StripSnapshot
+from tests import TransportMock, get_and_wait
 
 
 def test_create():
@@ -152,8 +151,8 @@ async def test_on():
         )
     )
 
-    with requests_mock.Mocker() as m:
-        m.post(requests_mock.ANY, json={"error": 0})
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
         dev.on(1)
 
         await asyncio.sleep(1)
@@ -202,8 +201,8 @@ async def test_off():
         )
     )
 
-    with requests_mock.Mocker() as m:
-        m.post(requests_mock.ANY, json={"error": 0})
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
         dev.off(1)
 
         await asyncio.sleep(1)
@@ -252,8 +251,8 @@ async def test_toggle():
         )
     )
 
-    with requests_mock.Mocker() as m:
-        m.post(requests_mock.ANY, json={"error": 0})
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
         dev.toggle(1)
 
         await asyncio.sleep(1)
@@ -293,8 +292,8 @@ async def test_toggle():
         },
     })
 
-    with requests_mock.Mocker() as m:
-        m.post(requests_mock.ANY, json={"error": 0})
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
         dev.toggle(1)
 
         await asyncio.sleep(1)
@@ -343,8 +342,8 @@ async def test_refresh():
         )
     )
 
-    with requests_mock.Mocker() as m:
-        m.post(requests_mock.ANY, json={"error": 0})
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
         dev.refresh(1)
 
         await asyncio.sleep(1)
@@ -384,8 +383,8 @@ async def test_refresh():
         },
     })
 
-    with requests_mock.Mocker() as m:
-        m.post(requests_mock.ANY, json={"error": 0})
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
         dev.refresh(1)
 
         await asyncio.sleep(1)
@@ -402,3 +401,305 @@ async def test_refresh():
     assert data["deviceid"] == "1234"
     assert data["encrypt"] is False
     assert json.loads(data["data"]) == {'switches': [{'outlet': 1, 'switch': 'on'}]}
+
+
+@pytest.mark.asyncio
+async def test_set_outlets():
+    dev = Strip(
+        {
+            "id": "1234",
+            "type": "stripe",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switches": [
+                    {
+                        "outlet": 0,
+                        "switch": "on",
+                    },
+                    {
+                        "outlet": 1,
+                        "switch": "off",
+                    },
+                    {
+                        "outlet": 2,
+                        "switch": "off",
+                    },
+                ],
+            },
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+
+    with pytest.raises(ValueError):
+        dev.set_outlets({0: True, 3: False})
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
+        result = await dev.set_outlets({0: False, 2: True})
+
+    assert result.ok is True
+    assert m.call_count == 1
+    assert m.last_request.path == "/zeroconf/switches"
+    data = json.loads(m.last_request.text)
+    assert json.loads(data["data"]) == {'switches': [{'outlet': 0, 'switch': 'off'}, {'outlet': 2, 'switch': 'on'}]}
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
+        await dev.all_on()
+
+    assert m.call_count == 1
+    data = json.loads(m.last_request.text)
+    assert json.loads(data["data"]) == {
+        'switches': [{'outlet': 0, 'switch': 'on'}, {'outlet': 1, 'switch': 'on'}, {'outlet': 2, 'switch': 'on'}]
+    }
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
+        await dev.all_off()
+
+    assert m.call_count == 1
+    data = json.loads(m.last_request.text)
+    assert json.loads(data["data"]) == {
+        'switches': [{'outlet': 0, 'switch': 'off'}, {'outlet': 1, 'switch': 'off'}, {'outlet': 2, 'switch': 'off'}]
+    }
+
+
+@pytest.mark.asyncio
+async def test_merge():
+    dev = Strip(
+        {
+            "id": "1234",
+            "type": "stripe",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switches": [
+                    {
+                        "outlet": 0,
+                        "switch": "on",
+                    },
+                    {
+                        "outlet": 1,
+                        "switch": "off",
+                    },
+                    {
+                        "outlet": 2,
+                        "switch": "off",
+                    },
+                ],
+            },
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
+        results = await asyncio.gather(dev.on(1), dev.off(0), dev.set_outlets({2: True, 1: False}), dev.on(0))
+
+    assert all(x.ok for x in results)
+    assert m.call_count == 1
+    data = json.loads(m.last_request.text)
+    assert json.loads(data["data"]) == {
+        'switches': [{'outlet': 1, 'switch': 'off'}, {'outlet': 2, 'switch': 'on'}, {'outlet': 0, 'switch': 'on'}]
+    }
+
+
+@pytest.mark.asyncio
+async def test_optimistic():
+    dev = Strip(
+        {
+            "id": "1234",
+            "type": "stripe",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switches": [
+                    {
+                        "outlet": 0,
+                        "switch": "on",
+                    },
+                    {
+                        "outlet": 1,
+                        "switch": "off",
+                    },
+                ],
+            },
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+                "optimistic": True,
+            }
+        )
+    )
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
+        future = dev.set_outlets({0: False, 1: True})
+        assert dev.status(0) is False
+        assert dev.status(1) is True
+        assert dev.pending_outlets == [0, 1]
+
+        # Announcement confirming only outlet 1
+        dev.update({
+            "id": "1234",
+            "type": "stripe",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switches": [
+                    {
+                        "outlet": 0,
+                        "switch": "on",
+                    },
+                    {
+                        "outlet": 1,
+                        "switch": "on",
+                    },
+                ],
+            },
+        })
+        assert dev.status(0) is False
+        assert dev.status(1) is True
+        assert dev.pending_outlets == [0]
+
+        await future
+
+    assert dev.pending_outlets == []
+    assert dev.status(0) is False
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 400})
+        future = dev.toggle(1)
+        assert dev.status(1) is False
+        await future
+
+    assert dev.pending_outlets == []
+    assert dev.status(1) is True
+
+
+@pytest.mark.asyncio
+async def test_optimistic_cancelled():
+    dev = Strip(
+        {
+            "id": "1234",
+            "type": "stripe",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switches": [
+                    {
+                        "outlet": 0,
+                        "switch": "on",
+                    },
+                    {
+                        "outlet": 1,
+                        "switch": "off",
+                    },
+                ],
+            },
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+                "optimistic": True,
+            }
+        )
+    )
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 0}, delay=0.05)
+
+        # Cancelled while being sent: the command is applied anyway
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(dev.on(1), 0.01)
+        await asyncio.sleep(0.1)
+        assert dev.status(1) is True
+        assert dev.pending_outlets == []
+
+        # Cancelled before being sent: the command is withdrawn
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(dev.off(0), 0)
+        await asyncio.sleep(0.1)
+        assert dev.status(0) is True
+        assert dev.pending_outlets == []
+
+    assert m.call_count == 1
+
+    dev = Strip(
+        {
+            "id": "1234",
+            "type": "strip",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switches": [
+                    {
+                        "outlet": 0,
+                        "switch": "on",
+                    },
+                    {
+                        "outlet": 1,
+                        "switch": "off",
+                    },
+                ],
+            },
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+    snapshot = dev.snapshot()
+
+    assert isinstance(snapshot, StripSnapshot)
+    assert snapshot.id == "1234"
+    assert snapshot.url == "http://address:123"
+    assert snapshot.outlets == [0, 1]
+    assert snapshot.status(0) is True
+    assert snapshot.status(1) is False
+    assert snapshot.pending_outlets == []
+    with pytest.raises(ValueError):
+        snapshot.status(2)
+
+    # The snapshot is not changed by the following updates
+    dev.update(
+        {
+            "id": "1234",
+            "type": "strip",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switches": [
+                    {
+                        "outlet": 0,
+                        "switch": "off",
+                    },
+                ],
+            },
+        }
+    )
+    assert dev.status(0) is False
+    assert snapshot.status(0) is True
@@ -1,6 +1,9 @@
+import pytest
+
 from sonofflan.config import DeviceConfig
 from sonofflan.devices.thermoplug import ThermoPlug
-from tests import get_and_wait
+from sonofflan.errors import CommandError
+from tests import TransportMock, get_and_wait
 
 
 def test_create():
@@ -100,3 +103,37 @@ def test_update():
     assert dev.sensor == "Sensor Type"
     assert dev.temperature == 21.57
     assert dev.humidity == 63
+
+
+@pytest.mark.asyncio
+async def test_on_not_normal():
+    dev = ThermoPlug(
+        {
+            "id": "1234",
+            "type": "th_plug",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "deviceType": "temperature",
+                "switch": "off",
+                "sensorType": "Sensor Type",
+                "currentTemperature": "20.00",
+                "currentHumidity": "55",
+            },
+        },
+        DeviceConfig(
+            {
+                "id": "1234",
+                "name": "Device 1",
+            }
+        )
+    )
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
+        result = await dev.on()
+
+    assert not m.called
+    assert result.ok is False
+    assert isinstance(result.exception, CommandError)
@@ -0,0 +1,59 @@
+from benchmarks.microbench import (
+    BenchmarkResult,
+    PAYLOADS,
+    benchmarks,
+    compare,
+    load_baseline,
+    main,
+    run_benchmarks,
+    save_baseline
+)
+
+
+def test_benchmarks():
+    names = benchmarks().keys()
+    assert "generate_iv" in names
+    for payload in PAYLOADS:
+        assert f"encrypt/{payload}" in names
+        assert f"decrypt/{payload}" in names
+        assert f"decode/{payload}" in names
+        assert f"decode_plain/{payload}" in names
+
+    # All the benchmarks work
+    for func in benchmarks().values():
+        func()
+
+
+def test_run_benchmarks():
+    results = run_benchmarks("strip", min_time=0.01)
+    assert [x.name for x in results] == ["encrypt/strip", "decrypt/strip", "decode/strip", "decode_plain/strip"]
+    for result in results:
+        assert result.ops > 0
+        assert result.allocated > 0
+
+
+def test_compare():
+    baseline = [BenchmarkResult("decode/plug", 1000, 1000), BenchmarkResult("decode/strip", 1000, 1000)]
+
+    assert compare([BenchmarkResult("decode/plug", 900, 1100)], baseline) == []
+    assert compare([BenchmarkResult("decode/new", 1, 1000000)], baseline) == []
+    regressions = compare([BenchmarkResult("decode/plug", 700, 1000), BenchmarkResult("decode/strip", 1000, 1500)],
+                          baseline)
+    assert len(regressions) == 2
+    assert regressions[0].startswith("decode/plug:")
+    assert regressions[1].startswith("decode/strip:")
+
+
+def test_baseline(tmp_path):
+    path = str(tmp_path / "baseline.json")
+    save_baseline([BenchmarkResult("decode/plug", 1000.5, 1234)], path)
+
+    baseline = load_baseline(path)
+    assert len(baseline) == 1
+    assert baseline[0].name == "decode/plug"
+    assert baseline[0].ops == 1000.5
+    assert baseline[0].allocated == 1234
+
+    assert main(["-k", "generate_iv", "-t", "0.01", "--compare", path]) == 0
+    save_baseline([BenchmarkResult("generate_iv", 1e12, 0)], path)
+    assert main(["-k", "generate_iv", "-t", "0.01", "--compare", path]) == 1
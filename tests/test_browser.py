@@ -1,6 +1,7 @@
 import asyncio
 import json
 import logging
+import time
 from unittest.mock import AsyncMock
 
 import pytest
@@ -10,7 +11,10 @@ from zeroconf import ServiceInfo, ServiceStateChange
 from sonofflan.browser import Browser
 from sonofflan.config import DevicesConfig
 from sonofflan.crypto import encrypt, generate_iv
-from sonofflan.devices import Plug, PowerPlug
+from sonofflan.devices import Plug, PowerPlug, PowerPlugSnapshot
+from sonofflan.errors import DeviceOfflineError
+from sonofflan.registry import Registry
+from tests import TransportMock
 
 dev2key = "abcdefgh-ijkl-mnop-qrst-uvwxyz012345"
 config = DevicesConfig([
@@ -32,16 +36,25 @@ class AsyncZeroconfMock(AsyncMock):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self.zeroconf = None
+        self.switches = {"1234": "on", "5678": "on"}
+        self.queried = []
+        self.delay = 0
+        self.addresses = [bytes([1, 2, 3, 4])]
+        self.interface_index = None
 
     # noinspection PyMethodMayBeStatic
     async def async_get_service_info(self, service_type: str, name: str) -> ServiceInfo:
         assert name.endswith("." + service_type)
+        self.queried.append(name)
+        switches = dict(self.switches)
+        if self.delay:
+            await asyncio.sleep(self.delay)
         device_id = name[:-(len(service_type) + 1)]
         if device_id.startswith("eWeLink_"):
             device_id = device_id[8:]
         if device_id == "1234":
             data = {
-                "switch": "on",
+                "switch": switches["1234"],
             }
             prop = {
                 b"id": b"1234",
@@ -51,7 +64,7 @@ class AsyncZeroconfMock(AsyncMock):
         elif device_id == "5678":
             iv = generate_iv()
             data = {
-                "switch": "on",
+                "switch": switches["5678"],
                 "voltage": 220.00,
                 "current": 5.00,
                 "power": 1100.00,
@@ -68,7 +81,8 @@ class AsyncZeroconfMock(AsyncMock):
         return ServiceInfo(
             type_=service_type,
             name=name,
-            addresses=[bytes([1, 2, 3, 4])],
+            addresses=self.addresses,
+            interface_index=self.interface_index,
             port=8181,
             properties=prop
         )
@@ -123,6 +137,30 @@ async def test_add(class_mocker):
     assert dev.status is True
 
 
+@pytest.mark.asyncio
+async def test_add_ipv6(class_mocker):
+    class_mocker.patch('sonofflan.browser.AsyncZeroconf', new=AsyncZeroconfMock)
+    class_mocker.patch('sonofflan.browser.AsyncServiceBrowser', new=AsyncServiceBrowserMock)
+
+    browser = Browser(config)
+    browser._zeroconf.addresses = [bytes([0xfe, 0x80] + [0] * 13 + [1]), bytes([1, 2, 3, 4])]
+    browser._zeroconf.interface_index = 2
+    # noinspection PyTypeChecker
+    browser._update(
+        zeroconf=None,
+        service_type="_ewelink._tcp.local.",
+        name="eWeLink_1234._ewelink._tcp.local.",
+        state_change=ServiceStateChange.Added
+    )
+    await asyncio.sleep(1)
+    await browser.shutdown()
+
+    dev = browser.devices["1234"]
+    assert dev.url == "http://1.2.3.4:8181"  # IPv4 first
+    assert dev.urls == ["http://1.2.3.4:8181", "http://[fe80::1%2]:8181"]  # Link-local: scope kept
+    assert isinstance(dev, Plug)
+
+
 @pytest.mark.asyncio
 async def test_add_two(class_mocker):
     class_mocker.patch('sonofflan.browser.AsyncZeroconf', new=AsyncZeroconfMock)
@@ -201,6 +239,8 @@ async def test_queue(class_mocker):
         name="eWeLink_5678._ewelink._tcp.local.",
         state_change=ServiceStateChange.Added
     )
+    await asyncio.sleep(0.1)
+    browser._zeroconf.switches["1234"] = "off"  # Unchanged announcements are skipped
     # noinspection PyTypeChecker
     browser._update(
         zeroconf=None,
@@ -211,7 +251,7 @@ async def test_queue(class_mocker):
 
     # Wait for all events processed
     await asyncio.sleep(1)
-    await browser._queue.join()
+    await browser.event_queue.join()
     task.cancel()
     await browser.shutdown()
 
@@ -219,15 +259,442 @@ async def test_queue(class_mocker):
     for ev in events:
         logger.info(f"  {ev.action.name} for {ev.device}")
     assert len(events) == 3
-    event = events.pop(0)
+    # Encrypted devices are decoded in the executor: the order is kept only for the same device
+    events_1234 = [x for x in events if x.device.id == "1234"]
+    events_5678 = [x for x in events if x.device.id == "5678"]
+    assert len(events_1234) == 2
+    assert len(events_5678) == 1
+    event = events_1234.pop(0)
     assert event.action == ServiceStateChange.Added
     assert event.device.id == "1234"
     assert event.device is not browser.devices["1234"]  # Check that it was copied
-    event = events.pop(0)
+    event = events_5678.pop(0)
     assert event.action == ServiceStateChange.Added
     assert event.device.id == "5678"
     assert event.device is not browser.devices["5678"]  # Check that it was copied
-    event = events.pop(0)
+    assert isinstance(event.device, PowerPlugSnapshot)
+    assert event.device.power == 1100.00
+    event = events_1234.pop(0)
     assert event.action == ServiceStateChange.Updated
     assert event.device.id == "1234"
     assert event.device is not browser.devices["1234"]  # Check that it was copied
+
+
+@pytest.mark.asyncio
+async def test_send_and_confirm(class_mocker):
+    class_mocker.patch('sonofflan.browser.AsyncZeroconf', new=AsyncZeroconfMock)
+    class_mocker.patch('sonofflan.browser.AsyncServiceBrowser', new=AsyncServiceBrowserMock)
+
+    browser = Browser(config)
+    # noinspection PyTypeChecker
+    browser._update(
+        zeroconf=None,
+        service_type="_ewelink._tcp.local.",
+        name="eWeLink_1234._ewelink._tcp.local.",
+        state_change=ServiceStateChange.Added
+    )
+    await asyncio.sleep(0.1)
+    assert browser.devices["1234"].status is True
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 0})
+        task = asyncio.create_task(browser.send_and_confirm("1234", "toggle", timeout=2))
+        await asyncio.sleep(0.1)
+        assert m.call_count == 1
+        assert not task.done()
+
+        # The device announces the new status
+        browser._zeroconf.switches["1234"] = "off"
+        # noinspection PyTypeChecker
+        browser._update(
+            zeroconf=None,
+            service_type="_ewelink._tcp.local.",
+            name="eWeLink_1234._ewelink._tcp.local.",
+            state_change=ServiceStateChange.Updated
+        )
+        result = await task
+
+        assert result.ok is True
+        assert browser.devices["1234"].status is False
+        data = json.loads(m.last_request.text)
+        assert json.loads(data["data"]) == {"switch": "off"}
+
+        # The device never announces the new status
+        with pytest.raises(asyncio.TimeoutError):
+            await browser.send_and_confirm("1234", "on", timeout=0.2)
+
+        # Command to the current status: confirmed at once (the device announces nothing new)
+        result = await browser.send_and_confirm("1234", "off", timeout=2)
+        assert result.ok is True
+
+    assert len(browser._waiters) == 0
+    await browser.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_send_and_confirm_optimistic(class_mocker):
+    class_mocker.patch('sonofflan.browser.AsyncZeroconf', new=AsyncZeroconfMock)
+    class_mocker.patch('sonofflan.browser.AsyncServiceBrowser', new=AsyncServiceBrowserMock)
+
+    browser = Browser(DevicesConfig([{"id": "1234", "name": "Device 1", "optimistic": True}]))
+    browser._zeroconf.switches["1234"] = "off"
+    # noinspection PyTypeChecker
+    browser._update(
+        zeroconf=None,
+        service_type="_ewelink._tcp.local.",
+        name="eWeLink_1234._ewelink._tcp.local.",
+        state_change=ServiceStateChange.Added
+    )
+    await asyncio.sleep(0.1)
+
+    with TransportMock() as m:
+        m.post(json_data={"error": 0}, delay=0.3)
+        task = asyncio.create_task(browser.send_and_confirm("1234", "on", timeout=2))
+        await asyncio.sleep(0.1)
+        assert browser.devices["1234"].status is True  # Optimistic
+
+        # Announcement contradicting the command while it is in flight: not a confirmation
+        # noinspection PyTypeChecker
+        browser._update(
+            zeroconf=None,
+            service_type="_ewelink._tcp.local.",
+            name="eWeLink_1234._ewelink._tcp.local.",
+            state_change=ServiceStateChange.Updated
+        )
+        await asyncio.sleep(0.4)
+        assert browser.devices["1234"].status is True  # Still pending
+        assert browser.devices["1234"].announced_status is False
+        assert not task.done()
+
+        # The device announces the new status
+        browser._zeroconf.switches["1234"] = "on"
+        # noinspection PyTypeChecker
+        browser._update(
+            zeroconf=None,
+            service_type="_ewelink._tcp.local.",
+            name="eWeLink_1234._ewelink._tcp.local.",
+            state_change=ServiceStateChange.Updated
+        )
+        result = await task
+
+    assert result.ok is True
+    assert browser.devices["1234"].announced_status is True
+    await browser.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_skip_unchanged(class_mocker):
+    class_mocker.patch('sonofflan.browser.AsyncZeroconf', new=AsyncZeroconfMock)
+    class_mocker.patch('sonofflan.browser.AsyncServiceBrowser', new=AsyncServiceBrowserMock)
+
+    browser = Browser(config)
+    for state_change in [ServiceStateChange.Added, ServiceStateChange.Updated, ServiceStateChange.Updated]:
+        # noinspection PyTypeChecker
+        browser._update(
+            zeroconf=None,
+            service_type="_ewelink._tcp.local.",
+            name="eWeLink_1234._ewelink._tcp.local.",
+            state_change=state_change
+        )
+        await asyncio.sleep(0.1)
+
+    assert browser.skipped == 2
+    assert browser.event_queue.depth == 1
+    assert browser.devices["1234"].status is True
+
+    # The device announces a new status
+    browser._zeroconf.switches["1234"] = "off"
+    # noinspection PyTypeChecker
+    browser._update(
+        zeroconf=None,
+        service_type="_ewelink._tcp.local.",
+        name="eWeLink_1234._ewelink._tcp.local.",
+        state_change=ServiceStateChange.Updated
+    )
+    await asyncio.sleep(0.1)
+
+    assert browser.skipped == 2
+    assert browser.devices["1234"].status is False
+
+    # The new status replaced the one queued for the device
+    assert browser.event_queue.depth == 1
+    assert browser.event_queue.coalesced == 1
+    event = await browser.wait_event()
+    assert event.action == ServiceStateChange.Added
+    assert event.device.status is False
+    browser.event_processed()
+
+    # A skipped announcement still wakes up the waiters
+    task = asyncio.create_task(browser.wait_update("1234", lambda x: x.status is False, timeout=2))
+    await asyncio.sleep(0)
+    # noinspection PyTypeChecker
+    browser._update(
+        zeroconf=None,
+        service_type="_ewelink._tcp.local.",
+        name="eWeLink_1234._ewelink._tcp.local.",
+        state_change=ServiceStateChange.Updated
+    )
+    assert await task is browser.devices["1234"]
+    assert browser.skipped == 3
+    await browser.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_subscribe(class_mocker):
+    class_mocker.patch('sonofflan.browser.AsyncZeroconf', new=AsyncZeroconfMock)
+    class_mocker.patch('sonofflan.browser.AsyncServiceBrowser', new=AsyncServiceBrowserMock)
+
+    browser = Browser(config)
+    plugs = browser.subscribe(types=[Plug])
+    power_plugs = browser.subscribe(types=[PowerPlug])
+    device_1 = browser.subscribe(ids=["1234"], actions=[ServiceStateChange.Added])
+
+    for name in ["eWeLink_1234._ewelink._tcp.local.", "eWeLink_5678._ewelink._tcp.local."]:
+        # noinspection PyTypeChecker
+        browser._update(
+            zeroconf=None,
+            service_type="_ewelink._tcp.local.",
+            name=name,
+            state_change=ServiceStateChange.Added
+        )
+    await asyncio.sleep(0.5)
+    await browser.shutdown()
+
+    assert sorted([x.device.id async for x in plugs]) == ["1234", "5678"]
+    events = [x async for x in power_plugs]
+    assert len(events) == 1
+    assert events[0].device.id == "5678"
+    events = [x async for x in device_1]
+    assert len(events) == 1
+    assert events[0].device.id == "1234"
+    assert browser.event_queue.depth == 2  # The default queue gets all the events
+
+
+@pytest.mark.asyncio
+async def test_not_configured(class_mocker):
+    class_mocker.patch('sonofflan.browser.AsyncZeroconf', new=AsyncZeroconfMock)
+    class_mocker.patch('sonofflan.browser.AsyncServiceBrowser', new=AsyncServiceBrowserMock)
+
+    browser = Browser(config)
+    for state_change in [ServiceStateChange.Added, ServiceStateChange.Updated]:
+        for name in ["eWeLink_9999._ewelink._tcp.local.", "eWeLink_1234._ewelink._tcp.local."]:
+            # noinspection PyTypeChecker
+            browser._update(
+                zeroconf=None,
+                service_type="_ewelink._tcp.local.",
+                name=name,
+                state_change=state_change
+            )
+        await asyncio.sleep(0.1)
+    await browser.shutdown()
+
+    # The not configured device was never queried
+    assert browser._zeroconf.queried == ["eWeLink_1234._ewelink._tcp.local."] * 2
+    assert browser.ignored == 2
+    assert list(browser.devices.keys()) == ["1234"]
+
+
+@pytest.mark.asyncio
+async def test_superseded(class_mocker):
+    class_mocker.patch('sonofflan.browser.AsyncZeroconf', new=AsyncZeroconfMock)
+    class_mocker.patch('sonofflan.browser.AsyncServiceBrowser', new=AsyncServiceBrowserMock)
+
+    browser = Browser(config)
+    browser._zeroconf.delay = 0.2
+    # noinspection PyTypeChecker
+    browser._update(
+        zeroconf=None,
+        service_type="_ewelink._tcp.local.",
+        name="eWeLink_1234._ewelink._tcp.local.",
+        state_change=ServiceStateChange.Added
+    )
+    await asyncio.sleep(0.1)
+
+    # A newer announcement arrives while the first one is still in progress
+    browser._zeroconf.switches["1234"] = "off"
+    # noinspection PyTypeChecker
+    browser._update(
+        zeroconf=None,
+        service_type="_ewelink._tcp.local.",
+        name="eWeLink_1234._ewelink._tcp.local.",
+        state_change=ServiceStateChange.Updated
+    )
+    assert len(browser._tasks) == 1
+    await asyncio.sleep(0.5)
+
+    assert browser.superseded == 1
+    assert len(browser._tasks) == 0
+    assert browser.devices["1234"].status is False
+    event = await browser.wait_event()
+    assert event.action == ServiceStateChange.Added  # The first announcement never completed
+    assert event.device.status is False
+    assert browser.event_queue.depth == 0
+
+    # Updated superseding an Updated stays Updated
+    browser._zeroconf.switches["1234"] = "on"
+    for _ in range(2):
+        # noinspection PyTypeChecker
+        browser._update(
+            zeroconf=None,
+            service_type="_ewelink._tcp.local.",
+            name="eWeLink_1234._ewelink._tcp.local.",
+            state_change=ServiceStateChange.Updated
+        )
+    await asyncio.sleep(0.5)
+
+    assert browser.superseded == 2
+    event = await browser.wait_event()
+    assert event.action == ServiceStateChange.Updated
+    assert event.device.status is True
+    await browser.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_registry(class_mocker, tmp_path):
+    class_mocker.patch('sonofflan.browser.AsyncZeroconf', new=AsyncZeroconfMock)
+    class_mocker.patch('sonofflan.browser.AsyncServiceBrowser', new=AsyncServiceBrowserMock)
+
+    registry = Registry(str(tmp_path / "registry.json"))
+    for device_id in ["1234", "9999"]:
+        registry.record(
+            {
+                "id": device_id,
+                "type": "plug",
+                "address": "1.2.3.5",
+                "port": 8081,
+                "encrypt": False,
+                "data": {
+                    "switch": "off",
+                },
+            }
+        )
+    registry.save()
+
+    # The configured device is available immediately, but not verified
+    browser = Browser(config, registry=Registry(registry.path))
+    assert list(browser.devices.keys()) == ["1234"]
+    dev = browser.devices["1234"]
+    assert dev.verified is False
+    assert dev.url == "http://1.2.3.5:8081"
+    assert dev.status is False
+
+    # The device announces itself
+    # noinspection PyTypeChecker
+    browser._update(
+        zeroconf=None,
+        service_type="_ewelink._tcp.local.",
+        name="eWeLink_1234._ewelink._tcp.local.",
+        state_change=ServiceStateChange.Added
+    )
+    await asyncio.sleep(0.1)
+    assert browser.devices["1234"] is dev
+    assert dev.verified is True
+    assert dev.url == "http://1.2.3.4:8181"
+    assert dev.status is True
+    await browser.shutdown()
+
+    devices = {x["id"]: x for x in Registry(registry.path).load()}
+    assert devices["1234"]["address"] == "1.2.3.4"
+    assert devices["1234"]["data"] == {"switch": "on"}
+    assert devices["9999"]["address"] == "1.2.3.5"
+
+
+@pytest.mark.asyncio
+async def test_wait_for_devices(class_mocker):
+    class_mocker.patch('sonofflan.browser.AsyncZeroconf', new=AsyncZeroconfMock)
+    class_mocker.patch('sonofflan.browser.AsyncServiceBrowser', new=AsyncServiceBrowserMock)
+
+    browser = Browser(config)
+    task = asyncio.create_task(browser.wait_for_devices(["1234"], timeout=2))
+    await asyncio.sleep(0.1)
+    assert not task.done()
+
+    # noinspection PyTypeChecker
+    browser._update(
+        zeroconf=None,
+        service_type="_ewelink._tcp.local.",
+        name="eWeLink_1234._ewelink._tcp.local.",
+        state_change=ServiceStateChange.Added
+    )
+    assert await asyncio.wait_for(task, 0.5) == []
+
+    # All the configured devices
+    assert await browser.wait_for_devices(timeout=0.2) == ["5678"]
+    assert await browser.wait_for_devices(["1234"], timeout=0) == []
+
+    # No new devices for the quiet period
+    assert await browser.wait_quiet(period=0.1, timeout=1) is True
+    task = asyncio.create_task(browser.wait_quiet(period=0.3, timeout=2))
+    await asyncio.sleep(0.2)
+    # noinspection PyTypeChecker
+    browser._update(
+        zeroconf=None,
+        service_type="_ewelink._tcp.local.",
+        name="eWeLink_5678._ewelink._tcp.local.",
+        state_change=ServiceStateChange.Added
+    )
+    await asyncio.sleep(0.2)
+    assert not task.done()  # The quiet period restarted
+    assert await asyncio.wait_for(task, 0.5) is True
+    assert await browser.wait_quiet(period=1, timeout=0.1) is False
+
+    # The quiet period doesn't end before the minimum wait
+    start = time.monotonic()
+    assert await browser.wait_quiet(period=0.1, timeout=2, min_wait=0.5) is True
+    assert time.monotonic() - start >= 0.5
+    assert await browser.wait_quiet(period=0.1, timeout=0.2, min_wait=0.5) is False
+    await browser.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_offline(class_mocker):
+    class_mocker.patch('sonofflan.browser.AsyncZeroconf', new=AsyncZeroconfMock)
+    class_mocker.patch('sonofflan.browser.AsyncServiceBrowser', new=AsyncServiceBrowserMock)
+
+    browser = Browser(config, ttl=0.5)
+    events = browser.subscribe(actions=[ServiceStateChange.Removed])
+
+    def announce(state_change: ServiceStateChange):
+        # noinspection PyTypeChecker
+        browser._update(
+            zeroconf=None,
+            service_type="_ewelink._tcp.local.",
+            name="eWeLink_1234._ewelink._tcp.local.",
+            state_change=state_change
+        )
+
+    announce(ServiceStateChange.Added)
+    await asyncio.sleep(0.1)
+    dev = browser.devices["1234"]
+    assert dev.online is True
+
+    # Removed by zeroconf (without querying the device)
+    queried = len(browser._zeroconf.queried)
+    announce(ServiceStateChange.Removed)
+    await asyncio.sleep(0.1)
+    assert len(browser._zeroconf.queried) == queried
+    assert dev.online is False
+    event = await events.get()
+    assert event.device.id == "1234"
+    assert event.device.online is False
+    assert event.expired is False
+    result = await dev.on()
+    assert isinstance(result.exception, DeviceOfflineError)
+
+    # Back online with the same announcement
+    announce(ServiceStateChange.Added)
+    await asyncio.sleep(0.1)
+    assert dev.online is True
+    assert browser.skipped == 0
+
+    # Not announced before the TTL
+    await asyncio.sleep(0.2)
+    assert dev.online is True
+    await asyncio.sleep(0.4)
+    assert dev.online is False
+    event = await asyncio.wait_for(events.get(), 1)
+    assert event.action == ServiceStateChange.Removed
+    assert event.device.online is False
+    assert event.expired is True  # Not announced for the TTL
+
+    await browser.shutdown()
@@ -1,6 +1,7 @@
 import pytest
 
 from sonofflan.config import DeviceConfig, DevicesConfig
+from sonofflan.crypto import DeviceCipher
 
 
 # Tests for DeviceConfig
@@ -36,6 +37,21 @@ def test_deviceconfig_with_key():
     assert dc.key == "!£$%"
 
 
+def test_deviceconfig_optimistic():
+    dc = DeviceConfig({"id": "1234"})
+    assert dc.optimistic is False
+    dc = DeviceConfig({"id": "1234", "optimistic": True})
+    assert dc.optimistic is True
+
+
+def test_deviceconfig_cipher():
+    dc = DeviceConfig({"id": "1234"})
+    assert dc.cipher is None
+    dc = DeviceConfig({"id": "1234", "key": "!£$%"})
+    assert isinstance(dc.cipher, DeviceCipher)
+    assert dc.cipher is dc.cipher
+
+
 # Tests for DevicesConfig
 def test_devicesconfig_invalid():
     with pytest.raises(TypeError):
@@ -46,6 +62,7 @@ def test_devicesconfig_invalid():
 def test_devicesconfig_none():
     dc = DevicesConfig()
     assert dc.num_devices() == 0
+    assert dc.ids() == []
     assert dc.device("1234") is None
     assert dc.device("5678") is None
     assert dc.device("ABCD") is None
@@ -88,6 +105,7 @@ def test_devicesconfig_list():
         }
     ])
     assert dc.num_devices() == 2
+    assert dc.ids() == ["1234", "5678"]
 
     dev1 = dc.device("1234")
     assert dev1 is not None
@@ -1,4 +1,8 @@
-from sonofflan.crypto import decrypt, encrypt, generate_iv
+from base64 import b64decode, b64encode
+
+import pytest
+
+from sonofflan.crypto import DeviceCipher, decrypt, encrypt, generate_iv
 
 
 def test_cripto():
@@ -11,3 +15,38 @@ def test_cripto():
     decrypted = decrypt(encrypted, iv, key)
 
     assert plain == decrypted.decode("utf-8")
+
+
+def test_device_cipher():
+    iv = generate_iv()
+    plain = "testing text"
+    key = "testing key"
+    cipher = DeviceCipher(key)
+
+    encrypted = cipher.encrypt(plain, iv)
+    assert encrypted == encrypt(plain, iv, key)
+
+    decrypted = cipher.decrypt(encrypted, iv)
+    assert plain == decrypted.decode("utf-8")
+    assert decrypt(encrypted, iv, key) == decrypted
+    assert key not in repr(cipher)
+
+
+def test_device_cipher_bytes():
+    iv = generate_iv()
+    plain = "testing text, long enough to span more than one block"
+    key = "testing key"
+    cipher = DeviceCipher(key)
+
+    encrypted = cipher.encrypt_bytes(memoryview(plain.encode("utf-8")), iv.encode("utf-8"))
+    assert isinstance(encrypted, bytes)
+    assert encrypted.decode("utf-8") == encrypt(plain, iv, key)
+
+    decrypted = cipher.decrypt_bytes(memoryview(encrypted), iv.encode("utf-8"))
+    assert decrypted == plain.encode("utf-8")
+    assert cipher.decrypt_bytes(encrypted, iv) == decrypted
+
+    # Only the first block: "A" * 16 without the padding block
+    truncated = b64encode(b64decode(cipher.encrypt_bytes(b"A" * 16, iv))[:16])
+    with pytest.raises(ValueError):
+        cipher.decrypt_bytes(truncated, iv)
@@ -0,0 +1,66 @@
+import asyncio
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+from sonofflan.crypto import DeviceCipher, encrypt, generate_iv
+from sonofflan.decoder import BatchDecoder, decode_batch, decode_info, decode_payload
+from sonofflan.errors import InvalidResponseError
+
+key = "testing key"
+
+
+def encrypted_payload(data: dict) -> tuple[bytes, str]:
+    iv = generate_iv()
+    return encrypt(json.dumps(data), iv, key).encode("utf8"), iv
+
+
+def test_decode_payload():
+    assert decode_payload(b'{"switch":"on"}') == {"switch": "on"}
+    data, iv = encrypted_payload({"switch": "off"})
+    assert decode_payload(data, iv, DeviceCipher(key)) == {"switch": "off"}
+    assert decode_payload(memoryview(data), iv.encode("utf8"), DeviceCipher(key)) == {"switch": "off"}
+    assert decode_payload(memoryview(b'{"switch":"on"}')) == {"switch": "on"}
+
+
+def test_decode_info():
+    assert decode_info({"error": 0, "data": {"switch": "on"}}) == {"switch": "on"}
+    assert decode_info({"error": 0, "data": '{"switch":"on"}'}) == {"switch": "on"}
+    data, iv = encrypted_payload({"switch": "off"})
+    response = {"error": 0, "encrypt": True, "iv": iv, "data": data.decode("utf8")}
+    assert decode_info(response, DeviceCipher(key)) == {"switch": "off"}
+    with pytest.raises(InvalidResponseError):
+        decode_info({"error": 0})
+
+
+def test_decode_batch():
+    data, iv = encrypted_payload({"switch": "off"})
+    results = decode_batch([(b'{"switch":"on"}', None, None), (b"invalid", None, None), (data, iv, DeviceCipher(key))])
+    assert results[0] == {"switch": "on"}
+    assert isinstance(results[1], ValueError)
+    assert results[2] == {"switch": "off"}
+
+
+@pytest.mark.asyncio
+async def test_batch_decoder():
+    cipher = DeviceCipher(key)
+    payloads = [encrypted_payload({"id": x}) for x in range(50)]
+    with ThreadPoolExecutor(2) as executor:
+        decoder = BatchDecoder(executor, max_batch=16)
+        results = await asyncio.gather(*[decoder.decode(data, iv, cipher) for data, iv in payloads])
+
+    assert results == [{"id": x} for x in range(50)]
+    assert decoder.batches == 4  # All the payloads were queued before the first dispatch
+    assert decoder.pending == 0
+
+
+@pytest.mark.asyncio
+async def test_batch_decoder_process_pool():
+    cipher = DeviceCipher(key)
+    data, iv = encrypted_payload({"switch": "on"})
+    with ProcessPoolExecutor(1) as executor:
+        decoder = BatchDecoder(executor)
+        assert await decoder.decode(data, iv, cipher) == {"switch": "on"}
+        with pytest.raises(ValueError):
+            await decoder.decode(data, iv, DeviceCipher("wrong key"))
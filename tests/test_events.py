@@ -0,0 +1,126 @@
+import asyncio
+import logging
+
+import pytest
+
+from sonofflan.events import EventBus, EventQueue
+
+
+@pytest.mark.asyncio
+async def test_order():
+    queue = EventQueue()
+    queue.put("a", 1)
+    queue.put("b", 2)
+    queue.put("c", 3)
+
+    assert queue.depth == 3
+    assert [await queue.get() for _ in range(3)] == [1, 2, 3]
+    assert queue.depth == 0
+
+
+@pytest.mark.asyncio
+async def test_coalesce():
+    queue = EventQueue(merger=lambda x, y: x + y if y > 0 else None)
+    queue.put("a", 1)
+    queue.put("b", 2)
+    queue.put("a", 10)  # Merged keeping its place in the queue
+    queue.put("b", -1)  # Not merged: replaces the queued one
+
+    assert queue.depth == 2
+    assert queue.coalesced == 2
+    assert await queue.get() == 11
+    assert await queue.get() == -1
+
+
+@pytest.mark.asyncio
+async def test_drops():
+    queue = EventQueue(maxsize=2)
+    queue.put("a", 1)
+    queue.put("b", 2)
+    queue.put("c", 3)
+
+    assert queue.depth == 2
+    assert queue.drops == 1
+    assert await queue.get() == 2
+    assert await queue.get() == 3
+
+    with pytest.raises(ValueError):
+        EventQueue(maxsize=0)
+
+
+def test_drops_log(caplog):
+    queue = EventQueue(maxsize=1)
+    with caplog.at_level(logging.DEBUG, logger="sonofflan.events"):
+        for x in range(1000):
+            queue.put(x, x)
+
+    assert queue.drops == 999
+    warnings = [x for x in caplog.records if x.levelno == logging.WARNING]
+    assert len(warnings) == 1  # The next drops are logged at debug level
+
+
+@pytest.mark.asyncio
+async def test_join_and_close():
+    queue = EventQueue()
+    getter = asyncio.create_task(queue.get())
+    await asyncio.sleep(0)
+    queue.put("a", 1)
+    assert await getter == 1
+
+    joiner = asyncio.create_task(queue.join())
+    await asyncio.sleep(0)
+    assert not joiner.done()
+    queue.task_done()
+    await asyncio.wait_for(joiner, 1)
+    with pytest.raises(ValueError):
+        queue.task_done()
+
+    getter = asyncio.create_task(queue.get())
+    await asyncio.sleep(0)
+    queue.close()
+    assert await getter is None
+    queue.put("b", 2)  # Ignored
+    assert queue.depth == 0
+    assert await queue.get() is None
+
+
+class Base:
+    pass
+
+
+class Derived(Base):
+    pass
+
+
+class Other:
+    pass
+
+
+@pytest.mark.asyncio
+async def test_bus():
+    bus = EventBus()
+    everything = bus.subscribe()
+    by_id = bus.subscribe(ids=["a"])
+    by_type = bus.subscribe(types=[Base])
+    by_all = bus.subscribe(ids=["a", "b"], types=[Derived], actions=["updated"])
+    assert bus.subscriptions == 4
+
+    assert bus.publish("a", 1, Derived, "added") == 3
+    assert bus.publish("b", 2, Derived, "updated") == 3
+    assert bus.publish("c", 3, Other, "updated") == 1
+
+    assert everything.queue.depth == 3
+    assert await by_id.get() == 1
+    assert by_id.queue.depth == 0
+    assert [await by_type.get(), await by_type.get()] == [1, 2]
+    assert await by_all.get() == 2
+
+    by_id.close()
+    assert bus.subscriptions == 3
+    assert await by_id.get() is None
+    assert bus.publish("a", 4, Other, "added") == 1  # Replaces the queued event 1
+
+    bus.close()
+    assert bus.subscriptions == 0
+    assert [x async for x in everything] == [4, 2, 3]
+    assert bus.subscribe().queue.closed
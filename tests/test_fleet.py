@@ -0,0 +1,143 @@
+import asyncio
+import json
+
+import pytest
+
+from sonofflan.config import DeviceConfig
+from sonofflan.devices import Plug, Strip
+from sonofflan.errors import CommandError
+from sonofflan.fleet import fan_out
+from sonofflan.transport import Response
+
+
+class SlowTransport:
+    def __init__(self, delays: dict[str, float]) -> None:
+        self.delays = delays
+        self.running = 0
+        self.max_running = 0
+        self.requests = []
+
+    # noinspection PyUnusedLocal
+    async def post(self, url, headers, data, *args, **kwargs) -> Response:
+        device_id = json.loads(data)["deviceid"]
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.delays.get(device_id, 0.01))
+            self.requests.append(device_id)
+        finally:
+            self.running -= 1
+        return Response(200, "OK", {}, b'{"error":0}')
+
+
+def create_plug(device_id: str, transport: SlowTransport) -> Plug:
+    dev = Plug(
+        {
+            "id": device_id,
+            "type": "plug",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switch": "on",
+            },
+        },
+        DeviceConfig(
+            {
+                "id": device_id,
+            }
+        )
+    )
+    dev.transport = transport
+    return dev
+
+
+def create_strip(device_id: str, transport: SlowTransport) -> Strip:
+    dev = Strip(
+        {
+            "id": device_id,
+            "type": "strip",
+            "address": "address",
+            "port": 123,
+            "encrypt": False,
+            "data": {
+                "switches": [
+                    {
+                        "outlet": 0,
+                        "switch": "on",
+                    },
+                ],
+            },
+        },
+        DeviceConfig(
+            {
+                "id": device_id,
+            }
+        )
+    )
+    dev.transport = transport
+    return dev
+
+
+@pytest.mark.asyncio
+async def test_fan_out():
+    transport = SlowTransport({})
+    devices = {str(x): create_plug(str(x), transport) for x in range(20)}
+
+    results = await fan_out(devices, "off", limit=5)
+
+    assert len(results) == 20
+    assert all(x.ok for x in results.values())
+    assert sorted(transport.requests) == sorted(devices)
+    assert transport.max_running == 5
+
+
+@pytest.mark.asyncio
+async def test_fan_out_select():
+    transport = SlowTransport({})
+    devices = {
+        "1": create_plug("1", transport),
+        "2": create_strip("2", transport),
+        "3": create_plug("3", transport),
+    }
+
+    results = await fan_out(devices, "off", select=lambda x: isinstance(x, Plug))
+    assert set(results) == {"1", "3"}
+
+    results = await fan_out(devices.values(), "all_off")
+    assert results["2"].ok is True
+    assert isinstance(results["1"].exception, CommandError)
+
+    results = await fan_out(devices, lambda x: x.off(0) if isinstance(x, Strip) else x.off())
+    assert all(x.ok for x in results.values())
+
+
+@pytest.mark.asyncio
+async def test_fan_out_deadline():
+    transport = SlowTransport({"2": 5.0})
+    devices = {str(x): create_plug(str(x), transport) for x in range(4)}
+
+    results = await fan_out(devices, "on", deadline=0.5)
+
+    assert results["0"].ok is True
+    assert results["1"].ok is True
+    assert results["2"].ok is False
+    assert isinstance(results["2"].exception, asyncio.TimeoutError)
+    assert results["3"].ok is True
+
+
+@pytest.mark.asyncio
+async def test_fan_out_deadline_withdraw():
+    transport = SlowTransport({"1": 0.5})
+    devices = {"1": create_plug("1", transport)}
+    busy = devices["1"].on()  # Keeps the device busy past the deadline
+    await asyncio.sleep(0)
+
+    results = await fan_out(devices, "off", deadline=0.1)
+    assert isinstance(results["1"].exception, asyncio.TimeoutError)
+    assert (await busy).ok is True
+    await asyncio.sleep(0.1)
+
+    # The command waiting in the queue was never sent
+    assert transport.requests == ["1"]
+    assert devices["1"]._queue.withdrawn == 1
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from zeroconf import ServiceStateChange
+
+from sonofflan.browser import Browser
+from sonofflan.crypto import encrypt, generate_iv
+from sonofflan.poller import Poller
+from tests import TransportMock
+from tests.test_browser import AsyncServiceBrowserMock, AsyncZeroconfMock, config, dev2key
+
+
+async def create_browser() -> Browser:
+    browser = Browser(config)
+    for name in ["eWeLink_1234._ewelink._tcp.local.", "eWeLink_5678._ewelink._tcp.local."]:
+        # noinspection PyTypeChecker
+        browser._update(
+            zeroconf=None,
+            service_type="_ewelink._tcp.local.",
+            name=name,
+            state_change=ServiceStateChange.Added
+        )
+    await asyncio.sleep(0.1)
+    await browser.event_queue.get()
+    await browser.event_queue.get()
+    return browser
+
+
+@pytest.mark.asyncio
+async def test_apply_poll(class_mocker):
+    class_mocker.patch('sonofflan.browser.AsyncZeroconf', new=AsyncZeroconfMock)
+    class_mocker.patch('sonofflan.browser.AsyncServiceBrowser', new=AsyncServiceBrowserMock)
+
+    browser = await create_browser()
+    assert browser.apply_poll("1234", {"switch": "off"}) is True
+    assert browser.devices["1234"].status is False
+    event = await browser.wait_event()
+    assert event.action == ServiceStateChange.Updated
+
+    assert browser.apply_poll("9999", {"switch": "off"}) is False
+    await browser.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_poll(class_mocker):
+    class_mocker.patch('sonofflan.browser.AsyncZeroconf', new=AsyncZeroconfMock)
+    class_mocker.patch('sonofflan.browser.AsyncServiceBrowser', new=AsyncServiceBrowserMock)
+
+    browser = await create_browser()
+    poller = Poller(browser)
+    with TransportMock() as m:
+        m.post(json_data={"seq": 1, "error": 0, "data": {"switch": "off"}})
+        assert await poller.poll("1234") is True
+
+        assert m.last_request.path == "/zeroconf/info"
+        assert browser.devices["1234"].status is False
+        event = await browser.wait_event()
+        assert event.action == ServiceStateChange.Updated
+        assert event.device.status is False
+
+        # Encrypted device: the state not returned by the info is kept
+        iv = generate_iv()
+        m.post(json_data={"seq": 2, "error": 0, "encrypt": True, "iv": iv,
+                          "data": encrypt(json.dumps({"switch": "off"}), iv, dev2key)})
+        assert await poller.poll("5678") is True
+        dev = browser.devices["5678"]
+        assert dev.status is False
+        assert dev.power == 1100.00
+
+        m.post(status=500)
+        assert await poller.poll("1234") is False
+        assert await poller.poll("9999") is False
+
+    assert poller.polls == 3
+    assert poller.failures == 1
+    await browser.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_schedule(class_mocker):
+    class_mocker.patch('sonofflan.browser.AsyncZeroconf', new=AsyncZeroconfMock)
+    class_mocker.patch('sonofflan.browser.AsyncServiceBrowser', new=AsyncServiceBrowserMock)
+
+    browser = await create_browser()
+    browser._announced["1234"] = time.monotonic() - 10  # Not announcing anymore
+    browser._announced["5678"] = time.monotonic() + 10  # Announcing normally
+    poller = Poller(browser, interval=0.2, jitter=0.1, limit=1)
+    with TransportMock() as m:
+        m.post(json_data={"seq": 1, "error": 0, "data": {"switch": "off"}})
+        poller.start()
+        await asyncio.sleep(0.7)
+        await poller.stop()
+
+        assert poller.polls >= 2
+        assert poller.skipped >= 2
+        assert m.call_count == poller.polls
+        assert all(x.url.startswith(browser.devices["1234"].url) for x in m.request_history)
+        assert browser.devices["1234"].status is False
+
+    with pytest.raises(ValueError):
+        Poller(browser, interval=0)
+    await browser.shutdown()
@@ -0,0 +1,49 @@
+import json
+
+from sonofflan.registry import Registry
+
+data = {
+    "id": "1234",
+    "type": "plug",
+    "address": "1.2.3.4",
+    "port": 8081,
+    "encrypt": False,
+    "data": {
+        "switch": "on",
+    },
+}
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "registry.json")
+    registry = Registry(path)
+    assert registry.load() == []
+
+    registry.record(data)
+    registry.record(dict(data, id="5678", verified=True))
+    registry.forget("5678")
+    assert registry.num_devices == 1
+    registry.save()
+
+    registry = Registry(path)
+    devices = registry.load()
+    assert registry.num_devices == 1
+    assert devices == [dict(data, verified=False)]
+
+    # Nothing changed: the file is not written
+    (tmp_path / "registry.json").unlink()
+    registry.record(data)
+    registry.save()
+    assert not (tmp_path / "registry.json").exists()
+
+
+def test_load_invalid(tmp_path):
+    path = tmp_path / "registry.json"
+    path.write_text("invalid")
+    assert Registry(str(path)).load() == []
+
+    path.write_text(json.dumps({"version": 0, "devices": {}}))
+    assert Registry(str(path)).load() == []
+
+    path.write_text(json.dumps({"version": 1, "devices": {"5678": data}}))
+    assert Registry(str(path)).load() == []
@@ -0,0 +1,94 @@
+import time
+
+import pytest
+
+from sonofflan.retry import CircuitBreaker, RetryPolicy, RttEstimator
+
+
+def test_retry_policy():
+    with pytest.raises(ValueError):
+        RetryPolicy(attempts=0)
+
+    policy = RetryPolicy(attempts=5, base_delay=0.1, max_delay=0.3)
+    assert policy.attempts == 5
+    for _ in range(100):
+        assert 0 <= policy.delay(1) <= 0.1
+        assert 0 <= policy.delay(2) <= 0.2
+        assert 0 <= policy.delay(3) <= 0.3
+        assert 0 <= policy.delay(10) <= 0.3
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=0.05)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow() is True
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.failures == 2
+    assert breaker.allow() is False
+
+    time.sleep(0.06)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow() is True  # Probe
+    assert breaker.allow() is False  # Only one probe at a time
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.06)
+    assert breaker.allow() is True
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+    assert breaker.allow() is True
+
+
+def test_circuit_breaker_abort():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow() is True
+    assert breaker.allow() is False
+    breaker.abort()
+    assert breaker.allow() is True
+
+
+def test_rtt_estimator():
+    with pytest.raises(ValueError):
+        RttEstimator(min_timeout=2, max_timeout=1)
+
+    estimator = RttEstimator(initial_timeout=5, min_timeout=0.1, max_timeout=10)
+    assert estimator.srtt is None
+    assert estimator.rttvar is None
+    assert estimator.timeout == 5
+
+    estimator.sample(0.2)
+    assert estimator.srtt == pytest.approx(0.2)
+    assert estimator.rttvar == pytest.approx(0.1)
+    assert estimator.timeout == pytest.approx(0.6)
+
+    for _ in range(50):
+        estimator.sample(0.2)
+    assert estimator.srtt == pytest.approx(0.2)
+    assert estimator.rttvar == pytest.approx(0.0, abs=1e-6)
+    assert estimator.timeout == pytest.approx(0.2, abs=1e-5)
+
+    estimator.sample(1.0)
+    assert estimator.srtt == pytest.approx(0.3)
+    assert estimator.rttvar == pytest.approx(0.2, abs=1e-5)
+    assert estimator.timeout == pytest.approx(1.1, abs=1e-5)
+
+    estimator.backoff()
+    assert estimator.timeout == pytest.approx(2.2, abs=1e-5)
+    for _ in range(10):
+        estimator.backoff()
+    assert estimator.timeout == 10
+
+
+def test_rtt_estimator_min():
+    estimator = RttEstimator(min_timeout=0.5)
+    for _ in range(10):
+        estimator.sample(0.01)
+    assert estimator.timeout == 0.5
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+from sonofflan.staleness import StalenessTracker
+
+
+@pytest.mark.asyncio
+async def test_expire():
+    expired = []
+    tracker = StalenessTracker(0.2, expired.append)
+    tracker.touch("a")
+    tracker.touch("b")
+    tracker.touch("c")
+    assert tracker.tracked == 3
+
+    await asyncio.sleep(0.1)
+    tracker.touch("a")  # Seen again
+    tracker.remove("c")
+    await asyncio.sleep(0.15)
+    assert expired == ["b"]
+    assert tracker.tracked == 1
+
+    await asyncio.sleep(0.1)
+    assert expired == ["b", "a"]
+    assert tracker.tracked == 0
+    assert tracker._timer is None
+
+    with pytest.raises(ValueError):
+        StalenessTracker(0, expired.append)
+
+
+@pytest.mark.asyncio
+async def test_many():
+    expired = []
+    tracker = StalenessTracker(0.1, expired.append)
+    for _ in range(10):
+        for x in range(1000):
+            tracker.touch(x)
+    assert tracker.tracked == 1000
+    assert len(tracker._heap) <= 2 * 1000 + 64  # Outdated entries are compacted
+
+    await asyncio.sleep(0.2)
+    assert sorted(expired) == list(range(1000))
+
+    tracker.touch("a")
+    tracker.close()
+    await asyncio.sleep(0.2)
+    assert len(expired) == 1000
@@ -0,0 +1,282 @@
+import asyncio
+import json
+
+import pytest
+
+from sonofflan.errors import InvalidResponseError, PoolTimeoutError
+from sonofflan.transport import Transport, _build_request
+
+
+class DeviceServer:
+    """Minimal HTTP server acting as a device"""
+
+    def __init__(self, responses: list[bytes]) -> None:
+        self.responses = responses
+        self.requests = []
+        self.connections = 0
+        self.server = None
+        self.port = None
+
+    async def __aenter__(self) -> "DeviceServer":
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                break
+            lines = head.decode("latin-1").split("\r\n")
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", "0")))
+            self.requests.append((lines[0], headers, body))
+            response = self.responses.pop(0)
+            if not response:
+                break
+            writer.write(response)
+            await writer.drain()
+            if headers.get("connection") == "close" or b"Connection: close" in response:
+                break
+        writer.close()
+
+
+def http_response(body: bytes) -> bytes:
+    return b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: " + \
+        str(len(body)).encode() + b"\r\n\r\n" + body
+
+
+@pytest.mark.asyncio
+async def test_post():
+    async with DeviceServer([http_response(b'{"seq":1,"error":0}')]) as server:
+        transport = Transport()
+        response = await transport.post(
+            f"http://127.0.0.1:{server.port}/zeroconf/switch",
+            headers={"Content-Type": "application/json"},
+            data=json.dumps({"deviceid": "1234"}),
+        )
+
+    assert response.status == 200
+    assert response.headers["content-type"] == "application/json"
+    assert response.json() == {"seq": 1, "error": 0}
+    assert len(server.requests) == 1
+    request_line, headers, body = server.requests[0]
+    assert request_line == "POST /zeroconf/switch HTTP/1.1"
+    assert headers["host"] == f"127.0.0.1:{server.port}"
+    assert headers["content-type"] == "application/json"
+    assert json.loads(body) == {"deviceid": "1234"}
+
+
+@pytest.mark.asyncio
+async def test_post_chunked():
+    response = b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n" \
+               b"5\r\n{\"err\r\n8\r\nor\":0}\r\n\r\n0\r\n\r\n"
+    async with DeviceServer([response]) as server:
+        response = await Transport().post(f"http://127.0.0.1:{server.port}/zeroconf/info", {}, "{}")
+
+    assert response.status == 200
+    assert response.json() == {"error": 0}
+
+
+@pytest.mark.asyncio
+async def test_post_no_response():
+    async with DeviceServer([b""]) as server:
+        with pytest.raises(InvalidResponseError):
+            await Transport().post(f"http://127.0.0.1:{server.port}/zeroconf/info", {}, "{}")
+
+
+@pytest.mark.asyncio
+async def test_post_timeout():
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await asyncio.sleep(10)
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            await Transport(timeout=0.1).post(f"http://127.0.0.1:{port}/zeroconf/info", {}, "{}")
+    finally:
+        server.close()
+
+
+@pytest.mark.asyncio
+async def test_post_invalid_url():
+    with pytest.raises(ValueError):
+        await Transport().post("https://127.0.0.1/zeroconf/info", {}, "{}")
+
+
+@pytest.mark.asyncio
+async def test_keep_alive():
+    responses = [http_response(b'{"error":0}') for _ in range(3)]
+    async with DeviceServer(responses) as server:
+        transport = Transport()
+        url = f"http://127.0.0.1:{server.port}/zeroconf/switch"
+        for _ in range(3):
+            response = await transport.post(url, {}, "{}")
+            assert response.json() == {"error": 0}
+        assert transport.open_connections == 1
+        assert transport.idle_connections == 1
+        await transport.close()
+
+    assert len(server.requests) == 3
+    assert server.requests[0][1]["connection"] == "keep-alive"
+    assert server.connections == 1
+    assert transport.open_connections == 0
+
+
+@pytest.mark.asyncio
+async def test_keep_alive_disabled():
+    responses = [http_response(b'{"error":0}') for _ in range(2)]
+    async with DeviceServer(responses) as server:
+        transport = Transport(max_idle_per_host=0)
+        url = f"http://127.0.0.1:{server.port}/zeroconf/switch"
+        await transport.post(url, {}, "{}")
+        await transport.post(url, {}, "{}")
+
+    assert server.requests[0][1]["connection"] == "close"
+    assert server.connections == 2
+    assert transport.open_connections == 0
+
+
+@pytest.mark.asyncio
+async def test_stale_connection():
+    responses = [
+        b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}",
+        b"",  # The device drops the idle connection
+        http_response(b'{"error":0}'),
+    ]
+    async with DeviceServer(responses) as server:
+        transport = Transport()
+        url = f"http://127.0.0.1:{server.port}/zeroconf/switch"
+        await transport.post(url, {}, "{}")
+        response = await transport.post(url, {}, "{}")
+        await transport.close()
+
+    assert response.json() == {"error": 0}
+    assert server.connections == 2
+
+
+@pytest.mark.asyncio
+async def test_max_connections():
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await reader.readuntil(b"\r\n\r\n")
+        await reader.readexactly(2)
+        await asyncio.sleep(0.1)
+        writer.write(http_response(b"{}"))
+        await writer.drain()
+        writer.close()
+
+    servers = [await asyncio.start_server(handle, "127.0.0.1", 0) for _ in range(4)]
+    transport = Transport(max_connections=2)
+    peak = 0
+
+    async def monitor():
+        nonlocal peak
+        while True:
+            peak = max(peak, transport.open_connections)
+            await asyncio.sleep(0.01)
+
+    task = asyncio.create_task(monitor())
+    try:
+        urls = [f"http://127.0.0.1:{x.sockets[0].getsockname()[1]}/zeroconf/info" for x in servers]
+        responses = await asyncio.gather(*[transport.post(url, {}, "{}") for url in urls])
+    finally:
+        task.cancel()
+        for server in servers:
+            server.close()
+
+    assert [x.status for x in responses] == [200] * 4
+    assert peak == 2
+    assert transport.open_connections <= 2
+
+
+@pytest.mark.asyncio
+async def test_slot_wait():
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await reader.readuntil(b"\r\n\r\n")
+        await reader.readexactly(2)
+        await asyncio.sleep(0.1)
+        writer.write(http_response(b"{}"))
+        await writer.drain()
+        writer.close()
+
+    servers = [await asyncio.start_server(handle, "127.0.0.1", 0) for _ in range(3)]
+    try:
+        urls = [f"http://127.0.0.1:{x.sockets[0].getsockname()[1]}/zeroconf/info" for x in servers]
+
+        # Waiting for a free slot doesn't count toward the timeout of the request
+        transport = Transport(max_connections=1)
+        responses = await asyncio.gather(*[transport.post(url, {}, "{}", timeout=0.25) for url in urls])
+        assert [x.status for x in responses] == [200] * 3
+        assert all(0.1 <= x.elapsed < 0.25 for x in responses)
+
+        # ...but it is bounded by its own timeout
+        transport = Transport(max_connections=1, acquire_timeout=0.05)
+        results = await asyncio.gather(*[transport.post(url, {}, "{}") for url in urls[:2]], return_exceptions=True)
+        assert results[0].status == 200
+        assert isinstance(results[1], PoolTimeoutError)
+
+        # A request cancelled before starting gives its slot back
+        with pytest.raises(asyncio.TimeoutError):
+            await transport.post(urls[0], {}, "{}", timeout=0)
+        assert transport.open_connections == 0
+    finally:
+        for server in servers:
+            server.close()
+
+
+@pytest.mark.asyncio
+async def test_evict():
+    async with DeviceServer([http_response(b"{}")]) as server:
+        transport = Transport()
+        await transport.post(f"http://127.0.0.1:{server.port}/zeroconf/info", {}, "{}")
+        assert transport.idle_connections == 1
+        transport.evict(f"http://127.0.0.1:{server.port}")
+
+    assert transport.idle_connections == 0
+    assert transport.open_connections == 0
+
+
+@pytest.mark.asyncio
+async def test_connect_any():
+    # A port nobody listens on
+    closed = await asyncio.start_server(lambda r, w: None, "127.0.0.1", 0)
+    closed_port = closed.sockets[0].getsockname()[1]
+    closed.close()
+    await closed.wait_closed()
+
+    async with DeviceServer([http_response(b"{}")]) as server:
+        transport = Transport()
+        urls = [f"http://127.0.0.1:{closed_port}", f"http://127.0.0.1:{server.port}"]
+        url = await transport.connect_any(urls, delay=0.05)
+        assert url == urls[1]
+        assert transport.idle_connections == 1
+
+        # The winning connection is used by the next request
+        await transport.post(f"{url}/zeroconf/info", {}, "{}")
+        assert server.connections == 1
+
+        # Already connected: no new attempt
+        assert await transport.connect_any(urls) == urls[1]
+        assert server.connections == 1
+        await transport.close()
+
+    with pytest.raises(ConnectionError):
+        await transport.connect_any([f"http://127.0.0.1:{closed_port}"], delay=0.05)
+    with pytest.raises(ValueError):
+        await transport.connect_any([])
+
+
+def test_build_request_ipv6():
+    request = _build_request("fe80::1%eth0", 8081, "/zeroconf/info", {}, b"{}", keep_alive=True)
+    assert b"\r\nHost: [fe80::1]:8081\r\n" in request  # The scope is not sent
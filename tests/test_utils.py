@@ -1,7 +1,24 @@
-from sonofflan.utils import parse_address
+import pytest
+
+from sonofflan.utils import base_url, parse_address
 
 
 def test_parse_address():
     input_data = bytes([1, 2, 3, 4])
     output = parse_address(input_data)
     assert output == "1.2.3.4"
+
+
+def test_parse_address_ipv6():
+    input_data = bytes([0xfe, 0x80] + [0] * 13 + [1])
+    output = parse_address(input_data)
+    assert output == "fe80::1"
+
+    with pytest.raises(ValueError):
+        parse_address(bytes([1, 2, 3]))
+
+
+def test_base_url():
+    assert base_url("1.2.3.4", 8081) == "http://1.2.3.4:8081"
+    assert base_url("fe80::1", 8081) == "http://[fe80::1]:8081"
+    assert base_url("fe80::1%eth0", 8081) == "http://[fe80::1%eth0]:8081"